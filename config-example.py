@@ -33,7 +33,26 @@ class FixedOptions:
     """
     PER_REPLICA_BATCH = 2
     BATCH_SIZE = PER_REPLICA_BATCH
-    OPTIMIZER = ["adam_constant"][0]
+    # gradients of GRAD_ACCUM_STEPS batches are accumulated and applied at once,
+    # effective batch size is BATCH_SIZE * GRAD_ACCUM_STEPS,
+    # micro-batches left at the end of epoch are applied as a smaller batch
+    GRAD_ACCUM_STEPS = 1
+    # "{optimizer}_{schedule}", learning rate of plan stage is scaled by schedule of global step
+    OPTIMIZER = ["adam_constant", "adam_cosine", "adam_step", "sgd_constant", "sgd_cosine", "sgd_step"][0]
+    LR_WARMUP_STEPS = 0
+    # cosine decays to LR_MIN_RATIO over LR_DECAY_STEPS, step decays by LR_DECAY_RATE every LR_DECAY_STEPS
+    LR_DECAY_STEPS = 100000
+    LR_DECAY_RATE = 0.1
+    LR_MIN_RATIO = 0.01
+    # training checkpoints are saved every epoch and every CKPT_SAVE_STEPS steps (0: only every epoch),
+    # the last CKPT_MAX_TO_KEEP checkpoints are kept
+    CKPT_SAVE_STEPS = 0
+    CKPT_MAX_TO_KEEP = 3
+    # mixed precision runs networks and images in 16 bits while poses, projections and loss reductions stay in float32
+    PRECISION = ["float32", "mixed_float16", "mixed_bfloat16"][0]
+    # stages whose activations are recomputed in backward pass instead of stored (model/model_util/recompute.py)
+    # subset of ["depth_decoder", "posenet", "flownet", "synthesis", "photo_error"]
+    RECOMPUTE = []
     DEPTH_ACTIVATION = ["InverseSigmoid", "Exponential"][0]
     PRETRAINED_WEIGHT = True
 
@@ -70,6 +89,7 @@ class VodeOptions(FixedOptions):
     DATAPATH_LOG = op.join(DATAPATH, "log")
     DATAPATH_PRD = op.join(DATAPATH, "prediction")
     DATAPATH_EVL = op.join(DATAPATH, "evaluation")
+    DATAPATH_PRV = op.join(DATAPATH, "preview")
     PROJECT_ROOT = op.dirname(__file__)
 
     """
@@ -84,6 +104,12 @@ class VodeOptions(FixedOptions):
     FRAME_PER_DRIVE = 0
     TOTAL_FRAME_LIMIT = 0
     VALIDATION_FRAMES = 500
+    # previews of converted examples are written to DATAPATH_PRV in background
+    # one preview per PREVIEW_INTERVAL examples (0: disabled), at most once per PREVIEW_MIN_PERIOD seconds
+    PREVIEW_INTERVAL = 0
+    PREVIEW_MIN_PERIOD = 1.
+    # byte budget of decoded frame cache in each reader (a2d2, waymo)
+    FRAME_CACHE_MBYTES = 512
     AUGMENT_PROBS = {"CropAndResize": 0.2,
                      "HorizontalFlip": 0.2,
                      "ColorJitter": 0.2}
@@ -93,8 +119,19 @@ class VodeOptions(FixedOptions):
     """
     ENABLE_SHAPE_DECOR = False
     LOG_LOSS = True
-    TRAIN_MODE = ["eager", "graph", "distributed"][1]
+    # metrics are kept on device and read back every LOG_STEPS steps
+    LOG_STEPS = 20
+    # console and csv outputs of step metrics are written every LOG_PERIOD seconds by a background thread
+    LOG_PERIOD = 1.
+    # "graph_xla" compiles train and validation steps by XLA, falls back to graph mode if compilation fails
+    # "multi_worker" reads cluster from TF_CONFIG, see model/multi_worker_local.py to run workers on one machine
+    TRAIN_MODE = ["eager", "graph", "graph_xla", "distributed", "multi_worker"][1]
+    # in eager mode, trace loss once into a tf.function (off by default so that loss ops run eagerly for debugging)
+    TRACE_LOSS = False
     SSIM_RATIO = 0.5
+    # md2 and cmb losses synthesize full resolution targets from upsampled depths instead of resizing
+    # low resolution reconstructions (Monodepth2), low resolution synthesis is skipped if no other loss needs it
+    SYNTH_FULL_RES = False
     SCALE_WEIGHT_T1 = np.array([0.25, 0.25, 0.25, 0.25]) * 4.
     SCALE_WEIGHT_T2 = np.array([0.1, 0.2, 0.3, 0.4]) * 4.
     LOSS_RIGID_T1 = {
@@ -0,0 +1,175 @@
+"""
+CPU benchmark of training modes and options, e.g. activation recomputation, precision and loss tracing
+Each setting is a training mode with options that override config.py,
+and runs in a new process on synthetic features so that peak memory and traced graphs are not shared.
+It reports time of the first step (trace and compile), steps/sec of the following steps,
+peak memory allocated by TF during a step, peak RSS of the process and the loss after the last step.
+Every setting starts from the same random seed, but losses of repeated runs differ by about 1% on CPU,
+so use them only to catch settings that break training.
+    python -m model.benchmark_train_modes
+"""
+import os
+# benchmark on CPU
+os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+import multiprocessing
+import resource
+import numpy as np
+import tensorflow as tf
+from timeit import default_timer as timer
+
+import settings
+from config import opts
+from tfrecords.tfrecord_reader import feature_signature
+from model.build_model.model_factory import ModelFactory
+from model.model_util.augmentation import augmentation_factory
+from model.loss_and_metric.loss_factory import loss_factory
+from model.model_util.optimizers import optimizer_factory, set_precision_policy
+import model.train_val as tv
+import utils.util_funcs as uf
+
+BENCHMARK_MODES = ["eager", "graph", "graph_xla"]
+BENCHMARK_RECOMPUTE = [[], ["photo_error"], ["synthesis", "photo_error"], ["depth_decoder"],
+                       ["depth_decoder", "synthesis", "photo_error"]]
+BENCHMARK_PRECISION = ["float32", "mixed_float16", "mixed_bfloat16"]
+BENCHMARK_NET = {"depth": "DepthNetBasic", "camera": "PoseNet"}
+BENCHMARK_SEED = 1234
+
+
+def make_synthetic_config(snippet_len=5, height=128, width=384):
+    """
+    :return: tfr_config like one read from tfr_config.txt of a monocular dataset
+    """
+    def feature_config(shape, decode_type):
+        return {"parse_type": tf.string, "decode_type": decode_type, "shape": shape}
+
+    return {"image": feature_config([snippet_len * height, width, 3], tf.uint8),
+            "intrinsic": feature_config([3, 3], tf.float32),
+            "pose_gt": feature_config([snippet_len - 1, 4, 4], tf.float32),
+            "depth_gt": feature_config([height, width, 1], tf.float32),
+            "imshape": [snippet_len, height, width, 3],
+            "length": 1000}
+
+
+def make_synthetic_features(tfr_config, batch_size):
+    signature = feature_signature(tfr_config, batch_size)
+    _, height, width, _ = tfr_config["imshape"]
+    features = {key: tf.random.uniform(spec.shape, -1., 1., dtype=spec.dtype) for key, spec in signature.items()}
+    features["image"] = tf.reshape(features["image5d"], signature["image"].shape)
+    intrinsic = np.array([[width / 2, 0, width / 2], [0, width / 2, height / 2], [0, 0, 1]], dtype=np.float32)
+    features["intrinsic"] = tf.constant(np.tile(intrinsic, (batch_size, 1, 1)))
+    features["pose_gt"] = tf.eye(4, batch_shape=signature["pose_gt"].shape[:2])
+    features["depth_gt"] = tf.random.uniform(signature["depth_gt"].shape, 1., 50.)
+    return features
+
+
+def benchmark_mode(mode, steps, batch_size, result_queue, options=None, loss_weights=None):
+    """
+    :param options: {option name: value} that overrides options of config.py, e.g. {"RECOMPUTE": ["synthesis"]}
+    :param loss_weights: loss weights of the benchmark, LOSS_RIGID_T1 by default
+    """
+    opts.TRAIN_MODE = mode
+    options = dict() if options is None else options
+    for name, value in options.items():
+        setattr(opts, name, value)
+    loss_weights = opts.LOSS_RIGID_T1 if loss_weights is None else loss_weights
+    np.random.seed(BENCHMARK_SEED)
+    tf.random.set_seed(BENCHMARK_SEED)
+    set_precision_policy(opts.PRECISION)
+    tfr_config = make_synthetic_config()
+    features = make_synthetic_features(tfr_config, batch_size)
+    model = ModelFactory(tfr_config, global_batch=batch_size, net_names=BENCHMARK_NET,
+                         pretrained_weight=False, stereo=False).get_model()
+    # default arguments of loss_factory are bound when it is imported, so options are passed explicitly
+    loss_object = loss_factory(tfr_config, loss_weights, opts.SCALE_WEIGHT_T1, stereo=False,
+                               batch_size=batch_size, full_res_synth=opts.SYNTH_FULL_RES, trace=opts.TRACE_LOSS)
+    optimizer = optimizer_factory("adam_constant", 0.0001, precision=opts.PRECISION)
+    trainer, _ = tv.train_val_factory(mode, model, loss_object, steps, False, augmentation_factory(), optimizer,
+                                      feature_signature(tfr_config, batch_size))
+
+    start = timer()
+    _, loss, _, _ = trainer.run_a_batch(features)
+    loss.numpy()
+    first_step = timer() - start
+    _, step_peak_mbytes = uf.measure_peak_memory(lambda: trainer.run_a_batch(features)[1].numpy())
+    start = timer()
+    for _ in range(steps):
+        _, loss, _, _ = trainer.run_a_batch(features)
+    loss.numpy()
+    steps_per_sec = steps / (timer() - start)
+    # ru_maxrss is in kilobytes on linux
+    peak_mbytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    label = ", ".join([mode] + [f"{name}={value}" for name, value in options.items()])
+    result_queue.put({"mode": label, "first_step_sec": first_step, "steps_per_sec": steps_per_sec,
+                      "step_peak_MB": step_peak_mbytes, "peak_MB": peak_mbytes, "loss": float(loss.numpy()),
+                      "trace_count": trainer.trace_count})
+
+
+def run_benchmarks(bench_settings, steps, batch_size, loss_weights=None):
+    """
+    :param bench_settings: list of (mode, {option name: value})
+    """
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for mode, options in bench_settings:
+        result_queue = context.Queue()
+        process = context.Process(target=benchmark_mode,
+                                  args=(mode, steps, batch_size, result_queue, options, loss_weights))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            print(f"[run_benchmarks] {mode} mode with {options} failed with exit code {process.exitcode}")
+            continue
+        results.append(result_queue.get())
+
+    print("\n[run_benchmarks] CPU, batch size:", batch_size, ", image shape:", make_synthetic_config()["imshape"])
+    for result in results:
+        step_peak = "n/a" if result["step_peak_MB"] is None else f"{result['step_peak_MB']:8.1f} MB"
+        print(f"  {result['mode']:>10}: first step {result['first_step_sec']:7.2f} sec, "
+              f"{result['steps_per_sec']:6.3f} steps/sec, step peak memory {step_peak}, "
+              f"peak RSS {result['peak_MB']:8.1f} MB, loss {result['loss']:.5f}, traced {result['trace_count']} times")
+    return results
+
+
+def benchmark_train_modes(modes=BENCHMARK_MODES, steps=20, batch_size=2):
+    return run_benchmarks([(mode, dict()) for mode in modes], steps, batch_size)
+
+
+def benchmark_recompute(recompute_list=BENCHMARK_RECOMPUTE, mode="graph", steps=20, batch_size=2):
+    """
+    peak memory and speed of graph mode with each set of recomputed stages
+    """
+    return run_benchmarks([(mode, {"RECOMPUTE": recompute}) for recompute in recompute_list], steps, batch_size)
+
+
+def benchmark_trace_loss(mode="eager", steps=20, batch_size=2):
+    """
+    speed of eager mode with the loss run op by op and traced once into a tf.function
+    """
+    return run_benchmarks([(mode, {"TRACE_LOSS": trace}) for trace in [False, True]], steps, batch_size)
+
+
+
+def benchmark_precision(precisions=BENCHMARK_PRECISION, mode="graph", steps=20, batch_size=2):
+    """
+    peak memory, speed and loss of graph mode with each precision policy
+    """
+    return run_benchmarks([(mode, {"PRECISION": precision}) for precision in precisions], steps, batch_size)
+
+
+
+def benchmark_full_res_synth(mode="graph", steps=20, batch_size=2):
+    """
+    peak memory and speed of Monodepth2 losses with targets synthesized at low resolution and at full resolution
+    """
+    # monocular losses of LOSS_RIGID_T3, synthetic features have no right images
+    loss_weights = {name: opts.LOSS_RIGID_T3[name] for name in ["md2L1", "md2SSIM", "smoothe"]}
+    return run_benchmarks([(mode, {"SYNTH_FULL_RES": full_res}) for full_res in [False, True]], steps, batch_size,
+                          loss_weights)
+
+
+if __name__ == "__main__":
+    benchmark_train_modes()
+    benchmark_recompute()
+    benchmark_trace_loss()
+    benchmark_precision()
+    benchmark_full_res_synth()
@@ -5,6 +5,7 @@ import settings
 import utils.util_funcs as uf
 import model.model_util.layer_ops as lo
 from model.build_model.pretrained_nets import PretrainedModel
+from model.model_util.recompute import recompute_block
 
 
 class DepthNetBasic:
@@ -73,6 +74,14 @@ class DepthNetBasic:
         return upconv
 
     def upconv_with_skip_connection(self, bef_layer, skip_layer, out_channels, scope, bef_pred=None):
+        def build_block(*block_inputs):
+            return self.upconv_block(out_channels, scope, *block_inputs)
+
+        inputs = [bef_layer, skip_layer] if bef_pred is None else [bef_layer, skip_layer, bef_pred]
+        # activations of the block are recomputed in backward pass if "depth_decoder" is in RECOMPUTE
+        return recompute_block("depth_decoder", build_block, inputs, scope)
+
+    def upconv_block(self, out_channels, scope, bef_layer, skip_layer, bef_pred=None):
         upconv = self.upsample_2x_d(bef_layer, scope)
         upconv = self.conv2d_d(upconv, out_channels, 3, name=scope + "_conv1")
         upconv = lo.resize_like(upconv, skip_layer, scope)
@@ -85,7 +94,8 @@ class DepthNetBasic:
 
     def get_scaled_depth(self, src, dst_height, dst_width, scope):
         conv = self.conv2d_d(src, 1, 3, activation="linear", name=scope + "_conv")
-        depth = layers.Lambda(lambda x: self.predict_depth(x), name=scope + "_acti")(conv)
+        # depth is activated and output in float32 under mixed precision policy
+        depth = layers.Lambda(lambda x: self.predict_depth(x), name=scope + "_acti", dtype="float32")(conv)
         conv_up = lo.resize_image(conv, dst_height, dst_width, scope)
         return depth, conv_up, conv
 
@@ -97,7 +107,7 @@ class DepthNetNoResize(DepthNetBasic):
     Modified BasicModel to remove resizing features in decoding layers
     Width and height of input image must be integer multiple of 128
     """
-    def upconv_with_skip_connection(self, bef_layer, skip_layer, out_channels, scope, bef_pred=None):
+    def upconv_block(self, out_channels, scope, bef_layer, skip_layer, bef_pred=None):
         upconv = self.upsample_2x_d(bef_layer, scope)
         upconv = self.conv2d_d(upconv, out_channels, 3, name=scope + "_conv1")
         upconv = tf.cond(bef_pred is not None,
@@ -181,6 +181,27 @@ def test_model_predictions():
     print("!!! test_model_predictions passed")
 
 
+def test_build_depthnet_mixed_precision():
+    print("\n===== start test_build_depthnet_mixed_precision")
+    import numpy as np
+    from model.model_util.optimizers import set_precision_policy
+    dataset_cfg = {"imshape": list(opts.get_img_shape("SHWC"))}
+    try:
+        set_precision_policy("mixed_float16")
+        model = ModelFactory(dataset_cfg, global_batch=1, net_names={"depth": "DepthNetBasic"},
+                             depth_activation="InverseSigmoid", pretrained_weight=False).get_model()
+        depthnet = model.models["depthnet"]
+        image5d = tf.zeros([1] + dataset_cfg["imshape"])
+        depth_ms = depthnet(image5d)["depth_ms"]
+    finally:
+        set_precision_policy("float32")
+    # depth is activated in float32 while convolutions run in float16
+    for depth in depth_ms:
+        assert depth.dtype == tf.float32, depth.dtype
+        assert np.isfinite(depth.numpy()).all()
+    print("!!! test_build_depthnet_mixed_precision passed")
+
+
 def print_dict_tensor_shape(dictdata, title):
     for name, data in dictdata.items():
         if isinstance(data, list):
@@ -193,4 +214,5 @@ def print_dict_tensor_shape(dictdata, title):
 if __name__ == "__main__":
     # test_build_model()
     test_model_predictions()
+    test_build_depthnet_mixed_precision()
 
@@ -5,6 +5,7 @@ import os.path as op
 from config import opts
 import utils.util_funcs as uf
 import utils.convert_pose as cp
+from model.model_util.recompute import recompute, RECOMPUTE_STAGES
 
 
 class ModelWrapper:
@@ -40,8 +41,13 @@ class ModelWrapper:
     def predict_batch(self, features, suffix=""):
         predictions = dict()
         for netname, model in self.models.items():
-            pred = model(features["image5d" + suffix])
+            # activations of posenet and flownet are recomputed in backward pass if netname is in RECOMPUTE,
+            # depthnet recomputes its decoder blocks instead ("depth_decoder")
+            network = recompute(netname, model) if netname in RECOMPUTE_STAGES else model
+            pred = network(features["image5d" + suffix])
             predictions.update(pred)
+        # with mixed precision, outputs are cast back to float32 for pose math and pixel projection
+        predictions = uf.cast_float32(predictions)
 
         if "depth_ms" in predictions:
             predictions["disp_ms"] = uf.safe_reciprocal_number_ms(predictions["depth_ms"])
@@ -4,8 +4,11 @@ import model.loss_and_metric.losses as lm
 
 
 def loss_factory(dataset_cfg, loss_weights, scale_weights, stereo=opts.STEREO,
-                 weights_to_regularize=None, batch_size=opts.BATCH_SIZE):
-    scale_weights = tf.convert_to_tensor(scale_weights.reshape(scale_weights.shape[0], 1), dtype=tf.float32)
+                 weights_to_regularize=None, batch_size=opts.BATCH_SIZE, full_res_synth=opts.SYNTH_FULL_RES,
+                 trace=opts.TRACE_LOSS):
+    # weights are variables so that compiled steps can be reused when weights change between plan stages
+    scale_weights = tf.Variable(scale_weights.reshape(scale_weights.shape[0], 1), dtype=tf.float32,
+                                trainable=False, name="scale_weights")
     loss_pool = {
         "L1": lm.PhotometricLossMultiScale("L1", scale_weights),
         "L1_R": lm.PhotometricLossMultiScale("L1", scale_weights, key_suffix="_R"),
@@ -31,20 +34,43 @@ def loss_factory(dataset_cfg, loss_weights, scale_weights, stereo=opts.STEREO,
         "flowL2_R": lm.FlowWarpLossMultiScale("L2", scale_weights, key_suffix="_R"),
         "flow_reg": lm.L2Regularizer(weights_to_regularize),
     }
-    losses = dict()
-    weights = dict()
+    weights = select_loss_weights(loss_weights, dataset_cfg)
+    losses = {name: loss_pool[name] for name in weights}
+    print("[loss_factory] loss weights:", weights)
+    print("[loss_factory] scale weights:", scale_weights.numpy()[:, 0])
+    weights = {name: tf.Variable(weight, dtype=tf.float32, trainable=False, name=f"loss_weight_{name}")
+               for name, weight in weights.items()}
+    return lm.TotalLoss(losses, weights, stereo, batch_size, full_res_synth, trace)
+
 
+def select_loss_weights(loss_weights, dataset_cfg):
+    """
+    :return: weights of losses that have non-zero weight and whose dependent data are in dataset
+    """
+    weights = dict()
     for name, weight in loss_weights.items():
         if weight == 0.:
             continue
         if not check_loss_dependency(name, dataset_cfg):
             continue
-        losses[name] = loss_pool[name]
         weights[name] = weight
+    return weights
 
-    print("[loss_factory] loss weights:", weights)
-    print("[loss_factory] scale weights:", scale_weights[:, 0])
-    return lm.TotalLoss(losses, weights, stereo, batch_size)
+
+def update_loss_weights(total_loss, loss_weights, scale_weights):
+    """
+    assign new weights to loss weight variables of total_loss made by loss_factory
+    losses with new non-zero weights cannot be added, so total_loss must have the same set of losses
+    """
+    for name, weight_var in total_loss.loss_weights.items():
+        weight_var.assign(loss_weights[name])
+    scale_weights = scale_weights.reshape(scale_weights.shape[0], 1)
+    for loss_object in total_loss.loss_objects.values():
+        if isinstance(getattr(loss_object, "scale_weights", None), tf.Variable):
+            loss_object.scale_weights.assign(scale_weights)
+    print("[update_loss_weights] loss weights:", {name: weight_var.numpy()
+                                                  for name, weight_var in total_loss.loss_weights.items()})
+    print("[update_loss_weights] scale weights:", scale_weights[:, 0])
 
 
 def check_loss_dependency(loss_key, dataset_cfg):
@@ -1,6 +1,5 @@
 import tensorflow as tf
-from tensorflow.keras import layers
-from model.synthesize.synthesize_base import SynthesizeMultiScale
+from model.synthesize.synthesize_base import SynthesizeMultiScale, SynthesisRequest
 from model.synthesize.flow_warping import FlowWarpMultiScale
 
 import utils.util_funcs as uf
@@ -8,21 +7,57 @@ from utils.util_class import WrongInputException
 import utils.convert_pose as cp
 from utils.decorators import shape_check
 import model.loss_and_metric.loss_util as lsu
+from model.model_util.recompute import recompute
 
 
 class TotalLoss:
-    def __init__(self, loss_objects=None, loss_weights=None, stereo=False, batch_size=1):
+    def __init__(self, loss_objects=None, loss_weights=None, stereo=False, batch_size=1, full_res_synth=False,
+                 trace=False):
         """
         :param loss_objects: dict of loss objects
         :param loss_weights: dict of weights of losses
+        :param full_res_synth: synthesize full resolution target from upsampled depth of each scale
+                               for MonoDepth2 and Combined losses (Monodepth2 style)
+        :param trace: when called eagerly, trace loss into a tf.function with input signature of the first batch
+                      instead of running every op eagerly
         """
         self.loss_objects = loss_objects
         self.loss_weights = loss_weights
         self.stereo = stereo
         self.batch_size = batch_size
+        self.full_res_synth = full_res_synth
+        # low resolution synthesis is skipped when no loss compares synthesized images at each scale
+        self.low_res_synth = (not full_res_synth) or \
+            any([type(loss) is PhotometricLossMultiScale for loss in (loss_objects or dict()).values()])
+        self.synthesizer = SynthesizeMultiScale()
+        # images are synthesized in compute dtype (float16 or bfloat16 under mixed precision policy)
+        self.image_dtype = tf.keras.mixed_precision.experimental.global_policy().compute_dtype
+        self.trace = trace
+        self.traced_loss = None
+        self.traced_signature = None
+        self.trace_count = 0
 
     @shape_check
     def __call__(self, predictions, features):
+        """
+        in graph and distributed modes, the loss is already a part of traced training step
+        in eager mode, the loss is traced once if self.trace, then the graph runs on every step
+        arguments and returns are the same as compute_loss()
+        """
+        if self.trace and tf.executing_eagerly():
+            return self.run_traced_loss(predictions, features)
+        return self.compute_loss(predictions, features)
+
+    def run_traced_loss(self, predictions, features):
+        signature = tf.nest.map_structure(tf.TensorSpec.from_tensor, (predictions, features))
+        if signature != self.traced_signature:
+            if self.traced_signature is not None:
+                print("[TotalLoss] input signature changed, retrace loss")
+            self.traced_loss = tf.function(self.compute_loss, input_signature=signature)
+            self.traced_signature = signature
+        return self.traced_loss(predictions, features)
+
+    def compute_loss(self, predictions, features):
         """
         :param predictions: {"depth_ms": .., "disp_ms": .., "pose": ..}
             disp_ms: multi scale disparity, list of [batch, height/scale, width/scale, 1]
@@ -33,12 +68,11 @@ class TotalLoss:
         :return loss: final loss of frames in batch (scalar)
                 losses: list of losses computed from loss_objects
         """
-        augm_data = self.append_data(features, predictions)
-        if self.stereo and ("image_R" in features):
-            augm_data_rig = self.append_data(features, predictions, "_R")
-            augm_data.update(augm_data_rig)
-            augm_data_stereo = self.synethesize_stereo(features, predictions, augm_data)
-            augm_data.update(augm_data_stereo)
+        # python code here runs only when traced
+        self.trace_count += 1
+        augm_data = self.append_data_rig(features, predictions)
+        # per-pixel errors are computed once and shared by losses
+        augm_data["photo_error_cache"] = PhotometricErrorCache(augm_data)
 
         losses = []
         loss_by_type = dict()
@@ -50,10 +84,32 @@ class TotalLoss:
             losses.append(weighted_loss)
             loss_by_type[loss_name] = loss_mean
 
-        total_loss = layers.Lambda(lambda x: tf.reduce_sum(x), name="total_loss")(losses)
+        total_loss = tf.add_n(losses)
         return total_loss, loss_by_type
 
-    def append_data(self, features, predictions, suffix=""):
+    def append_data_rig(self, features, predictions):
+        """
+        gather additional data of left and (if stereo) right cameras
+        when both sides have depth and pose, temporal and stereo reconstructions of both sides
+        are packed into a single synthesis per scale (see synthesize_rig)
+        :return augm_data: outputs of append_data with and without "_R" suffix, stereo_synth_ms, stereo_synth_ms_R
+        """
+        if not (self.stereo and ("image_R" in features)):
+            return self.append_data(features, predictions)
+
+        packed = self.low_res_synth and ("stereo_T_LR" in features) and \
+            all([key in predictions for key in ["depth_ms", "pose", "depth_ms_R", "pose_R"]])
+        augm_data = self.append_data(features, predictions, synth_low_res=not packed)
+        augm_data_rig = self.append_data(features, predictions, "_R", synth_low_res=not packed)
+        augm_data.update(augm_data_rig)
+        if packed:
+            augm_data_synth = self.synthesize_rig(features, predictions, augm_data)
+        else:
+            augm_data_synth = self.synethesize_stereo(features, predictions, augm_data)
+        augm_data.update(augm_data_synth)
+        return augm_data
+
+    def append_data(self, features, predictions, suffix="", synth_low_res=None):
         """
         gather additional data required to compute losses
         :param features: {image, intrinsic}
@@ -63,6 +119,7 @@ class TotalLoss:
                 depth_ms: multi scale disparities, list of [batch, height/scale, width/scale, 1]
                 pose: poses that transform points from target to source [batch, numsrc, 6]
         :param suffix: suffix to keys
+        :param synth_low_res: synthesize target at each scale, follows self.low_res_synth if None
         :return augm_data: {depth_ms, source, target, target_ms, synth_target_ms}
                 depth_ms: multi scale depth, list of [batch, height/scale, width/scale, 1]
                 source: source frames [batch, numsrc, height, width, 3]
@@ -70,10 +127,12 @@ class TotalLoss:
                 target_ms: multi scale target frame, list of [batch, height/scale, width/scale, 3]
                 synth_target_ms: multi scale synthesized target frames generated from each source image,
                                 list of [batch, numsrc, height/scale, width/scale, 3]
+                synth_target_full_ms: full resolution target frames synthesized from depth of each scale,
+                                list of [batch, numsrc, height, width, 3] (only if full_res_synth)
                 warped_target_ms: multi scale flow warped target frames generated from each source image,
                                 list of [batch, numsrc, height/scale, width/scale, 3]
         """
-        image5d = features["image5d" + suffix]
+        image5d = tf.cast(features["image5d" + suffix], self.image_dtype)
         intrinsic = features["intrinsic" + suffix]
         source_image = image5d[:, :-1]
         target_image = image5d[:, -1]
@@ -84,11 +143,23 @@ class TotalLoss:
         if ("depth_ms" + suffix in predictions) and ("pose" + suffix in predictions):
             pred_depth_ms = predictions["depth_ms" + suffix]
             pred_pose = predictions["pose" + suffix]
-            target_ms = uf.multi_scale_like_depth(target_image, pred_depth_ms)
+            # resize the whole snippet once and split it into source and target pyramids
+            image_ms = self.synthesizer.make_pyramid(image5d, pred_depth_ms)
+            source_ms = [image_sc[:, :-1] for image_sc in image_ms]
+            target_ms = [image_sc[:, -1] for image_sc in image_ms]
+            augm_data["source_ms" + suffix] = source_ms
             augm_data["target_ms" + suffix] = target_ms
+            pose_matr = cp.pose_rvec2matr_batch_tf(pred_pose)
+            augm_data["pose_matr" + suffix] = pose_matr
+            if synth_low_res is None:
+                synth_low_res = self.low_res_synth
             # synthesized image is used in both L1 and SSIM photometric losses
-            synth_target_ms = SynthesizeMultiScale()(source_image, intrinsic, pred_depth_ms, pred_pose)
-            augm_data["synth_target_ms" + suffix] = synth_target_ms
+            if synth_low_res:
+                synth_target_ms = self.synthesizer(source_image, intrinsic, pred_depth_ms, pose_matr, source_ms)
+                augm_data["synth_target_ms" + suffix] = synth_target_ms
+            if self.full_res_synth:
+                synth_target_full_ms = self.synthesize_full_res(source_image, intrinsic, pred_depth_ms, pose_matr)
+                augm_data["synth_target_full_ms" + suffix] = synth_target_full_ms
 
         # warped image is used in both L1 and SSIM photometric losses
         if "flow_ms" + suffix in predictions:
@@ -101,6 +172,57 @@ class TotalLoss:
 
         return augm_data
 
+    def synthesize_rig(self, features, predictions, augm_data):
+        """
+        synthesize temporal and stereo reconstructions of both sides at once
+        left and right targets are concatenated along the batch axis,
+        and temporal and stereo sources of each target are concatenated along the source axis
+        :return: {synth_target_ms, synth_target_ms_R, stereo_synth_ms, stereo_synth_ms_R}
+                synth_target_ms(_R): list of [batch, numsrc, height/scale, width/scale, 3]
+                stereo_synth_ms(_R): list of [batch, 1, height/scale, width/scale, 3]
+        """
+        def concat_rig(left, right):
+            return tf.concat([left, right], axis=0)
+
+        def concat_rig_ms(left_ms, right_ms):
+            return [concat_rig(left, right) for left, right in zip(left_ms, right_ms)]
+
+        batch, height = augm_data["target"].get_shape()[:2]
+        pose_T_LR = tf.expand_dims(features["stereo_T_LR"], 1)
+        pose_T_RL = tf.expand_dims(tf.linalg.inv(features["stereo_T_LR"]), 1)
+        # target pyramids of the other side are reused as stereo source pyramids
+        requests = [SynthesisRequest("synth_target_ms",
+                                     source_ms=concat_rig_ms(augm_data["source_ms"], augm_data["source_ms_R"]),
+                                     pose=concat_rig(augm_data["pose_matr"], augm_data["pose_matr_R"])),
+                    SynthesisRequest("stereo_synth_ms",
+                                     source_ms=concat_rig_ms(self.stereo_source_ms(augm_data, "_R"),
+                                                             self.stereo_source_ms(augm_data, "")),
+                                     pose=concat_rig(pose_T_RL, pose_T_LR))]
+        # [2*batch, ...]
+        intrinsic = concat_rig(features["intrinsic"], features["intrinsic_R"])
+        depth_ms = concat_rig_ms(predictions["depth_ms"], predictions["depth_ms_R"])
+        synth_by_key = self.synthesizer.synthesize_requests(requests, intrinsic, depth_ms, height)
+
+        synth_rig = dict()
+        for key, synth_ms in synth_by_key.items():
+            synth_rig[key] = [synth_sc[:batch] for synth_sc in synth_ms]
+            synth_rig[key + "_R"] = [synth_sc[batch:] for synth_sc in synth_ms]
+        return synth_rig
+
+    def synthesize_full_res(self, source_image, intrinsic, pred_depth_ms, pose_matr):
+        """
+        upsample depth of each scale to full resolution and synthesize target from full resolution sources,
+        instead of upsampling low resolution reconstructions (Monodepth2)
+        :return: list of [batch, numsrc, height, width, 3]
+        """
+        height, width = source_image.get_shape()[2:4]
+        depth_full_ms = [depth if depth.get_shape()[1] == height else
+                         tf.image.resize(depth, (height, width), method="bilinear")
+                         for depth in pred_depth_ms]
+        # all scales share the full resolution source
+        source_ms = [source_image] * len(depth_full_ms)
+        return self.synthesizer(source_image, intrinsic, depth_full_ms, pose_matr, source_ms)
+
     def synethesize_stereo(self, features, predictions, augm_data):
         """
         gather additional data required to compute losses
@@ -116,28 +238,36 @@ class TotalLoss:
         if ("stereo_T_LR" not in features) or ("depth_ms" not in predictions):
             return synth_stereo
 
+        # target pyramids of the other side are reused as stereo source pyramids
         # synthesize left image from right image
-        pose_T_RL = tf.linalg.inv(features["stereo_T_LR"])
-        pose_T_RL = cp.pose_matr2rvec_batch(tf.expand_dims(pose_T_RL, 1))
-        stereo_source = tf.expand_dims(augm_data["target_R"], 1)
-        synth_stereo["stereo_synth_ms"] = SynthesizeMultiScale()(
-                                                source_image=stereo_source,
+        pose_T_RL = tf.expand_dims(tf.linalg.inv(features["stereo_T_LR"]), 1)
+        synth_stereo["stereo_synth_ms"] = self.synthesizer(
+                                                source_image=tf.expand_dims(augm_data["target_R"], 1),
                                                 intrinsic=features["intrinsic"],
                                                 pred_depth_ms=predictions["depth_ms"],
-                                                pred_pose=pose_T_RL)
+                                                pred_pose=pose_T_RL,
+                                                source_ms=self.stereo_source_ms(augm_data, "_R"))
 
         # synthesize right image from left image
-        pose_T_LR = features["stereo_T_LR"]
-        pose_T_LR = cp.pose_matr2rvec_batch(tf.expand_dims(pose_T_LR, 1))
-        stereo_source = tf.expand_dims(augm_data["target"], 1)
-        synth_stereo["stereo_synth_ms_R"] = SynthesizeMultiScale()(
-                                                source_image=stereo_source,
-                                                intrinsic=features["intrinsic"],
+        pose_T_LR = tf.expand_dims(features["stereo_T_LR"], 1)
+        synth_stereo["stereo_synth_ms_R"] = self.synthesizer(
+                                                source_image=tf.expand_dims(augm_data["target"], 1),
+                                                intrinsic=features["intrinsic_R"],
                                                 pred_depth_ms=predictions["depth_ms_R"],
-                                                pred_pose=pose_T_LR)
+                                                pred_pose=pose_T_LR,
+                                                source_ms=self.stereo_source_ms(augm_data, ""))
         # synth_stereo_xxx: list of [batch, 1, height/scale, width/scale, 3]
         return synth_stereo
 
+    def stereo_source_ms(self, augm_data, suffix):
+        """
+        :return: target pyramid of one side as source pyramid, list of [batch, 1, height/scale, width/scale, 3]
+                 or None if the pyramid was not made
+        """
+        if "target_ms" + suffix not in augm_data:
+            return None
+        return [tf.expand_dims(target_sc, 1) for target_sc in augm_data["target_ms" + suffix]]
+
 
 class LossBase:
     def __call__(self, features, predictions, augm_data):
@@ -149,21 +279,93 @@ class LossBase:
         :return: [batch]
         """
         # [scales, batch] -> transpose: [batch, scales] -> matmul: [batch]
-        loss_batch = layers.Lambda(lambda x: tf.matmul(tf.transpose(x), self.scale_weights), name=name)(losses)
+        with tf.name_scope(name):
+            loss_batch = tf.matmul(tf.transpose(tf.convert_to_tensor(losses)), self.scale_weights)
         return loss_batch
 
 
-class PhotometricLoss(LossBase):
-    def __init__(self, method, scale_weights, key_suffix=""):
+class PhotometricErrorCache:
+    """
+    Per-pixel photometric errors shared by all losses in a step
+    L1, SSIM, md2, cmb and stereo losses read the same synthesized images,
+    so masks, error maps and SSIM statistics of targets are computed once per (key, scale) and reused.
+    Images in augm_data are referenced by keys, so a loss asks for an error map with
+    (method, key of synthesized images, key of target images, scale index).
+    """
+    def __init__(self, augm_data):
+        self.augm_data = augm_data
+        self.errors = dict()
+        self.masks = dict()
+        self.target_stats = dict()
+
+    def error_map(self, method, synth_key, target_key, scale):
+        """
+        :param method: "L1", "L2" or "SSIM"
+        :param synth_key: key of synthesized images in augm_data, list of [batch, numsrc, height/scale, width/scale, 3]
+        :param target_key: key of target images in augm_data, list of [batch, height/scale, width/scale, 3]
+                           or a single target [batch, height, width, 3] for all scales
+        :param scale: scale index
+        :return: masked per-pixel error [batch, numsrc, height/scale, width/scale, 3]
+        """
+        cache_key = (method, synth_key, target_key, scale)
+        if cache_key in self.errors:
+            return self.errors[cache_key]
+
+        synth_target = self.augm_data[synth_key][scale]
+        orig_target = self.get_target(target_key, scale)
+        # boolean mask is captured instead of passed, because recompute_grad differentiates every argument
+        mask = self.get_mask(synth_key, scale)
         if method == "L1":
-            self.photometric_loss = lsu.photometric_loss_l1
+            def compute_error(synth, target):
+                return lsu.mask_photometric_error(lsu.photometric_error_l1(synth, target), mask, reduce=False)
+            error_args = (synth_target, orig_target)
         elif method == "L2":
-            self.photometric_loss = lsu.photometric_loss_l2
+            def compute_error(synth, target):
+                return lsu.mask_photometric_error(lsu.photometric_error_l2(synth, target), mask, reduce=False)
+            error_args = (synth_target, orig_target)
         elif method == "SSIM":
-            self.photometric_loss = lsu.photometric_loss_ssim
+            def compute_error(synth, target, mu_x, sigma_x):
+                photo_error = lsu.photometric_error_ssim(synth, target, (mu_x, sigma_x))
+                return lsu.mask_photometric_error(photo_error, mask, reduce=False)
+            error_args = (synth_target, orig_target) + tuple(self.get_target_stats(target_key, scale))
         else:
             raise WrongInputException("Wrong photometric loss name: " + method)
 
+        # SSIM statistics are recomputed in backward pass if "photo_error" in RECOMPUTE
+        photo_error = recompute("photo_error", compute_error)(*error_args)
+        self.errors[cache_key] = photo_error
+        return photo_error
+
+    def batch_error(self, method, synth_key, target_key, scale):
+        """
+        :return: error averaged per example in float32 [batch]
+        """
+        photo_error = self.error_map(method, synth_key, target_key, scale)
+        return tf.reduce_mean(tf.cast(photo_error, tf.float32), axis=[1, 2, 3, 4])
+
+    def get_target(self, target_key, scale):
+        target = self.augm_data[target_key]
+        return target[scale] if isinstance(target, list) else target
+
+    def get_mask(self, synth_key, scale):
+        if (synth_key, scale) not in self.masks:
+            self.masks[(synth_key, scale)] = lsu.photometric_error_mask(self.augm_data[synth_key][scale])
+        return self.masks[(synth_key, scale)]
+
+    def get_target_stats(self, target_key, scale):
+        # a single target is shared by all scales
+        stats_key = (target_key, scale if isinstance(self.augm_data[target_key], list) else 0)
+        if stats_key not in self.target_stats:
+            self.target_stats[stats_key] = lsu.ssim_target_stats(self.get_target(target_key, scale))
+        return self.target_stats[stats_key]
+
+
+class PhotometricLoss(LossBase):
+    def __init__(self, method, scale_weights, key_suffix=""):
+        if method not in ["L1", "L2", "SSIM"]:
+            raise WrongInputException("Wrong photometric loss name: " + method)
+
+        self.method = method
         self.key_suffix = key_suffix
         self.scale_weights = scale_weights
 
@@ -180,13 +382,13 @@ class PhotometricLossMultiScale(PhotometricLoss):
         desciptions of inputs are available in 'TotalLoss.append_data()'
         :return: photo_loss [batch]
         """
-        original_target_ms = augm_data["target_ms" + self.key_suffix]
-        synth_target_ms = augm_data["synth_target_ms" + self.key_suffix]
+        error_cache = get_error_cache(augm_data)
+        synth_key = "synth_target_ms" + self.key_suffix
+        target_key = "target_ms" + self.key_suffix
 
         losses = []
-        for i, (synt_target, orig_target) in enumerate(zip(synth_target_ms, original_target_ms)):
-            loss = layers.Lambda(lambda inputs: self.photometric_loss(inputs[0], inputs[1]),
-                                 name=f"photo_loss_{i}" + self.key_suffix)([synt_target, orig_target])
+        for i in range(len(augm_data[synth_key])):
+            loss = error_cache.batch_error(self.method, synth_key, target_key, i)
             losses.append(loss)
 
         name = "photo_loss_sum" + self.key_suffix
@@ -206,26 +408,20 @@ class MonoDepth2LossMultiScale(PhotometricLoss):
         desciptions of inputs are available in 'TotalLoss.append_data()'
         :return: photo_loss [batch]
         """
-        synth_target_ms = augm_data["synth_target_ms" + self.key_suffix]
-        original_target = augm_data["target" + self.key_suffix]
-        Ho, Wo = original_target.shape[1:3]
+        error_cache = get_error_cache(augm_data)
+        synth_key = full_res_synth_key(augm_data, self.key_suffix)
+        target_key = "target" + self.key_suffix
 
         losses = []
-        for i, synt_target in enumerate(synth_target_ms):
-            # resize synthesized target to original image size
-            synt_target_rsz = resize_bilinear(synt_target, (Ho, Wo))
-            op_name = f"mono2_loss_{i}" + self.key_suffix
-            # compute L1 loss without reduce_mean -> [batch, numsrc, height, width, channel]
-            loss = layers.Lambda(lambda inputs: self.photometric_loss(inputs[0], inputs[1], False),
-                                 name=op_name)([synt_target_rsz, original_target])
+        for i in range(len(augm_data[synth_key])):
+            # L1 loss without reduce_mean -> [batch, numsrc, height, width, channel]
+            loss = error_cache.error_map(self.method, synth_key, target_key, i)
             # take minimum loss over sources for each pixel -> [batch, height, width, channel]
-            op_name = f"mono2_loss_min_{i}" + self.key_suffix
-            loss = layers.Lambda(lambda x: tf.reduce_min(x, axis=1), name=op_name)(loss)
+            loss = tf.reduce_min(loss, axis=1)
+            # average over image -> [batch]
+            loss = tf.reduce_mean(tf.cast(loss, tf.float32), axis=[1, 2, 3])
             losses.append(loss)
 
-        # average over image [scales, batch, height, width, channel] -> [scales, batch]
-        op_name = "mono2_loss_mean" + self.key_suffix
-        losses = layers.Lambda(lambda x: tf.reduce_mean(x, axis=[2, 3, 4]), name=op_name)(losses)
         op_name = "mono2_loss_sum" + self.key_suffix
         # weighted sum over scales: [scales, batch] -> [batch]
         return self.merge_multi_scale_losses(losses, op_name)
@@ -243,34 +439,27 @@ class CombinedLossMultiScale(PhotometricLoss):
         desciptions of inputs are available in 'TotalLoss.append_data()'
         :return: photo_loss [batch]
         """
-        synth_target_ms = augm_data["synth_target_ms" + self.key_suffix]
-        warped_target_ms = augm_data["warped_target_ms" + self.key_suffix]
-        original_target = augm_data["target" + self.key_suffix]
-        Ho, Wo = original_target.shape[1:3]
+        error_cache = get_error_cache(augm_data)
+        synth_key = full_res_synth_key(augm_data, self.key_suffix)
+        target_key = "target" + self.key_suffix
 
         # compare multi scale static flow with fixed scale optical flow with 1/4 scale
-        warped_target = warped_target_ms[0]
-        warped_target = resize_bilinear(warped_target, (Ho, Wo))
-        op_name = f"comb_flow_loss_{0}" + self.key_suffix
+        warped_key = "warped_target_rsz" + self.key_suffix
+        if warped_key not in augm_data:
+            Ho, Wo = augm_data[target_key].shape[1:3]
+            augm_data[warped_key] = [resize_bilinear(augm_data["warped_target_ms" + self.key_suffix][0], (Ho, Wo))]
         # flow loss: [batch, numsrc, height, width, 3]
-        flow_loss = layers.Lambda(lambda inputs: self.photometric_loss(inputs[0], inputs[1], False),
-                                  name=op_name)([warped_target, original_target])
+        flow_loss = error_cache.error_map(self.method, warped_key, target_key, 0)
 
         losses = []
-        for i, synt_target in enumerate(synth_target_ms):
-            # resize synthesized target to original image size
-            synt_target_rsz = resize_bilinear(synt_target, (Ho, Wo))
-            op_name = f"comb_mono2_loss_{i}" + self.key_suffix
-            # compute L1 loss without reduce_mean -> [batch, numsrc, height, width, 3]
-            static_loss = layers.Lambda(lambda inputs: self.photometric_loss(inputs[0], inputs[1], False),
-                                        name=op_name)([synt_target_rsz, original_target])
-
+        for i in range(len(augm_data[synth_key])):
+            # L1 loss without reduce_mean -> [batch, numsrc, height, width, 3]
+            static_loss = error_cache.error_map(self.method, synth_key, target_key, i)
             # extract static loss lower than optical flow loss
-            mask = tf.cast(static_loss < flow_loss, tf.float32)
+            mask = tf.cast(static_loss < flow_loss, static_loss.dtype)
             static_loss = static_loss * mask
             # reduce mean -> [batch]
-            op_name = f"comb_photo_mean_{i}" + self.key_suffix
-            loss = layers.Lambda(lambda x: tf.reduce_mean(x, axis=[1, 2, 3, 4]), name=op_name)(static_loss)
+            loss = tf.reduce_mean(tf.cast(static_loss, tf.float32), axis=[1, 2, 3, 4])
             losses.append(loss)
 
         op_name = f"comb_photo_sum" + self.key_suffix
@@ -278,9 +467,36 @@ class CombinedLossMultiScale(PhotometricLoss):
         return self.merge_multi_scale_losses(losses, op_name)
 
 
+def get_error_cache(augm_data):
+    """
+    :return: PhotometricErrorCache made by TotalLoss, or a new one if losses are called without TotalLoss
+    """
+    if "photo_error_cache" not in augm_data:
+        augm_data["photo_error_cache"] = PhotometricErrorCache(augm_data)
+    return augm_data["photo_error_cache"]
+
+
+def full_res_synth_key(augm_data, suffix):
+    """
+    :return: key of full resolution synthesized targets of all scales, list of [batch, numsrc, height, width, 3]
+             they are synthesized from upsampled depths if available,
+             otherwise low resolution targets are resized once and shared by losses
+    """
+    if "synth_target_full_ms" + suffix in augm_data:
+        return "synth_target_full_ms" + suffix
+    rsz_key = "synth_target_rsz_ms" + suffix
+    if rsz_key not in augm_data:
+        Ho, Wo = augm_data["target" + suffix].shape[1:3]
+        augm_data[rsz_key] = [resize_bilinear(synt_target, (Ho, Wo))
+                              for synt_target in augm_data["synth_target_ms" + suffix]]
+    return rsz_key
+
+
 def resize_bilinear(srcimg, dst_hw):
     Hd, Wd = dst_hw
     B, N, Hs, Ws, C = srcimg.get_shape()
+    if (Hs, Ws) == (Hd, Wd):
+        return srcimg
     srcimg = tf.reshape(srcimg, (B * N, Hs, Ws, C))
     dstimg = tf.image.resize(srcimg, (Hd, Wd), method="bilinear")
     dstimg = tf.reshape(dstimg, (B, N, Hd, Wd, C))
@@ -303,8 +519,7 @@ class SmoothenessLossMultiScale(LossBase):
         orig_width = target_ms[0].get_shape().as_list()[2]
         for i, (disp, image) in enumerate(zip(pred_disp_ms, target_ms)):
             scale = orig_width / image.get_shape().as_list()[2]
-            loss = layers.Lambda(lambda inputs: self.smootheness_loss(inputs[0], inputs[1]) / scale,
-                                 name=f"smooth_loss_{i}")([disp, image])
+            loss = self.smootheness_loss(disp, image) / scale
             losses.append(loss)
 
         # weighted sum over scales: [scales, batch] -> [batch]
@@ -316,6 +531,10 @@ class SmoothenessLossMultiScale(LossBase):
         :param image: scaled original target image [batch, height/scale, width/scale, 3]
         :return: smootheness loss [batch]
         """
+        # gradients of disparity are small, compute them in float32
+        disp = tf.cast(disp, tf.float32)
+        image = tf.cast(image, tf.float32)
+
         def gradient_x(img):
             gx = img[:, :, :-1, :] - img[:, :, 1:, :]
             return gx
@@ -352,31 +571,28 @@ class StereoDepthLoss(PhotometricLoss):
         desciptions of inputs are available in 'TotalLoss.append_data()'
         :return: photo_loss [batch]
         """
+        error_cache = get_error_cache(augm_data)
         # synthesize left image from right image
-        loss_left = self.stereo_photometric_loss(synth_target_ms=augm_data["stereo_synth_ms"],
-                                                 target_ms=augm_data["target_ms"])
+        loss_left = self.stereo_photometric_loss(error_cache, "stereo_synth_ms", "target_ms")
         # synthesize right image from left image
-        loss_right = self.stereo_photometric_loss(synth_target_ms=augm_data["stereo_synth_ms_R"],
-                                                  target_ms=augm_data["target_ms_R"],
-                                                  suffix="_R")
+        loss_right = self.stereo_photometric_loss(error_cache, "stereo_synth_ms_R", "target_ms_R")
         # [2, scales, batch] -> [scales, batch]
         losses = [loss_left, loss_right]
-        losses = layers.Lambda(lambda x: tf.reduce_sum(x, axis=0), name="st.photo_LR_sum")(losses)
+        losses = tf.reduce_sum(tf.convert_to_tensor(losses), axis=0)
         # weighted sum over scales: [scales, batch] -> [batch]
         return self.merge_multi_scale_losses(losses, "st.photo_loss_sum")
 
-    def stereo_photometric_loss(self, synth_target_ms, target_ms, suffix=""):
+    def stereo_photometric_loss(self, error_cache, synth_key, target_key):
         """
         synthesize image from source to target
-        :param synth_target_ms: list of [batch, height/scale, width/scale, 1]
-        :param target_ms: list of [batch, height/scale, width/scale, 3]
-        :param suffix: "" if right to left, else "_R"
+        :param error_cache: PhotometricErrorCache
+        :param synth_key: key of synthesized images, list of [batch, 1, height/scale, width/scale, 3]
+        :param target_key: key of target images, list of [batch, height/scale, width/scale, 3]
         :return losses [scales, batch]
         """
         losses = []
-        for i, (synth_img_sc, target_img_sc) in enumerate(zip(synth_target_ms, target_ms)):
-            loss = layers.Lambda(lambda inputs: self.photometric_loss(inputs[0], inputs[1]),
-                                 name=f"photo_loss_{i}" + suffix)([synth_img_sc, target_img_sc])
+        for i in range(len(error_cache.augm_data[synth_key])):
+            loss = error_cache.batch_error(self.method, synth_key, target_key, i)
             losses.append(loss)
         return losses
 
@@ -400,23 +616,21 @@ class StereoPoseLoss(LossBase):
 class FlowWarpLossMultiScale(PhotometricLoss):
     def __init__(self, method, scale_weights, key_suffix=""):
         super().__init__(method, scale_weights, key_suffix)
-        self.scale_wegihts = ()
 
     def __call__(self, features, predictions, augm_data):
         """
         desciptions of inputs are available in 'TotalLoss.append_data()'
         :return: photo_loss [batch]
         """
-        flow_target_ms = augm_data["flow_target_ms" + self.key_suffix]
+        error_cache = get_error_cache(augm_data)
         # warp a target from 4 sources and 4 flows in 4 level scales
-        warped_target_ms = augm_data["warped_target_ms" + self.key_suffix]
+        warped_key = "warped_target_ms" + self.key_suffix
+        target_key = "flow_target_ms" + self.key_suffix
 
         losses = []
-        for i, (warp_target, orig_target) in enumerate(zip(warped_target_ms, flow_target_ms)):
-            loss = layers.Lambda(lambda inputs: self.photometric_loss(inputs[0], inputs[1]),
-                                 name=f"flow_warp_loss_{i}" + self.key_suffix)([warp_target, orig_target])
+        for i in range(len(augm_data[warped_key])):
+            loss = error_cache.batch_error(self.method, warped_key, target_key, i)
             losses.append(loss)
-        # losses: [loss at each scale] -> sum: scalar
         name = "flow_warp_loss_sum" + self.key_suffix
         # weighted sum over scales: [scales, batch] -> [batch]
         return self.merge_multi_scale_losses(losses, name)
@@ -495,6 +709,31 @@ def train_model(model, optimizer, xi, yi):
     optimizer.apply_gradients(zip(grad, model.trainable_weights))
 
 
+def test_photometric_loss_precision():
+    """
+    compare photometric losses and memory of synthesized images between float32 and 16-bit images
+    """
+    print("\n===== start test_photometric_loss_precision")
+    batch, numsrc, height, width = (4, 4, 128, 384)
+    target = tf.random.uniform((batch, height, width, 3), -1., 1.)
+    # synthesized image = target + small error
+    synth = tf.expand_dims(target, 1) + tf.random.normal((batch, numsrc, height, width, 3), stddev=0.05)
+    for dtype in [tf.float16, tf.bfloat16]:
+        for name, loss_func in [("L1", lsu.photometric_loss_l1), ("SSIM", lsu.photometric_loss_ssim)]:
+            loss32 = loss_func(synth, target).numpy()
+            loss16 = loss_func(tf.cast(synth, dtype), tf.cast(target, dtype))
+            assert loss16.dtype == tf.float32
+            rel_diff = np.max(np.abs(loss16.numpy() - loss32) / loss32)
+            print(f"[{dtype.name}] {name} loss relative difference: {rel_diff:.5f}")
+            assert rel_diff < 0.02
+        # synthesized images of 4 scales (1, 1/2, 1/4, 1/8)
+        synth_bytes = sum([batch * numsrc * height * width * 3 / 4**sc for sc in range(4)])
+        print(f"[{dtype.name}] synthesized images per side: {synth_bytes * 4 / 2**20:.1f}MB in float32, "
+              f"{synth_bytes * dtype.size / 2**20:.1f}MB in {dtype.name}")
+    print("!!! test_photometric_loss_precision passed")
+
+
 if __name__ == "__main__":
     test_average_pool_3d()
     test_gradient_tape()
+    test_photometric_loss_precision()
@@ -0,0 +1,156 @@
+"""
+SSIM with separable 3x3 box filters
+Local means are computed by two depthwise convolutions (1x3 and 3x1) on a [batch*numsrc, height, width, channel] view.
+Zero padded sums are divided by the number of valid pixels to match AveragePooling3D(padding="SAME").
+Statistics of the target are computed once and broadcast over sources.
+"""
+import numpy as np
+import tensorflow as tf
+from timeit import default_timer as timer
+
+from model.synthesize import synth_consts
+
+C1 = 0.01 ** 2
+C2 = 0.03 ** 2
+
+
+def ssim_error(synt_target, orig_target, target_stats=None):
+    """
+    :param synt_target: [batch, numsrc, height, width, channel]
+    :param orig_target: [batch, height, width, channel]
+    :param target_stats: (optional) precomputed target_statistics(orig_target)
+    :return: (1 - SSIM) / 2 in float32 [batch, numsrc, height, width, channel]
+    """
+    batch, numsrc, height, width, channel = synt_target.get_shape()
+    # variances (E[x^2] - E[x]^2) and c1, c2 vanish in float16
+    x = tf.cast(tf.expand_dims(orig_target, axis=1), tf.float32)    # [batch, 1, height, width, channel]
+    y = tf.cast(synt_target, tf.float32)                            # [batch, numsrc, height, width, channel]
+    # mu_x, sigma_x: [batch, 1, height, width, channel]
+    mu_x, sigma_x = target_stats if target_stats is not None else target_statistics(orig_target)
+
+    # filter y, y^2, x*y at once: [batch*numsrc, height, width, channel*3]
+    stacked = tf.concat([y, y * y, x * y], axis=-1)
+    stacked = tf.reshape(stacked, (batch * numsrc, height, width, channel * 3))
+    stacked = box_filter(stacked)
+    stacked = tf.reshape(stacked, (batch, numsrc, height, width, channel * 3))
+    mu_y, mean_yy, mean_xy = tf.split(stacked, 3, axis=-1)
+    sigma_y = mean_yy - mu_y ** 2
+    sigma_xy = mean_xy - mu_x * mu_y
+
+    ssim_n = (2 * mu_x * mu_y + C1) * (2 * sigma_xy + C2)
+    ssim_d = (mu_x ** 2 + mu_y ** 2 + C1) * (sigma_x + sigma_y + C2)
+    ssim = ssim_n / ssim_d
+    return tf.clip_by_value((1 - ssim) / 2, 0, 1)
+
+
+def target_statistics(orig_target):
+    """
+    :param orig_target: [batch, height, width, channel]
+    :return: local mean and variance of target, [batch, 1, height, width, channel] each
+    """
+    x = tf.cast(orig_target, tf.float32)
+    stacked = box_filter(tf.concat([x, x * x], axis=-1))
+    mu_x, mean_xx = tf.split(stacked, 2, axis=-1)
+    sigma_x = mean_xx - mu_x ** 2
+    return tf.expand_dims(mu_x, axis=1), tf.expand_dims(sigma_x, axis=1)
+
+
+def box_filter(image):
+    """
+    :param image: [batch, height, width, channel] in float32
+    :return: 3x3 local mean over valid pixels (SAME padding) [batch, height, width, channel]
+    """
+    _, height, width, channel = image.get_shape()
+    kernel_h = synth_consts.get_constant(("box_kernel", 1, 3, channel),
+                                         lambda: np.ones((1, 3, channel, 1), dtype=np.float32))
+    kernel_v = synth_consts.get_constant(("box_kernel", 3, 1, channel),
+                                         lambda: np.ones((3, 1, channel, 1), dtype=np.float32))
+    local_sum = tf.nn.depthwise_conv2d(image, kernel_h, strides=[1, 1, 1, 1], padding="SAME")
+    local_sum = tf.nn.depthwise_conv2d(local_sum, kernel_v, strides=[1, 1, 1, 1], padding="SAME")
+    return local_sum * inverse_count_map(height, width)
+
+
+def inverse_count_map(height, width):
+    """
+    :return: 1 / (number of valid pixels in 3x3 window) [1, height, width, 1]
+    """
+    def build():
+        # a pixel itself + its previous pixel (if exists) + its next pixel (if exists)
+        count_v = 1. + (np.arange(height) > 0) + (np.arange(height) < height - 1)
+        count_u = 1. + (np.arange(width) > 0) + (np.arange(width) < width - 1)
+        count = np.outer(count_v, count_u).astype(np.float32)
+        return (1. / count).reshape((1, height, width, 1))
+    return synth_consts.get_constant(("box_inverse_count", height, width), build)
+
+
+# ======================================================================
+
+def ssim_error_pool3d(synt_target, orig_target):
+    """
+    previous implementation with AveragePooling3D and tiled target, kept as a reference for tests
+    """
+    numsrc = synt_target.get_shape()[1]
+    x = tf.tile(tf.expand_dims(orig_target, axis=1), [1, numsrc, 1, 1, 1])
+    y = synt_target
+    average_pool = tf.keras.layers.AveragePooling3D(pool_size=[1, 3, 3], strides=1, padding="SAME")
+    mu_x = average_pool(x)
+    mu_y = average_pool(y)
+    sigma_x = average_pool(x ** 2) - mu_x ** 2
+    sigma_y = average_pool(y ** 2) - mu_y ** 2
+    sigma_xy = average_pool(x * y) - mu_x * mu_y
+    ssim_n = (2 * mu_x * mu_y + C1) * (2 * sigma_xy + C2)
+    ssim_d = (mu_x ** 2 + mu_y ** 2 + C1) * (sigma_x + sigma_y + C2)
+    ssim = ssim_n / ssim_d
+    return tf.clip_by_value((1 - ssim) / 2, 0, 1)
+
+
+def make_ssim_inputs(batch=4, numsrc=4, height=128, width=384):
+    target = tf.random.uniform((batch, height, width, 3), -1., 1.)
+    synth = tf.expand_dims(target, 1) + tf.random.normal((batch, numsrc, height, width, 3), stddev=0.1)
+    return synth, target
+
+
+def test_ssim_equivalence():
+    print("\n===== start test_ssim_equivalence")
+    for shape in [(2, 4, 5, 7), (4, 4, 128, 384)]:
+        synth, target = make_ssim_inputs(*shape)
+        # EXECUTE
+        ssim_sep = ssim_error(synth, target)
+        ssim_pool = ssim_error_pool3d(synth, target)
+        max_diff = np.max(np.abs(ssim_sep.numpy() - ssim_pool.numpy()))
+        print(f"shape={shape}, max abs diff={max_diff:.7f}")
+        assert np.allclose(ssim_sep.numpy(), ssim_pool.numpy(), atol=1e-5)
+    print("!!! test_ssim_equivalence passed")
+
+
+def test_ssim_speed(steps=20):
+    print("\n===== start test_ssim_speed")
+    synth, target = make_ssim_inputs()
+
+    @tf.function
+    def run_pool3d(y, x):
+        with tf.GradientTape() as tape:
+            tape.watch(y)
+            loss = tf.reduce_mean(ssim_error_pool3d(y, x))
+        return tape.gradient(loss, y)
+
+    @tf.function
+    def run_separable(y, x):
+        with tf.GradientTape() as tape:
+            tape.watch(y)
+            loss = tf.reduce_mean(ssim_error(y, x))
+        return tape.gradient(loss, y)
+
+    for name, func in [("pool3d", run_pool3d), ("separable", run_separable)]:
+        func(synth, target)
+        start = timer()
+        for _ in range(steps):
+            grad = func(synth, target)
+        grad.numpy()
+        print(f"[test_ssim_speed] {name}: {(timer() - start) / steps * 1000.:.2f} ms/step (forward and backward)")
+    print("!!! test_ssim_speed passed")
+
+
+if __name__ == "__main__":
+    test_ssim_equivalence()
+    test_ssim_speed()
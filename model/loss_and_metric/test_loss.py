@@ -3,6 +3,7 @@ import numpy as np
 import cv2
 import tensorflow as tf
 from tensorflow.keras import layers
+from timeit import default_timer as timer
 
 import settings
 from config import opts
@@ -11,6 +12,7 @@ import utils.convert_pose as cp
 from tfrecords.tfrecord_reader import TfrecordReader
 from model.synthesize.synthesize_base import SynthesizeMultiScale
 import model.loss_and_metric.losses as ls
+import model.loss_and_metric.loss_util as lsu
 
 WAIT_KEY = 0
 
@@ -313,7 +315,188 @@ def tu_show_synthesize_result(synth_target_ms, target, source, suffix):
     return view
 
 
+def test_full_res_synthesis_loss():
+    """
+    MonoDepth2 loss with full resolution synthesis from upsampled depths must skip low resolution synthesis,
+    and in a static scene it must reconstruct the target from full resolution sources at every scale,
+    while low resolution reconstructions lose details of the target
+    """
+    print("\n===== start test_full_res_synthesis_loss")
+    batch, numsrc, height, width = (2, 4, 64, 192)
+    # static scene: all frames are the same image and poses are zero
+    image = tf.random.uniform((batch, 1, height, width, 3), -1., 1.)
+    image5d = tf.tile(image, (1, numsrc + 1, 1, 1, 1))
+    intrinsic = np.array([[width/2, 0, width/2], [0, width/2, height/2], [0, 0, 1]], dtype=np.float32)
+    features = {"image5d": image5d, "intrinsic": tf.constant(np.tile(intrinsic[np.newaxis], (batch, 1, 1)))}
+    depth = tf.random.uniform((batch, height, width, 1), 5., 20.)
+    pose = tf.zeros((batch, numsrc, 6))
+    predictions = {"depth_ms": uf.multi_scale_depths(depth, [1, 2, 4, 8]), "pose": pose}
+    scale_weights = tf.constant([[1.], [1.], [1.], [1.]])
+    loss_objects = {"md2L1": ls.MonoDepth2LossMultiScale("L1", scale_weights)}
+
+    results = dict()
+    for full_res in [False, True]:
+        total_loss = ls.TotalLoss(loss_objects, {"md2L1": 1.}, batch_size=batch, full_res_synth=full_res)
+        augm_data = total_loss.append_data(features, predictions)
+        assert ("synth_target_ms" in augm_data) == (not full_res)
+        assert ("synth_target_full_ms" in augm_data) == full_res
+        # EXECUTE
+        results[full_res], _ = total_loss(predictions, features)
+        print(f"full_res_synth={full_res}, loss={results[full_res].numpy():.5f}")
+
+    assert results[True].numpy() < 0.01
+    assert results[False].numpy() > 10 * results[True].numpy()
+    print("!!! test_full_res_synthesis_loss passed")
+
+
+def test_photometric_error_cache():
+    """
+    losses reduced from PhotometricErrorCache must be equal to losses computed independently,
+    and error maps must be computed once for L1, SSIM and md2 losses of the same images
+    """
+    print("\n===== start test_photometric_error_cache")
+    batch, numsrc, height, width = (2, 4, 64, 192)
+    target = tf.random.uniform((batch, height, width, 3), -1., 1.)
+    target_ms = [tf.image.resize(target, (height // sc, width // sc)) for sc in [1, 2, 4, 8]]
+    synth_target_ms = [tf.expand_dims(tgt, 1) + tf.random.normal((batch, numsrc) + tuple(tgt.shape[1:]), stddev=0.1)
+                       for tgt in target_ms]
+    augm_data = {"target": target, "target_ms": target_ms, "synth_target_ms": synth_target_ms}
+    scale_weights = tf.constant([[1.], [1.], [1.], [1.]])
+
+    for method, loss_func in [("L1", lsu.photometric_loss_l1), ("SSIM", lsu.photometric_loss_ssim)]:
+        # EXECUTE
+        loss_cached = ls.PhotometricLossMultiScale(method, scale_weights)(None, None, augm_data)
+        ls.MonoDepth2LossMultiScale(method, scale_weights)(None, None, augm_data)
+        loss_direct = tf.add_n([loss_func(synth, tgt) for synth, tgt in zip(synth_target_ms, target_ms)])
+        print(f"{method} loss cached: {loss_cached.numpy()[:, 0]}, direct: {loss_direct.numpy()}")
+        assert np.allclose(loss_cached.numpy()[:, 0], loss_direct.numpy(), atol=1e-5)
+
+    error_cache = augm_data["photo_error_cache"]
+    # 2 methods x (4 scales of low resolution + 4 scales of full resolution)
+    assert len(error_cache.errors) == 16
+    # masks of (low resolution + resized) synthesized images
+    assert len(error_cache.masks) == 8
+    print("!!! test_photometric_error_cache passed")
+
+
+def test_packed_rig_synthesis():
+    """
+    packed synthesis of both cameras (synthesize_rig) must equal separate synthesis of each side,
+    left and right intrinsics differ so that the intrinsic of each side is checked
+    """
+    print("\n===== start test_packed_rig_synthesis")
+    batch, snippet, height, width = (2, 5, 64, 192)
+    intrinsic = np.array([[100., 0., 96.], [0., 100., 32.], [0., 0., 1.]], dtype=np.float32)
+    intrinsic_R = intrinsic.copy()
+    intrinsic_R[0, 2] += 4.
+    stereo_T_LR = np.tile(np.identity(4, dtype=np.float32), (batch, 1, 1))
+    stereo_T_LR[:, 0, 3] = -0.5
+    features = {"stereo_T_LR": tf.constant(stereo_T_LR),
+                "intrinsic": tf.constant(np.tile(intrinsic, (batch, 1, 1))),
+                "intrinsic_R": tf.constant(np.tile(intrinsic_R, (batch, 1, 1)))}
+    predictions = dict()
+    for suffix in ["", "_R"]:
+        features["image5d" + suffix] = tf.random.uniform((batch, snippet, height, width, 3), -1., 1.)
+        features["image" + suffix] = tf.reshape(features["image5d" + suffix], (batch, snippet * height, width, 3))
+        depth = tf.random.uniform((batch, height, width, 1), 5., 20.)
+        predictions["depth_ms" + suffix] = uf.multi_scale_depths(depth, [1, 2, 4, 8])
+        predictions["pose" + suffix] = tf.random.uniform((batch, snippet - 1, 6), -0.05, 0.05)
+    total_loss = ls.TotalLoss(stereo=True, batch_size=batch)
+
+    # EXECUTE
+    augm_packed = total_loss.append_data_rig(features, predictions)
+    augm_separate = total_loss.append_data(features, predictions)
+    augm_separate.update(total_loss.append_data(features, predictions, "_R"))
+    augm_separate.update(total_loss.synethesize_stereo(features, predictions, augm_separate))
+
+    for key in ["synth_target_ms", "synth_target_ms_R", "stereo_synth_ms", "stereo_synth_ms_R"]:
+        for packed, separate in zip(augm_packed[key], augm_separate[key]):
+            assert np.allclose(packed.numpy(), separate.numpy(), atol=1e-4), key
+    print("!!! test_packed_rig_synthesis passed")
+
+
+def test_traced_loss(steps=10):
+    """
+    traced loss must give the same values as eager loss and must be traced only once
+    """
+    print("\n===== start test_traced_loss")
+    batch, numsrc, height, width = (2, 4, 64, 192)
+    image5d = tf.random.uniform((batch, numsrc + 1, height, width, 3), -1., 1.)
+    intrinsic = np.array([[width/2, 0, width/2], [0, width/2, height/2], [0, 0, 1]], dtype=np.float32)
+    features = {"image5d": image5d, "intrinsic": tf.constant(np.tile(intrinsic[np.newaxis], (batch, 1, 1)))}
+    depth = tf.random.uniform((batch, height, width, 1), 5., 20.)
+    pose = tf.random.uniform((batch, numsrc, 6), -0.05, 0.05)
+    predictions = {"depth_ms": uf.multi_scale_depths(depth, [1, 2, 4, 8]), "pose": pose,
+                   "disp_ms": uf.multi_scale_depths(1. / depth, [1, 2, 4, 8])}
+    scale_weights = tf.constant([[1.], [1.], [1.], [1.]])
+    loss_objects = {"L1": ls.PhotometricLossMultiScale("L1", scale_weights),
+                    "SSIM": ls.PhotometricLossMultiScale("SSIM", scale_weights),
+                    "smoothe": ls.SmoothenessLossMultiScale(scale_weights)}
+    loss_weights = {"L1": 0.5, "SSIM": 0.5, "smoothe": 1.}
+
+    results = dict()
+    for trace in [False, True]:
+        total_loss = ls.TotalLoss(loss_objects, loss_weights, batch_size=batch, trace=trace)
+        start = timer()
+        results[trace] = total_loss(predictions, features)
+        first_time = timer() - start
+        start = timer()
+        for _ in range(steps):
+            loss, _ = total_loss(predictions, features)
+        loss.numpy()
+        print(f"trace={trace}: first call {first_time * 1000.:.1f} ms, "
+              f"next calls {(timer() - start) / steps * 1000.:.2f} ms/step, trace count={total_loss.trace_count}")
+        if trace:
+            assert total_loss.trace_count == 1
+
+    assert np.isclose(results[False][0].numpy(), results[True][0].numpy(), rtol=1e-5)
+    for name in loss_objects:
+        assert np.isclose(results[False][1][name].numpy(), results[True][1][name].numpy(), rtol=1e-5)
+    print("!!! test_traced_loss passed")
+
+
+def test_recompute_loss():
+    """
+    gradients of loss must be the same when synthesis and photometric errors are recomputed
+    """
+    print("\n===== start test_recompute_loss")
+    batch, numsrc, height, width = (2, 4, 64, 192)
+    image5d = tf.random.uniform((batch, numsrc + 1, height, width, 3), -1., 1.)
+    intrinsic = np.array([[width/2, 0, width/2], [0, width/2, height/2], [0, 0, 1]], dtype=np.float32)
+    features = {"image5d": image5d, "intrinsic": tf.constant(np.tile(intrinsic[np.newaxis], (batch, 1, 1)))}
+    depth = tf.Variable(tf.random.uniform((batch, height, width, 1), 5., 20.))
+    pose = tf.Variable(tf.random.uniform((batch, numsrc, 6), -0.05, 0.05))
+    scale_weights = tf.constant([[1.], [1.], [1.], [1.]])
+    loss_objects = {"L1": ls.PhotometricLossMultiScale("L1", scale_weights),
+                    "SSIM": ls.PhotometricLossMultiScale("SSIM", scale_weights),
+                    "md2SSIM": ls.MonoDepth2LossMultiScale("SSIM", scale_weights)}
+    loss_weights = {"L1": 0.5, "SSIM": 0.5, "md2SSIM": 1.}
+
+    grads = []
+    recompute_stages = opts.RECOMPUTE
+    try:
+        for stages in [[], ["synthesis", "photo_error"]]:
+            opts.RECOMPUTE = stages
+            total_loss = ls.TotalLoss(loss_objects, loss_weights, batch_size=batch)
+            with tf.GradientTape() as tape:
+                predictions = {"depth_ms": uf.multi_scale_depths(depth, [1, 2, 4, 8]), "pose": pose,
+                               "disp_ms": uf.multi_scale_depths(1. / depth, [1, 2, 4, 8])}
+                loss, _ = total_loss(predictions, features)
+            grads.append([grad.numpy() for grad in tape.gradient(loss, [depth, pose])])
+            print(f"RECOMPUTE={stages}, loss={loss.numpy():.5f}")
+    finally:
+        opts.RECOMPUTE = recompute_stages
+    for stored, recomputed in zip(grads[0], grads[1]):
+        assert np.allclose(stored, recomputed, rtol=1e-4, atol=1e-6)
+    print("!!! test_recompute_loss passed")
+
+
 def test():
+    # test_packed_rig_synthesis()
+    # test_traced_loss()
+    # test_recompute_loss()
+    # test_photometric_error_cache()
+    # test_full_res_synthesis_loss()
     # test_photometric_loss_quality("_R")
     # test_photometric_loss_quantity("_R")
     # test_smootheness_loss_quantity()
@@ -0,0 +1,156 @@
+"""
+Training metrics computed by TF ops inside the step function
+They reproduce merge_results() in train_val.py (PoseMetricTf, valid_depth_filter and center depths)
+without converting tensors to numpy, so the step loop does not wait for the device every step.
+"""
+import numpy as np
+import tensorflow as tf
+
+from config import opts
+import utils.convert_pose as cp
+import evaluate.eval_utils as eu
+
+
+def compute_batch_metrics(features, preds, loss, loss_by_type):
+    """
+    :return: {"loss", "trjabs", "trjrel", "roterr", "deprel", "gtdepth", "prdepth", loss names}
+             scalar float32 tensors
+    """
+    metrics = {"loss": tf.cast(loss, tf.float32)}
+    if "pose" in preds:
+        if "pose_gt" in features:
+            metrics["trjabs"], metrics["trjrel"], metrics["roterr"] = pose_errors(preds["pose"], features["pose_gt"])
+        else:
+            metrics["trjabs"] = metrics["trjrel"] = metrics["roterr"] = tf.constant(0.)
+    if "depth_ms" in preds:
+        depth_pred = preds["depth_ms"][0]
+        depth_true = features["depth_gt"] if "depth_gt" in features else None
+        metrics["deprel"] = depth_abs_rel(depth_pred, depth_true) if depth_true is not None else tf.constant(0.)
+        # compare center depths of the first sample
+        gtdepth, prdepth = center_depths(depth_pred, depth_true)
+        metrics["gtdepth"] = gtdepth[0]
+        metrics["prdepth"] = prdepth[0]
+    for key, loss_val in loss_by_type.items():
+        metrics[key] = tf.cast(loss_val, tf.float32)
+    return metrics
+
+
+def pose_errors(pose_pred, pose_true_mat):
+    """
+    :param pose_pred: 6-DoF poses [batch, numsrc, 6]
+    :param pose_true_mat: 4x4 transformation matrix [batch, numsrc, 4, 4]
+    :return: mean of trajectory errors in absolute and relative scale and rotational error
+    """
+    pose_pred_mat = snippet_pose_from_first(cp.pose_rvec2matr_batch_tf(pose_pred))
+    pose_true_mat = snippet_pose_from_first(tf.cast(pose_true_mat, tf.float32))
+    xyz_pred = pose_pred_mat[:, :, :3, 3]
+    xyz_true = pose_true_mat[:, :, :3, 3]
+    trj_abs_err = tf.norm(xyz_true - xyz_pred, axis=2)[:, 1:]
+    # the first frame is origin, so its scale is undefined
+    scale = tf.math.divide_no_nan(tf.reduce_sum(xyz_true * xyz_pred, axis=2), tf.reduce_sum(xyz_pred ** 2, axis=2))
+    trj_rel_err = tf.norm(xyz_true - xyz_pred * scale[..., tf.newaxis], axis=2)[:, 1:]
+
+    rot_rela = tf.matmul(tf.linalg.inv(pose_pred_mat[:, :, :3, :3]), pose_true_mat[:, :, :3, :3])
+    angle = tf.clip_by_value((tf.linalg.trace(rot_rela) - 1.) / 2., -1., 1.)
+    rot_err = tf.acos(angle)[:, 1:]
+    return tf.reduce_mean(trj_abs_err), tf.reduce_mean(trj_rel_err), tf.reduce_mean(rot_err)
+
+
+def snippet_pose_from_first(poses):
+    """
+    :param poses: 4x4 transformation matrices, [batch, numsrc, 4, 4]
+    :return: 4x4 transformation matrices with origin of the first frame, [batch, snippet, 4, 4]
+    """
+    batch = poses.get_shape()[0]
+    target_pose = tf.eye(4, batch_shape=[batch, 1], dtype=poses.dtype)
+    poses_mat = tf.concat([poses[:, :2], target_pose, poses[:, 2:]], axis=1)
+    return tf.matmul(tf.linalg.inv(poses_mat[:, 0:1]), poses_mat)
+
+
+def depth_abs_rel(depth_pred, depth_true):
+    """
+    median-scaled abs rel error within valid range and Garg crop, same as valid_depth_filter() in eval_utils.py
+    :param depth_pred: [batch, height, width, 1]
+    :param depth_true: [batch, height, width, 1]
+    :return: mean abs rel error over batch
+    """
+    batch, height, width, _ = depth_true.get_shape()
+    depth_pred = tf.reshape(tf.cast(depth_pred, tf.float32), (batch, -1))
+    depth_true = tf.reshape(tf.cast(depth_true, tf.float32), (batch, -1))
+    crop = np.array([0.40810811 * height, 0.99189189 * height,
+                     0.03594771 * width, 0.96405229 * width]).astype(np.int32)
+    crop_mask = np.zeros((height, width), dtype=bool)
+    crop_mask[crop[0]:crop[1], crop[2]:crop[3]] = True
+    mask = tf.logical_and(depth_true > opts.MIN_DEPTH, depth_true < opts.MAX_DEPTH)
+    mask = tf.logical_and(mask, crop_mask.reshape((1, -1)))
+    # scale matching
+    scaler = masked_median(depth_true, mask) / masked_median(depth_pred, mask)
+    depth_pred = tf.clip_by_value(depth_pred * scaler[:, tf.newaxis], opts.MIN_DEPTH, opts.MAX_DEPTH)
+    mask = tf.cast(mask, tf.float32)
+    abs_rel = tf.math.divide_no_nan(tf.abs(depth_true - depth_pred), depth_true) * mask
+    abs_rel = tf.reduce_sum(abs_rel, axis=1) / tf.maximum(tf.reduce_sum(mask, axis=1), 1.)
+    return tf.reduce_mean(abs_rel)
+
+
+def masked_median(values, mask):
+    """
+    :param values: [batch, N]
+    :param mask: [batch, N] in bool
+    :return: median of masked values like np.median [batch]
+    """
+    # invalid values are sorted behind valid ones
+    values = tf.sort(tf.where(mask, values, tf.fill(tf.shape(values), np.inf)), axis=1)
+    count = tf.reduce_sum(tf.cast(mask, tf.int32), axis=1)
+    lower = tf.gather(values, tf.maximum((count - 1) // 2, 0), batch_dims=1)
+    upper = tf.gather(values, tf.maximum(count // 2, 0), batch_dims=1)
+    return (lower + upper) / 2.
+
+
+def center_depths(depth_pred, depth_true=None):
+    """
+    :return: mean of true depths and predicted depths in a window below the image center [batch]
+    """
+    batch, height, width, _ = depth_pred.get_shape()
+    xs, xe = width // 2 - 10, width // 2 + 10
+    ys, ye = height // 4 * 3 - 10, height // 4 * 3 + 10
+    mean_pred = tf.reduce_mean(tf.cast(depth_pred[:, ys:ye, xs:xe, :], tf.float32), axis=[1, 2, 3])
+    if depth_true is None:
+        return tf.ones_like(mean_pred), mean_pred
+    depth_true = tf.cast(depth_true[:, ys:ye, xs:xe, :], tf.float32)
+    valid = tf.cast(depth_true > 0, tf.float32)
+    mean_true = tf.reduce_sum(depth_true * valid, axis=[1, 2, 3]) / tf.reduce_sum(valid, axis=[1, 2, 3])
+    return mean_true, mean_pred
+
+
+# ======================================================================
+
+def test_train_metrics():
+    """
+    metrics by TF ops must be equal to the numpy metrics of train_val.merge_results()
+    """
+    print("\n===== start test_train_metrics")
+    batch, numsrc, height, width = (4, 4, 128, 384)
+    pose_pred = tf.random.uniform((batch, numsrc, 6), -0.1, 0.1)
+    pose_true = cp.pose_rvec2matr_batch_tf(pose_pred + tf.random.normal((batch, numsrc, 6), stddev=0.01))
+    depth_true = tf.random.uniform((batch, height, width, 1), 0., 90.)
+    depth_pred = depth_true * tf.random.uniform((batch, height, width, 1), 0.5, 1.5)
+
+    pose_eval = eu.PoseMetricTf()
+    pose_eval.compute_pose_errors(pose_pred, pose_true)
+    pose_np = pose_eval.get_mean_pose_error()
+    pose_tf = pose_errors(pose_pred, pose_true)
+    print("pose errors numpy:", pose_np, "tf:", [err.numpy() for err in pose_tf])
+    assert np.allclose(pose_np, [err.numpy() for err in pose_tf], rtol=1e-3, atol=1e-6)
+
+    abs_rels = []
+    for depth_pr, depth_gt in zip(depth_pred.numpy()[..., 0], depth_true.numpy()[..., 0]):
+        depth_pr_val, depth_gt_val = eu.valid_depth_filter(depth_pr, depth_gt)
+        abs_rels.append(np.mean(np.abs(depth_gt_val - depth_pr_val) / depth_gt_val))
+    abs_rel_tf = depth_abs_rel(depth_pred, depth_true).numpy()
+    print("depth abs rel numpy:", np.mean(abs_rels), "tf:", abs_rel_tf)
+    assert np.isclose(np.mean(abs_rels), abs_rel_tf, rtol=1e-4)
+    print("!!! test_train_metrics passed")
+
+
+if __name__ == "__main__":
+    test_train_metrics()
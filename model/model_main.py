@@ -5,66 +5,155 @@ import numpy as np
 
 import settings
 from config import opts
-from tfrecords.tfrecord_reader import TfrecordReader
+from tfrecords.tfrecord_reader import TfrecordReader, feature_signature
 import utils.util_funcs as uf
 from model.build_model.model_factory import ModelFactory
 from model.model_util.augmentation import augmentation_factory
-from model.loss_and_metric.loss_factory import loss_factory
-from model.model_util.optimizers import optimizer_factory
+from model.loss_and_metric.loss_factory import loss_factory, select_loss_weights, update_loss_weights
+from model.model_util.optimizers import optimizer_factory, set_precision_policy, set_learning_rate
+from model.model_util.checkpointer import create_checkpointer, has_training_checkpoint, read_checkpoint_position
 import model.model_util.logger as log
-from model.model_util.distributer import StrategyScope, StrategyDataset
+from model.model_util.distributer import DistributionStrategy, StrategyScope, StrategyDataset, is_distributed
 import model.train_val as tv
 
 
 def train_by_plan(plan):
+    # gpu options must be set before devices are initialized by distribution strategy
+    set_gpu_configs()
+    if opts.TRAIN_MODE == "multi_worker":
+        # multi-worker strategy must be created before any other op
+        DistributionStrategy.get_strategy()
     target_epoch = 0
+    # training parts of the previous plan stage, reused by the next stage if possible
+    stage = None
     for net_names, dataset_name, epoch, learning_rate, loss_weights, scale_weights, save_ckpt in plan:
         target_epoch += epoch
-        train(net_names, dataset_name, target_epoch, learning_rate, loss_weights, scale_weights, save_ckpt)
+        stage = train(net_names, dataset_name, target_epoch, learning_rate, loss_weights, scale_weights, save_ckpt,
+                      stage)
 
 
-def train(net_names, dataset_name, target_epoch, learning_rate, loss_weights, scale_weights, save_ckpt):
-    initial_epoch = uf.read_previous_epoch(opts.CKPT_NAME)
+def train(net_names, dataset_name, target_epoch, learning_rate, loss_weights, scale_weights, save_ckpt,
+          prev_stage=None):
+    """
+    :param prev_stage: training stage returned by train() of the previous plan stage
+    :return: training stage of this plan stage, see get_training_stage()
+    """
+    initial_epoch, initial_step = read_training_position()
     if target_epoch <= initial_epoch:
         print(f"!! target_epoch {target_epoch} <= initial_epoch {initial_epoch}, no need to train")
-        return
+        return prev_stage
 
     set_configs()
-    log.copy_or_check_same()
-    dataset_train, tfr_config, train_steps = get_dataset(dataset_name, "train", True)
+    # only chief writes checkpoints and logs in multi_worker mode
+    is_chief = DistributionStrategy.is_chief()
+    if is_chief:
+        log.copy_or_check_same()
+    _, tfr_config, train_steps = get_dataset(dataset_name, "train", True)
     dataset_val, _, val_steps = get_dataset(dataset_name, "val", False)
-    model, augmenter, loss_object, optimizer = \
-        create_training_parts(initial_epoch, tfr_config, learning_rate, loss_weights, scale_weights, net_names)
-    trainer, validater = tv.train_val_factory(opts.TRAIN_MODE, model, loss_object,
-                                              train_steps, opts.STEREO, augmenter, optimizer)
+    stage = get_training_stage(prev_stage, initial_epoch, tfr_config, train_steps, learning_rate,
+                               loss_weights, scale_weights, net_names)
+    model, trainer, validater = stage["model"], stage["trainer"], stage["validater"]
+    checkpointer = trainer.checkpointer
 
     print(f"\n\n========== START TRAINING ON {opts.CKPT_NAME} ==========")
     for epoch in range(initial_epoch, target_epoch):
         print(f"========== Start epoch: {epoch}/{target_epoch} ==========")
-        result_train = trainer.run_an_epoch(dataset_train)
-        result_val = validater.run_an_epoch(dataset_val)
+        start_step = initial_step if epoch == initial_epoch else 0
+        epoch_seed = checkpointer.begin_epoch(epoch, start_step)
+        # records of the epoch are in the order of epoch_seed, so a resumed epoch skips the trained batches
+        dataset_train, _, _ = get_dataset(dataset_name, "train", True, shuffle_seed=epoch_seed,
+                                          skip_batches=start_step)
+        result_train = trainer.run_an_epoch(dataset_train, epoch, start_step)
+        result_val = validater.run_an_epoch(dataset_val, epoch)
+        # written on background thread while results are saved
+        checkpointer.end_epoch()
+
+        if is_chief:
+            print("save intermediate results ...")
+            log.save_reconstruction_samples(model, get_sample_dataset(dataset_name, dataset_val), val_steps, epoch)
+            log.save_log(epoch, dataset_name, result_train, result_val)
+            # h5 weights of the last epoch for prediction and evaluation that load "latest"
+            save_model_weights(model, "latest")
+        # other workers read history and checkpoints of chief at the next plan stage
+        DistributionStrategy.barrier()
+
+    if save_ckpt and is_chief:
+        # h5 weights for prediction and evaluation
+        save_model_weights(model, f"ep{target_epoch:02}")
+    # the next plan stage restores the last checkpoint
+    checkpointer.wait()
+    DistributionStrategy.barrier()
+    return stage
 
-        print("save intermediate results ...")
-        log.save_reconstruction_samples(model, dataset_val, val_steps, epoch)
-        log.save_log(epoch, dataset_name, result_train, result_val)
-        save_model_weights(model, "latest")
 
-    if save_ckpt:
-        save_model_weights(model, f"ep{target_epoch:02}")
+def read_training_position():
+    """
+    :return: (epoch, step in epoch) to resume training from,
+             position of the latest training checkpoint if exists, otherwise the epoch after history.csv
+    """
+    position = read_checkpoint_position(checkpoint_dir_path())
+    if position is None:
+        return uf.read_previous_epoch(opts.CKPT_NAME), 0
+    print(f"[read_training_position] resume from epoch {position['epoch']}, step {position['step']}")
+    return position["epoch"], position["step"]
+
+
+def get_training_stage(prev_stage, initial_epoch, tfr_config, train_steps, learning_rate, loss_weights,
+                       scale_weights, net_names):
+    """
+    reuse the model, losses, optimizer and compiled steps of the previous plan stage
+    if the networks, active losses and feature signature are the same,
+    then only loss weights, scale weights and learning rate are updated while optimizer states are kept,
+    otherwise new parts are restored from the latest training checkpoint
+    :param prev_stage: training stage of the previous plan stage or None
+    :return: training stage, dict of "key", "model", "loss_object", "optimizer", "trainer", "validater"
+    """
+    signature = feature_signature(tfr_config, opts.BATCH_SIZE)
+    signature_key = tuple([(key, tuple(spec.shape.as_list()), spec.dtype.name)
+                           for key, spec in sorted(signature.items())])
+    active_losses = tuple(sorted(select_loss_weights(loss_weights, tfr_config).keys()))
+    stage_key = (tuple(net_names), active_losses, signature_key, opts.TRAIN_MODE)
+
+    if prev_stage and (prev_stage["key"] == stage_key):
+        print("[get_training_stage] reuse model and compiled steps of the previous stage")
+        update_loss_weights(prev_stage["loss_object"], loss_weights, scale_weights)
+        set_learning_rate(prev_stage["optimizer"], learning_rate)
+        prev_stage["trainer"].reset_accumulation()
+        prev_stage["trainer"].steps_per_epoch = train_steps
+        prev_stage["validater"].steps_per_epoch = train_steps
+        return prev_stage
+
+    # release the previous stage before building new one
+    if prev_stage:
+        prev_stage.clear()
+    model, augmenter, loss_object, optimizer = \
+        create_training_parts(initial_epoch, tfr_config, learning_rate, loss_weights, scale_weights, net_names)
+    checkpointer, _ = create_checkpointer(checkpoint_dir_path(), model, optimizer,
+                                          opts.CKPT_MAX_TO_KEEP, opts.CKPT_SAVE_STEPS)
+    trainer, validater = tv.train_val_factory(opts.TRAIN_MODE, model, loss_object, train_steps,
+                                              opts.STEREO, augmenter, optimizer, signature)
+    trainer.set_checkpointer(checkpointer)
+    return {"key": stage_key, "model": model, "loss_object": loss_object, "optimizer": optimizer,
+            "trainer": trainer, "validater": validater}
 
 
 def set_configs():
     np.set_printoptions(precision=3, suppress=True)
+    set_precision_policy(opts.PRECISION)
     if not op.isdir(op.join(opts.DATAPATH_CKP, opts.CKPT_NAME)):
         os.makedirs(op.join(opts.DATAPATH_CKP, opts.CKPT_NAME), exist_ok=True)
+    set_gpu_configs()
+
 
-    # set gpu configs
+def set_gpu_configs():
     gpus = tf.config.experimental.list_physical_devices('GPU')
     if gpus:
         try:
             # Currently, memory growth needs to be the same across GPUs
             for gpu in gpus:
-                tf.config.experimental.set_memory_growth(gpu, True)
+                # devices cannot be modified after they are initialized, even to the same value
+                if not tf.config.experimental.get_memory_growth(gpu):
+                    tf.config.experimental.set_memory_growth(gpu, True)
 
             logical_gpus = tf.config.experimental.list_logical_devices('GPU')
             print(len(gpus), "Physical GPUs,", len(logical_gpus), "Logical GPUs")
@@ -77,24 +166,33 @@ def set_configs():
 def create_training_parts(initial_epoch, tfr_config, learning_rate, loss_weights, scale_weights,
                           net_names=None, weight_suffix='latest'):
     pretrained_weight = (initial_epoch == 0) and opts.PRETRAINED_WEIGHT
-    model = ModelFactory(tfr_config, net_names=net_names, global_batch=opts.BATCH_SIZE,
+    # networks run on each replica with per-replica batch in distributed modes
+    model_batch = opts.PER_REPLICA_BATCH if is_distributed() else opts.BATCH_SIZE
+    model = ModelFactory(tfr_config, net_names=net_names, global_batch=model_batch,
                          pretrained_weight=pretrained_weight).get_model()
-    model = try_load_weights(model, weight_suffix)
+    # weights of the latest training checkpoint are restored by create_checkpointer()
+    if (weight_suffix != "latest") or (not has_training_checkpoint(checkpoint_dir_path())):
+        model = try_load_weights(model, weight_suffix)
     # during joint training, flownet is frozen
     if ("depth" in net_names) and ("flow" in net_names):
         model.set_trainable("flownet", False)
 
     # model.compile(optimizer='sgd', loss='mean_absolute_error')
     augmenter = augmentation_factory(opts.AUGMENT_PROBS)
+    # losses are averaged over global batch by compute_average_loss
     loss_object = loss_factory(tfr_config, loss_weights, scale_weights,
-                               weights_to_regularize=model.weights_to_regularize())
-    optimizer = optimizer_factory(opts.OPTIMIZER, learning_rate, initial_epoch)
+                               weights_to_regularize=model.weights_to_regularize(), batch_size=opts.BATCH_SIZE)
+    optimizer = optimizer_factory(opts.OPTIMIZER, learning_rate, initial_epoch, opts.PRECISION)
     return model, augmenter, loss_object, optimizer
 
 
+def checkpoint_dir_path():
+    return op.join(opts.DATAPATH_CKP, opts.CKPT_NAME, "ckpt")
+
+
 def try_load_weights(model, weight_suffix='latest'):
     if opts.CKPT_NAME:
-        model_dir_path = op.join(opts.DATAPATH_CKP, opts.CKPT_NAME, "ckpt")
+        model_dir_path = checkpoint_dir_path()
         if op.isdir(model_dir_path):
             model.load_weights(model_dir_path, weight_suffix)
         else:
@@ -103,23 +201,43 @@ def try_load_weights(model, weight_suffix='latest'):
 
 
 @StrategyDataset
-def get_dataset(dataset_name, split, shuffle, batch_size=opts.BATCH_SIZE):
+def get_dataset(dataset_name, split, shuffle, batch_size=None, num_shards=1, shard_index=0, shuffle_seed=None,
+                skip_batches=0):
+    """
+    :param batch_size: global batch size (opts.BATCH_SIZE) if None, it is set after distribution strategy is created
+    :param num_shards, shard_index: read only every num_shards-th tfrecord file from shard_index
+    :param shuffle_seed, skip_batches: fix the order of shuffled records and skip batches already trained
+    """
+    batch_size = opts.BATCH_SIZE if batch_size is None else batch_size
     tfr_train_path = op.join(opts.DATAPATH_TFR, f"{dataset_name}_{split}")
     print("tfr path : ", tfr_train_path)
     assert op.isdir(tfr_train_path)
-    tfr_reader = TfrecordReader(tfr_train_path, shuffle=shuffle, batch_size=batch_size)
+    tfr_reader = TfrecordReader(tfr_train_path, shuffle=shuffle, batch_size=batch_size,
+                                num_shards=num_shards, shard_index=shard_index,
+                                shuffle_seed=shuffle_seed, skip_batches=skip_batches)
     dataset = tfr_reader.get_dataset()
     tfr_config = tfr_reader.get_tfr_config()
     steps_per_epoch = uf.count_steps(tfr_train_path, batch_size)
     return dataset, tfr_config, steps_per_epoch
 
 
+def get_sample_dataset(dataset_name, dataset_val):
+    """
+    :return: validation dataset that the model can be called on directly,
+             distributed datasets yield per-replica values, so a plain dataset of per-replica batch is made
+    """
+    if not is_distributed():
+        return dataset_val
+    dataset, _, _ = get_dataset.func(dataset_name, "val", False, batch_size=opts.PER_REPLICA_BATCH)
+    return dataset
+
+
 def save_model_weights(model, weights_suffix):
     """
     :param model: model wrapper instance
     :param weights_suffix: checkpoint name suffix
     """
-    model_dir_path = op.join(opts.DATAPATH_CKP, opts.CKPT_NAME, "ckpt")
+    model_dir_path = checkpoint_dir_path()
     if not op.isdir(model_dir_path):
         os.makedirs(model_dir_path, exist_ok=True)
     model.save_weights(model_dir_path, weights_suffix)
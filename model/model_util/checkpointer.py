@@ -0,0 +1,304 @@
+"""
+Training checkpoints by tf.train.Checkpoint and tf.train.CheckpointManager
+A checkpoint holds network weights, optimizer slots and iterations (global step),
+training position (epoch, step in epoch) and random seed.
+Variables are tracked by flat keys like "depthnet/conv1/kernel" or "optimizer/m/depthnet/conv1/kernel",
+so that checkpoints of a plan stage are partially restored into networks of another stage.
+Values are copied to host memory at a step boundary and written on a background thread,
+so training continues while files are written.
+Training records of an epoch are shuffled in the order of a seed of the epoch,
+so training resumes at the exact batch by skipping the records of trained steps instead of saving the iterator.
+"""
+import os
+import threading
+import numpy as np
+import tensorflow as tf
+
+from model.model_util.distributer import DistributionStrategy, StrategyScope
+
+POSITION_KEYS = ["train/epoch", "train/step", "train/seed"]
+
+
+def variable_key(variable):
+    return variable.name.split(":")[0]
+
+
+def tracked_variables(model, optimizer=None):
+    """
+    :param model: model wrapper instance
+    :return: {flat key: variable} of networks and optimizer states
+    """
+    variables = dict()
+    for netname, net in model.models.items():
+        for weight in net.weights:
+            variables[f"{netname}/{variable_key(weight)}"] = weight
+    assert len(variables) == sum([len(net.weights) for net in model.models.values()]), \
+        "[tracked_variables] weight names are NOT unique"
+    if optimizer is None:
+        return variables
+
+    # LossScaleOptimizer exposes iterations and slots of the optimizer it wraps
+    variables["optimizer/iterations"] = optimizer.iterations
+    for netname, net in model.models.items():
+        for weight in net.trainable_weights:
+            for slot_name in optimizer.get_slot_names():
+                try:
+                    slot = optimizer.get_slot(weight, slot_name)
+                except KeyError:
+                    # slots are not created for variables that have not been trained
+                    continue
+                variables[f"optimizer/{slot_name}/{netname}/{variable_key(weight)}"] = slot
+    return variables
+
+
+def create_slots(optimizer, model):
+    """
+    slots are created at the first update by default, create them in advance to restore them
+    by applying zero gradients, which leaves weights of a new optimizer unchanged,
+    iterations incremented by this update is overwritten by the restored one
+    """
+    weights = model.trainable_weights()
+    zero_grads = [tf.zeros_like(weight) for weight in weights]
+    strategy = DistributionStrategy.get_strategy()
+    if strategy is None:
+        optimizer.apply_gradients(zip(zero_grads, weights))
+    else:
+        # optimizer applies gradients only in replica context
+        strategy.run(lambda: optimizer.apply_gradients(zip(zero_grads, weights)))
+
+
+def has_training_checkpoint(ckpt_dir_path):
+    return tf.train.latest_checkpoint(ckpt_dir_path) is not None
+
+
+def read_checkpoint_position(ckpt_dir_path):
+    """
+    :return: {"epoch": epoch, "step": step in epoch} of the latest checkpoint, None if there is no checkpoint
+    """
+    ckpt_path = tf.train.latest_checkpoint(ckpt_dir_path)
+    if ckpt_path is None:
+        return None
+    position = {key: tf.Variable(0, dtype=tf.int64) for key in POSITION_KEYS}
+    tf.train.Checkpoint(**position).restore(ckpt_path).expect_partial()
+    return {"epoch": int(position["train/epoch"].numpy()), "step": int(position["train/step"].numpy())}
+
+
+def checkpoint_number(ckpt_path):
+    # CheckpointManager names checkpoints as "{prefix}-{number}"
+    return int(ckpt_path.rsplit("-", 1)[-1]) if ckpt_path else 0
+
+
+class TrainingCheckpointer:
+    """
+    saves training state every epoch and every save_steps steps, the last max_to_keep checkpoints are kept
+    only chief saves checkpoints in multi_worker mode, every worker restores them
+    """
+    def __init__(self, ckpt_dir_path, model, optimizer, max_to_keep=3, save_steps=0):
+        """
+        :param ckpt_dir_path: directory of checkpoints
+        :param save_steps: save a checkpoint every save_steps steps in the middle of epoch, 0 saves only at epoch end
+        """
+        self.ckpt_dir_path = ckpt_dir_path
+        self.model = model
+        self.optimizer = optimizer
+        self.max_to_keep = max_to_keep
+        self.save_steps = save_steps
+        self.save_number = checkpoint_number(tf.train.latest_checkpoint(ckpt_dir_path)) + 1
+        self.seed = int(np.random.randint(0, 2**31 - 1))
+        self.epoch = 0
+        self.last_saved_step = 0
+        # host side copies of tracked variables that are written by background thread
+        self.shadow = dict()
+        self.manager = None
+        self.writer = None
+        self.error = None
+
+    def restore(self):
+        """
+        restore the latest checkpoint into networks and optimizer,
+        variables that are not in the checkpoint (e.g. network added in this plan stage) are left as they are
+        :return: {"epoch": epoch, "step": step in epoch} of the checkpoint, None if there is no checkpoint
+        """
+        ckpt_path = tf.train.latest_checkpoint(self.ckpt_dir_path)
+        if ckpt_path is None:
+            print("[TrainingCheckpointer] no checkpoint in", self.ckpt_dir_path)
+            return None
+        create_slots(self.optimizer, self.model)
+        variables = tracked_variables(self.model, self.optimizer)
+        position = {key: tf.Variable(0, dtype=tf.int64) for key in POSITION_KEYS}
+        checkpoint = tf.train.Checkpoint(**variables, **position)
+        checkpoint.restore(ckpt_path).expect_partial()
+
+        global_step = int(self.optimizer.iterations.numpy())
+        # random seeds of epochs are derived from the seed of the first run
+        self.seed = int(position["train/seed"].numpy())
+        epoch, step = int(position["train/epoch"].numpy()), int(position["train/step"].numpy())
+        print(f"[TrainingCheckpointer] restored {ckpt_path}: epoch={epoch}, step={step}, global step={global_step}")
+        return {"epoch": epoch, "step": step}
+
+    def begin_epoch(self, epoch, step=0):
+        """
+        :param step: number of steps already trained in this epoch when training is resumed
+        :return: seed of the epoch that fixes the order of training records
+        """
+        self.epoch = epoch
+        self.last_saved_step = step
+        # seeded tf.data and random ops depend on the global seed too, so it is also set by the seed of the epoch
+        epoch_seed = self.seed + epoch
+        tf.random.set_seed(epoch_seed)
+        return epoch_seed
+
+    def step_end(self, step):
+        """
+        :param step: number of steps trained in this epoch, called only when no gradients are accumulated
+        """
+        if (self.save_steps > 0) and (step - self.last_saved_step >= self.save_steps):
+            self.save(self.epoch, step)
+            self.last_saved_step = step
+
+    def end_epoch(self):
+        self.save(self.epoch + 1, 0)
+
+    def save(self, epoch, step):
+        """
+        copy tracked variables to host and write them on background thread
+        :param epoch, step: training position to resume from
+        """
+        if not DistributionStrategy.is_chief():
+            return
+        # keep only one pending checkpoint in host memory
+        self.wait()
+        os.makedirs(self.ckpt_dir_path, exist_ok=True)
+        values = {key: var.numpy() for key, var in tracked_variables(self.model, self.optimizer).items()}
+        values.update({"train/epoch": np.int64(epoch), "train/step": np.int64(step),
+                       "train/seed": np.int64(self.seed)})
+        self.writer = threading.Thread(target=self.write, args=(values, self.save_number), daemon=True)
+        self.save_number += 1
+        self.writer.start()
+
+    def write(self, values, number):
+        try:
+            with tf.device("/cpu:0"):
+                self.update_shadow(values)
+            ckpt_path = self.manager.save(checkpoint_number=number)
+            print(f"\n[TrainingCheckpointer] saved {ckpt_path}")
+        except Exception as error:
+            self.error = error
+
+    def update_shadow(self, values):
+        if set(values.keys()) != set(self.shadow.keys()):
+            # new slots or networks are tracked, rebuild checkpoint over new set of variables
+            self.shadow = {key: tf.Variable(value, trainable=False) for key, value in values.items()}
+            checkpoint = tf.train.Checkpoint(**self.shadow)
+            self.manager = tf.train.CheckpointManager(checkpoint, self.ckpt_dir_path, max_to_keep=self.max_to_keep)
+            return
+        for key, value in values.items():
+            self.shadow[key].assign(value)
+
+    def wait(self):
+        """
+        block until the pending checkpoint is written, errors on background thread are raised here
+        """
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+@StrategyScope
+def create_checkpointer(ckpt_dir_path, model, optimizer, max_to_keep=3, save_steps=0):
+    """
+    slots of optimizer must be created in strategy scope
+    :return: TrainingCheckpointer and position of the restored checkpoint (None if there is no checkpoint)
+    """
+    checkpointer = TrainingCheckpointer(ckpt_dir_path, model, optimizer, max_to_keep, save_steps)
+    position = checkpointer.restore()
+    return checkpointer, position
+
+
+# ======================================================================
+import tempfile
+
+
+def test_training_checkpointer():
+    print("\n===== start test_training_checkpointer")
+
+    class ModelStub:
+        def __init__(self):
+            inputs = tf.keras.layers.Input((4,))
+            outputs = tf.keras.layers.Dense(3, name="dense")(inputs)
+            self.models = {"depthnet": tf.keras.Model(inputs, outputs)}
+
+        def trainable_weights(self):
+            return self.models["depthnet"].trainable_weights
+
+    def train_steps(model, optimizer, steps):
+        for _ in range(steps):
+            with tf.GradientTape() as tape:
+                loss = tf.reduce_sum(tf.square(model.models["depthnet"](tf.ones((2, 4)))))
+            grads = tape.gradient(loss, model.trainable_weights())
+            optimizer.apply_gradients(zip(grads, model.trainable_weights()))
+
+    ckpt_dir_path = tempfile.mkdtemp()
+    model, optimizer = ModelStub(), tf.optimizers.Adam(0.01)
+    checkpointer, position = create_checkpointer(ckpt_dir_path, model, optimizer, max_to_keep=2, save_steps=2)
+    assert position is None
+    checkpointer.begin_epoch(3)
+    for step in range(1, 6):
+        train_steps(model, optimizer, 1)
+        checkpointer.step_end(step)
+        if step == 4:
+            saved = {key: var.numpy() for key, var in tracked_variables(model, optimizer).items()}
+    checkpointer.wait()
+    # only the last 2 checkpoints are kept
+    assert len(tf.train.get_checkpoint_state(ckpt_dir_path).all_model_checkpoint_paths) == 2
+
+    train_steps(model, optimizer, 3)
+    new_model, new_optimizer = ModelStub(), tf.optimizers.Adam(0.01)
+    _, position = create_checkpointer(ckpt_dir_path, new_model, new_optimizer)
+    assert position == {"epoch": 3, "step": 4}
+    restored = tracked_variables(new_model, new_optimizer)
+    assert restored.keys() == saved.keys()
+    for key, value in saved.items():
+        assert np.allclose(restored[key].numpy(), value), key
+    print("!!! test_training_checkpointer passed")
+
+
+def test_resume_epoch_order():
+    print("\n===== start test_resume_epoch_order")
+
+    class ModelStub:
+        def __init__(self):
+            self.models = dict()
+
+        def trainable_weights(self):
+            return []
+
+    def epoch_batches(epoch_seed, skip_batches):
+        # like TfrecordReader: records are shuffled by the seed of epoch and skipped before batching
+        dataset = tf.data.Dataset.range(100).shuffle(20, seed=epoch_seed, reshuffle_each_iteration=False)
+        return [batch.numpy() for batch in dataset.skip(skip_batches * 4).batch(4)]
+
+    ckpt_dir_path = tempfile.mkdtemp()
+    checkpointer = TrainingCheckpointer(ckpt_dir_path, ModelStub(), tf.optimizers.SGD(0.1))
+    expected = epoch_batches(checkpointer.begin_epoch(2), 0)
+    checkpointer.save(2, 5)
+    checkpointer.wait()
+
+    # a resumed run starts with another global seed
+    tf.random.set_seed(checkpointer.seed + 1000)
+    new_checkpointer, position = create_checkpointer(ckpt_dir_path, ModelStub(), tf.optimizers.SGD(0.1))
+    assert position == {"epoch": 2, "step": 5}
+    resumed = epoch_batches(new_checkpointer.begin_epoch(position["epoch"], position["step"]), position["step"])
+    # the remaining batches of the epoch are the same as without the interruption
+    assert len(resumed) == len(expected) - 5
+    for batch, expected_batch in zip(resumed, expected[5:]):
+        assert np.array_equal(batch, expected_batch)
+    print("!!! test_resume_epoch_order passed")
+
+
+if __name__ == "__main__":
+    test_training_checkpointer()
+    test_resume_epoch_order()
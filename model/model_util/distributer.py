@@ -1,26 +1,89 @@
+import os
+import json
 import tensorflow as tf
 from config import opts
 
+DISTRIBUTED_MODES = ["distributed", "multi_worker"]
+
+
+def is_distributed():
+    return opts.TRAIN_MODE in DISTRIBUTED_MODES
+
 
 class DistributionStrategy:
+    """
+    "distributed": MirroredStrategy over devices of a single host
+    "multi_worker": MultiWorkerMirroredStrategy over workers described by TF_CONFIG environment variable,
+                    it must be created at the beginning of the program before other ops
+    """
     strategy = None
 
     @classmethod
     def get_strategy(cls):
-        if (cls.strategy is None) and (opts.TRAIN_MODE == "distributed"):
-            cls.strategy = tf.distribute.MirroredStrategy()
+        if (cls.strategy is None) and is_distributed():
+            if opts.TRAIN_MODE == "multi_worker":
+                cls.strategy = tf.distribute.experimental.MultiWorkerMirroredStrategy()
+            else:
+                cls.strategy = tf.distribute.MirroredStrategy()
+            # num_replicas_in_sync counts replicas of all workers
             opts.BATCH_SIZE = cls.strategy.num_replicas_in_sync * opts.PER_REPLICA_BATCH
             print(f"[DistributionStrategy] number of devices: {cls.strategy.num_replicas_in_sync}")
             print(f"[DistributionStrategy] global batch size: {opts.BATCH_SIZE}")
         return cls.strategy
 
+    @classmethod
+    def is_chief(cls):
+        """
+        :return: whether this process writes checkpoints and logs,
+                 only one worker is chief in multi_worker mode, the single process is chief otherwise
+        """
+        if opts.TRAIN_MODE != "multi_worker":
+            return True
+        task_type, task_id, cluster = read_tf_config()
+        if "chief" in cluster:
+            return task_type == "chief"
+        return (task_type == "worker") and (task_id == 0)
+
+    @classmethod
+    def barrier(cls):
+        """
+        block until all workers reach here, e.g. non-chief workers wait for chief to write logs
+        """
+        if opts.TRAIN_MODE != "multi_worker":
+            return
+        strategy = cls.get_strategy()
+        ones = strategy.run(lambda: tf.constant(1.))
+        strategy.reduce(tf.distribute.ReduceOp.SUM, ones, axis=None).numpy()
+
+
+def read_tf_config():
+    """
+    :return: task type, task index and cluster spec {job name: [addresses]} of TF_CONFIG
+    """
+    tf_config = json.loads(os.environ.get("TF_CONFIG", "{}"))
+    task = tf_config.get("task", {})
+    return task.get("type", "worker"), int(task.get("index", 0)), tf_config.get("cluster", {})
+
+
+def local_replica_values(strategy, structure):
+    """
+    :param structure: nested structure of per-replica values, e.g. {key: PerReplica}
+    :return: list of structures of plain tensors, one for each local replica
+    """
+    flat_values = [strategy.experimental_local_results(value) for value in tf.nest.flatten(structure)]
+    num_replicas = max([len(values) for values in flat_values])
+    # values that are not per-replica are shared by all replicas
+    return [tf.nest.pack_sequence_as(structure, [values[i] if len(values) > 1 else values[0]
+                                                 for values in flat_values])
+            for i in range(num_replicas)]
+
 
 class StrategyScope:
     def __init__(self, f):
         self.func = f
 
     def __call__(self, *args, **kwargs):
-        if opts.TRAIN_MODE == "distributed":
+        if is_distributed():
             print("[StrategyScope]", self.func.__name__)
             strategy = DistributionStrategy.get_strategy()
             with strategy.scope():
@@ -30,6 +93,12 @@ class StrategyScope:
 
 
 class StrategyDataset:
+    """
+    decorates a function (..., batch_size, num_shards, shard_index, skip_batches)
+    that returns (dataset, tfr_config, steps)
+    "distributed": the dataset of global batch is split over replicas
+    "multi_worker": each worker builds its own dataset from its shard of files with per-replica batch
+    """
     def __init__(self, f):
         self.func = f
 
@@ -37,28 +106,33 @@ class StrategyDataset:
         if opts.TRAIN_MODE == "distributed":
             print("[StrategyDataset]", self.func.__name__, *args)
             strategy = DistributionStrategy.get_strategy()
-            dataset, steps = self.func(*args, **kwargs)
+            dataset, tfr_config, steps = self.func(*args, **kwargs)
             dist_dataset = strategy.experimental_distribute_dataset(dataset)
-            return dist_dataset, steps
+            return dist_dataset, tfr_config, steps
+        elif opts.TRAIN_MODE == "multi_worker":
+            print("[StrategyDataset]", self.func.__name__, *args)
+            strategy = DistributionStrategy.get_strategy()
+            # steps per epoch by global batch, every worker must run the same number of steps
+            _, tfr_config, steps = self.func(*args, **kwargs)
+
+            def dataset_fn(input_context):
+                replica_batch = input_context.get_per_replica_batch_size(opts.BATCH_SIZE)
+                replicas_per_worker = strategy.num_replicas_in_sync // input_context.num_input_pipelines
+                # a global step takes a batch of every replica on the worker
+                skip_batches = kwargs.get("skip_batches", 0) * replicas_per_worker
+                shard_kwargs = dict(kwargs, batch_size=replica_batch, num_shards=input_context.num_input_pipelines,
+                                    shard_index=input_context.input_pipeline_id, skip_batches=skip_batches)
+                dataset, _, _ = self.func(*args, **shard_kwargs)
+                # file shards may have different lengths, so each worker repeats its shard and takes the same steps
+                return dataset.repeat().take(steps * replicas_per_worker - skip_batches)
+
+            dist_dataset = strategy.experimental_distribute_datasets_from_function(dataset_fn)
+            return dist_dataset, tfr_config, steps
         else:
             return self.func(*args, **kwargs)
 
 
 class ReplicaOutputIntegrator:
-    def __call__(self, per_replica_results):
-        predictions = []
-        loss_mean = []
-        loss_by_type = []
-        for replica_result in per_replica_results:
-            predictions.append(replica_result[0])
-            loss_mean.append(replica_result[1])
-            loss_by_type.append(replica_result[2])
-
-        predictions = self.integrate_predictions(predictions)
-        loss_mean = self.integrate_scalar_loss(loss_mean)
-        loss_by_type = self.integrate_dict_scalars(loss_by_type)
-        return predictions, loss_mean, loss_by_type
-
     def integrate_predictions(self, replica_results):
         # replica_results: list of {key: value} for each replica
         # print("integrate dict:", replica_results)
@@ -90,22 +164,3 @@ class ReplicaOutputIntegrator:
             outputs[i] = tf.concat(across_replica_data, axis=0)
         return outputs
 
-    def integrate_scalar_loss(self, replica_results):
-        # replica_results: list of loss_mean(scalar) for each replica
-        result = replica_results[0] + replica_results[1]
-        return tf.reduce_sum(replica_results)
-
-    def integrate_dict_scalars(self, replica_results):
-        # replica_results: list of loss_by_type {key: value} for each replica
-        gather_outputs = {key: [] for key in replica_results[0]}
-        for data in replica_results:
-            for key, value in data.items():
-                gather_outputs[key].append(value)
-        # print("gather_outputs:", gather_outputs)
-
-        integ_outputs = dict()
-        for key, value in gather_outputs.items():
-            integ_outputs[key] = tf.reduce_sum(value)
-        # print("integ outputs", integ_outputs)
-        return integ_outputs
-
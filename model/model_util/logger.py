@@ -25,8 +25,9 @@ def save_log(epoch, dataset_name, results_train, results_val):
     """
     :param epoch:
     :param dataset_name:
-    :param results_train: dict of losses, metrics and depths from training data
-    :param results_val: dict of losses, metrics and depths from validation data
+    :param results_train: summary of losses, metrics and depths from training data,
+                          dataframe of rows "mean" and quantiles (e.g. "q50") by metric columns
+    :param results_val: summary of losses, metrics and depths from validation data
     """
     summ_cols = ["loss", "trjabs", "trjrel", "roterr", "deprel"]
     summary = save_results(epoch, dataset_name, results_train, results_val, summ_cols, "history.csv")
@@ -50,8 +51,8 @@ def save_results(epoch, dataset_name, results_train, results_val, columns, filen
       checkpts의 how-to-read-columns.txt 에서도 확인할 수 있다.
     - smootheness loss나 regularization loss는 크기가 작아서 1000을 곱해서 저장한다.
     """
-    train_result = results_train.mean(axis=0).to_dict()
-    val_result = results_val.mean(axis=0).to_dict()
+    train_result = results_train.loc["mean"].to_dict()
+    val_result = results_val.loc["mean"].to_dict()
 
     epoch_result = {"epoch": f"{epoch:>5}", "dataset": f"{dataset_name[:7]:<7}"}
     for colname in columns:
@@ -154,7 +155,7 @@ def save_scales(epoch, results_train, results_val, filename):
     results_train = results_train.rename(columns={col: "t_" + col for col in list(results_train)})
     results_val = results_val.rename(columns={col: "v_" + col for col in list(results_val)})
     results = pd.concat([results_train, results_val], axis=1)
-    results = results.quantile([0, 0.25, 0.5, 0.75, 1.], axis=0)
+    results = results.loc[["q0", "q25", "q50", "q75", "q100"]]
     results["|"] = "|"
     results = results[list(results_train) + ["|"] + list(results_val)]
 
@@ -169,7 +170,7 @@ def make_reconstructed_views(model, dataset, total_steps):
     # 7 file are in a row in file explorer
     stride = min(total_steps, RECON_SAMPLES*50) // RECON_SAMPLES
     max_steps = stride * RECON_SAMPLES
-    total_loss = lm.TotalLoss()
+    total_loss = lm.TotalLoss(stereo=opts.STEREO)
     scaleidx, batchidx, srcidx = 0, 0, 0
 
     for i, features in enumerate(dataset):
@@ -188,12 +189,7 @@ def make_reconstructed_views(model, dataset, total_steps):
 def stack_reconstruction_images(total_loss, features, predictions, indices):
     scaleidx, batchidx, srcidx = indices
     # create intermediate data
-    augm_data = total_loss.append_data(features, predictions)
-    if opts.STEREO and ("image_R" in features):
-        augm_data_rig = total_loss.append_data(features, predictions, "_R")
-        augm_data.update(augm_data_rig)
-        augm_data_stereo = total_loss.synethesize_stereo(features, predictions, augm_data)
-        augm_data.update(augm_data_stereo)
+    augm_data = total_loss.append_data_rig(features, predictions)
 
     view_imgs = {"left_target": augm_data["target"][0]}
 
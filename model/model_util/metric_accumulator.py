@@ -0,0 +1,202 @@
+import os
+import os.path as op
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+import utils.util_funcs as uf
+
+SUMMARY_QUANTILES = [0., 0.25, 0.5, 0.75, 0.8, 0.9, 1.]
+
+
+def quantile_label(quantile):
+    return f"q{int(round(quantile * 100))}"
+
+
+class MetricAccumulator:
+    """
+    Accumulates scalar metrics of steps in fixed size float32 buffers
+    - ring buffer: the latest values of each metric, they are written to csv
+    - streaming mean: running sum and count in float64
+    - quantile sketch: uniform reservoir sample of all values in the epoch
+    Console and csv outputs are written from a background thread at a fixed period,
+    so the step loop only copies numbers into buffers.
+    """
+    def __init__(self, name, csv_path=None, period=1., formatter=None, ring_size=4096, reservoir_size=1024, seed=0):
+        """
+        :param name: name printed on progress line
+        :param csv_path: csv file to append metrics of every step, None disables csv output
+        :param period: output period in seconds
+        :param formatter: function that makes progress message from mean metrics {name: float}
+        """
+        self.name = name
+        self.csv_path = csv_path
+        self.period = period
+        self.formatter = format_mean if formatter is None else formatter
+        self.ring_size = ring_size
+        self.reservoir_size = reservoir_size
+        self.rng = np.random.RandomState(seed)
+        self.lock = threading.Lock()
+        self.stop_event = None
+        self.writer = None
+        self.keys = []
+        self.ring = None
+        self.reservoir = None
+        self.sums = None
+        self.count = 0
+        self.written_count = 0
+        self.dropped_count = 0
+        self.total_steps = 0
+        self.epoch = 0
+        self.step_offset = 0
+        self.start_time = 0
+
+    def start(self, total_steps=0, epoch=0, step_offset=0):
+        """
+        reset accumulated values and start the background writer
+        :param epoch: written to "epoch" column of csv
+        :param step_offset: step index of the first added metrics in the epoch, e.g. resumed step
+        """
+        self.close()
+        with self.lock:
+            self.keys = []
+            self.count = 0
+            self.written_count = 0
+            self.dropped_count = 0
+            self.total_steps = total_steps
+            self.epoch = epoch
+            self.step_offset = step_offset
+            self.start_time = time.time()
+        self.stop_event = threading.Event()
+        self.writer = threading.Thread(target=self.work, daemon=True)
+        self.writer.start()
+
+    def add(self, step_metrics):
+        """
+        :param step_metrics: list of {name: float} of steps
+        """
+        if not step_metrics:
+            return
+        with self.lock:
+            if not self.keys:
+                self.init_buffers(list(step_metrics[0].keys()))
+            for metrics in step_metrics:
+                values = np.array([metrics[key] for key in self.keys], dtype=np.float32)
+                self.ring[self.count % self.ring_size] = values
+                self.sums += values
+                # reservoir sampling (algorithm R)
+                if self.count < self.reservoir_size:
+                    self.reservoir[self.count] = values
+                else:
+                    index = self.rng.randint(0, self.count + 1)
+                    if index < self.reservoir_size:
+                        self.reservoir[index] = values
+                self.count += 1
+
+    def init_buffers(self, keys):
+        self.keys = keys
+        self.ring = np.zeros((self.ring_size, len(keys)), dtype=np.float32)
+        self.reservoir = np.zeros((self.reservoir_size, len(keys)), dtype=np.float32)
+        self.sums = np.zeros(len(keys), dtype=np.float64)
+
+    def mean(self):
+        with self.lock:
+            if self.count == 0:
+                return dict()
+            return dict(zip(self.keys, self.sums / self.count))
+
+    def summary(self):
+        """
+        :return: dataframe of metric columns, rows are "mean" and quantiles from the sketch (e.g. "q50")
+        """
+        with self.lock:
+            if self.count == 0:
+                return pd.DataFrame()
+            sample = self.reservoir[:min(self.count, self.reservoir_size)]
+            rows = [self.sums / self.count] + list(np.quantile(sample, SUMMARY_QUANTILES, axis=0))
+            labels = ["mean"] + [quantile_label(quantile) for quantile in SUMMARY_QUANTILES]
+            return pd.DataFrame(rows, index=labels, columns=self.keys)
+
+    def close(self):
+        """
+        stop the background writer after writing remaining outputs
+        """
+        if self.writer is None:
+            return
+        self.stop_event.set()
+        self.writer.join()
+        self.writer = None
+        if self.dropped_count > 0:
+            print(f"\n[{self.name}] {self.dropped_count} steps were not written to csv (ring buffer overflow)")
+
+    def work(self):
+        while not self.stop_event.wait(self.period):
+            self.write_outputs()
+        self.write_outputs()
+
+    def write_outputs(self):
+        with self.lock:
+            if self.count == 0:
+                return
+            mean = dict(zip(self.keys, self.sums / self.count))
+            new_rows = self.collect_new_rows()
+            step_time = (time.time() - self.start_time) / self.count
+            status = f"    {self.name} {self.count}/{self.total_steps} steps, {self.formatter(mean)}, " \
+                     f"time={step_time:1.4f}..."
+        uf.print_progress_status(status)
+        if (self.csv_path is not None) and (new_rows is not None):
+            rows, steps = new_rows
+            frame = pd.DataFrame(rows, columns=self.keys)
+            frame.insert(0, "step", steps + self.step_offset)
+            frame.insert(0, "epoch", self.epoch)
+            os.makedirs(op.dirname(self.csv_path), exist_ok=True)
+            frame.to_csv(self.csv_path, mode="a", index=False, float_format="%.5f",
+                         header=not op.isfile(self.csv_path))
+
+    def collect_new_rows(self):
+        """
+        :return: (values of steps not written yet [N, metrics], step indices [N]) or None
+        """
+        begin = max(self.written_count, self.count - self.ring_size)
+        self.dropped_count += begin - self.written_count
+        if begin == self.count:
+            return None
+        steps = np.arange(begin, self.count)
+        rows = self.ring[steps % self.ring_size].copy()
+        self.written_count = self.count
+        return rows, steps
+
+
+def format_mean(mean):
+    return ", ".join([f"{key}={val:1.4f}" for key, val in mean.items()])
+
+
+# ======================================================================
+
+def test_metric_accumulator():
+    print("\n===== start test_metric_accumulator")
+    import tempfile
+    import time
+    csv_path = op.join(tempfile.mkdtemp(), "steps.csv")
+    accum = MetricAccumulator("test", csv_path, period=0.05, ring_size=64, reservoir_size=256)
+    accum.start(total_steps=1000, epoch=2, step_offset=100)
+    values = np.random.RandomState(1).uniform(0, 1, 1000)
+    for i in range(0, 1000, 20):
+        accum.add([{"loss": val, "deprel": val * 2} for val in values[i:i + 20]])
+        time.sleep(0.002)
+    accum.close()
+
+    summary = accum.summary()
+    print("\n", summary)
+    assert np.isclose(summary.loc["mean", "loss"], values.mean(), rtol=1e-5)
+    # quantiles from 256 samples are close to exact ones
+    assert abs(summary.loc["q50", "loss"] - np.median(values)) < 0.1
+    written = pd.read_csv(csv_path)
+    assert len(written) + accum.dropped_count == 1000
+    assert (written["epoch"] == 2).all() and written["step"].min() >= 100 and written["step"].max() == 1099
+    print("!!! test_metric_accumulator passed")
+
+
+if __name__ == "__main__":
+    test_metric_accumulator()
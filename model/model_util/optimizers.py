@@ -1,13 +1,178 @@
+import math
 import tensorflow as tf
+
+from config import opts
 from utils.util_class import WrongInputException
+from model.model_util.distributer import StrategyScope
+
+OPTIMIZERS = {"adam": tf.optimizers.Adam, "sgd": tf.optimizers.SGD}
+LR_SCHEDULES = ["constant", "cosine", "step"]
+
+
+def optimizer_factory(opt_name, basic_lr, epoch=0, precision="float32"):
+    """
+    :param opt_name: "{optimizer}_{schedule}" e.g. "adam_constant", "adam_cosine", "sgd_step"
+    :param basic_lr: learning rate of the plan stage, it is scaled by schedule of global step
+    """
+    optim_name, _, schedule_name = opt_name.partition("_")
+    if (optim_name not in OPTIMIZERS) or (schedule_name not in LR_SCHEDULES):
+        raise WrongInputException(f"{opt_name} is NOT an available optimizer name")
+    schedule = LearningRateByStep(schedule_name, basic_lr, opts.LR_WARMUP_STEPS, opts.LR_DECAY_STEPS,
+                                  opts.LR_DECAY_RATE, opts.LR_MIN_RATIO)
+    optimizer = OPTIMIZERS[optim_name](learning_rate=schedule)
+
+    # float16 gradients underflow without loss scaling, bfloat16 has the same exponent range as float32
+    if precision == "mixed_float16":
+        optimizer = tf.keras.mixed_precision.experimental.LossScaleOptimizer(optimizer, loss_scale="dynamic")
+    return optimizer
+
+
+class LearningRateByStep(tf.keras.optimizers.schedules.LearningRateSchedule):
+    """
+    learning rate as a function of global step (optimizer iterations) that persists over plan stages
+    lr = basic_lr * warmup(step) * decay(step)
+    - warmup: linearly increases from 1/warmup_steps to 1 over the first warmup_steps
+    - "constant": decay is 1
+    - "cosine": decay goes from 1 to min_ratio along a half cosine over decay_steps and stays at min_ratio
+    - "step": decay is multiplied by decay_rate every decay_steps
+    basic_lr is a variable so that compiled training steps follow learning rate of the next plan stage
+    """
+    def __init__(self, schedule, basic_lr, warmup_steps=0, decay_steps=100000, decay_rate=0.1, min_ratio=0.):
+        super().__init__()
+        if schedule not in LR_SCHEDULES:
+            raise WrongInputException(f"[LearningRateByStep] {schedule} is NOT an available schedule")
+        self.schedule = schedule
+        self.warmup_steps = warmup_steps
+        self.decay_steps = max(decay_steps, 1)
+        self.decay_rate = decay_rate
+        self.min_ratio = min_ratio
+        self.basic_lr = tf.Variable(basic_lr, trainable=False, dtype=tf.float32, name="basic_lr")
+
+    def __call__(self, step):
+        step = tf.cast(step, tf.float32)
+        if self.schedule == "cosine":
+            progress = tf.minimum(step / self.decay_steps, 1.)
+            decay = self.min_ratio + (1. - self.min_ratio) * 0.5 * (1. + tf.cos(math.pi * progress))
+        elif self.schedule == "step":
+            decay = tf.pow(self.decay_rate, tf.floor(step / self.decay_steps))
+        else:
+            decay = tf.constant(1.)
+        if self.warmup_steps > 0:
+            decay *= tf.minimum((step + 1.) / self.warmup_steps, 1.)
+        return self.basic_lr * decay
+
+    def set_basic_lr(self, basic_lr):
+        self.basic_lr.assign(basic_lr)
+
+    def get_config(self):
+        return {"schedule": self.schedule, "basic_lr": float(self.basic_lr.numpy()),
+                "warmup_steps": self.warmup_steps, "decay_steps": self.decay_steps,
+                "decay_rate": self.decay_rate, "min_ratio": self.min_ratio}
+
+
+def set_precision_policy(precision):
+    """
+    set global keras policy, it must be called before models are created
+    :param precision: "float32", "mixed_float16" or "mixed_bfloat16"
+    """
+    if precision not in ["float32", "mixed_float16", "mixed_bfloat16"]:
+        raise WrongInputException(f"{precision} is NOT an available precision")
+    policy = tf.keras.mixed_precision.experimental.Policy(precision)
+    tf.keras.mixed_precision.experimental.set_policy(policy)
+    print(f"[set_precision_policy] compute dtype: {policy.compute_dtype}, variable dtype: {policy.variable_dtype}")
+
+
+def is_loss_scaled(optimizer):
+    return isinstance(optimizer, tf.keras.mixed_precision.experimental.LossScaleOptimizer)
+
+
+def get_scaled_loss(optimizer, loss):
+    """
+    :return: loss multiplied by the current loss scale if optimizer is loss-scaled, otherwise loss itself
+    """
+    if is_loss_scaled(optimizer):
+        return optimizer.get_scaled_loss(loss)
+    return loss
+
+
+def get_unscaled_gradients(optimizer, grads):
+    """
+    :return: gradients divided by the current loss scale if optimizer is loss-scaled, otherwise grads themselves
+    """
+    if is_loss_scaled(optimizer):
+        return optimizer.get_unscaled_gradients(grads)
+    return grads
+
+
+def set_learning_rate(optimizer, learning_rate):
+    """
+    set basic learning rate of the next plan stage, slots and iterations (global step) are kept
+    so that compiled training steps that captured the optimizer can be reused without re-warming moments
+    """
+    # LossScaleOptimizer exposes learning_rate and iterations of the optimizer it wraps
+    optimizer.learning_rate.set_basic_lr(learning_rate)
+    print(f"[set_learning_rate] basic learning rate={learning_rate}, global step={optimizer.iterations.numpy()}")
+
+
+class GradientAccumulator:
+    """
+    sums gradients of micro-batches into preallocated variables to apply them at once
+    variables are SUM-aggregated on read, so under MirroredStrategy each replica accumulates its own gradients
+    and optimizer.apply_gradients() all-reduces them as usual
+    """
+    def __init__(self, variables, accum_steps):
+        self.accum_steps = accum_steps
+        self.accum_grads = [tf.Variable(tf.zeros_like(var), trainable=False, name=f"accum_grad_{i}",
+                                        synchronization=tf.VariableSynchronization.ON_READ,
+                                        aggregation=tf.VariableAggregation.SUM)
+                            for i, var in enumerate(variables)]
+
+    def accumulate(self, grads):
+        """
+        :param grads: unscaled gradients of a micro-batch whose loss is averaged over the micro-batch
+        """
+        for accum_grad, grad in zip(self.accum_grads, grads):
+            if grad is not None:
+                # loss averaged over accum_steps micro-batches, like compute_average_loss over the effective batch
+                accum_grad.assign_add(tf.cast(grad, accum_grad.dtype) / self.accum_steps)
+
+    def gradients(self):
+        return [accum_grad.read_value() for accum_grad in self.accum_grads]
+
+    def reset(self):
+        for accum_grad in self.accum_grads:
+            accum_grad.assign(tf.zeros_like(accum_grad))
+
+
+@StrategyScope
+def create_gradient_accumulator(variables, accum_steps):
+    """
+    :return: GradientAccumulator created in strategy scope, None if gradients are applied every step
+    """
+    if accum_steps <= 1:
+        return None
+    print(f"[create_gradient_accumulator] gradients are applied every {accum_steps} steps")
+    return GradientAccumulator(variables, accum_steps)
+
+
+# ======================================================================
+import numpy as np
+
 
-# TODO: make a optimizer policy class to change learning rates according to epochs
+def test_learning_rate_by_step():
+    print("\n===== start test_learning_rate_by_step")
+    steps = np.array([0, 9, 50, 100, 250], dtype=np.int64)
+    warmup = LearningRateByStep("constant", 0.1, warmup_steps=10)
+    assert np.allclose([warmup(step).numpy() for step in steps], [0.01, 0.1, 0.1, 0.1, 0.1])
+    cosine = LearningRateByStep("cosine", 0.1, decay_steps=100, min_ratio=0.1)
+    assert np.allclose([cosine(step).numpy() for step in steps], [0.1, 0.0982, 0.055, 0.01, 0.01], atol=1e-4)
+    step_decay = LearningRateByStep("step", 0.1, decay_steps=100, decay_rate=0.5)
+    assert np.allclose([step_decay(step).numpy() for step in steps], [0.1, 0.1, 0.1, 0.05, 0.025])
+    # stage learning rate scales the schedule
+    step_decay.set_basic_lr(0.01)
+    assert np.isclose(step_decay(250).numpy(), 0.0025)
+    print("!!! test_learning_rate_by_step passed")
 
 
-def optimizer_factory(opt_name, basic_lr, epoch=0):
-    if opt_name == "adam_constant":
-        return tf.optimizers.Adam(learning_rate=basic_lr)
-    if opt_name == "sgd_constant":
-        return tf.optimizers.SGD(learning_rate=basic_lr)
-    else:
-        raise WrongInputException(f"{opt_name} is NOT an available model name")
+if __name__ == "__main__":
+    test_learning_rate_by_step()
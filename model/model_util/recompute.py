@@ -0,0 +1,128 @@
+"""
+Activation recomputation (gradient checkpointing)
+A stage wrapped by recompute() keeps only its inputs and outputs for backprop
+and recomputes its intermediate activations in the backward pass, trading compute for memory.
+Stages are selected by opts.RECOMPUTE:
+    "depth_decoder": each upconv block of the depthnet decoder, built as a nested model
+    "posenet", "flownet": the whole network call in ModelWrapper
+    "synthesis": view synthesis of each scale (pixel projection and bilinear sampling)
+    "photo_error": photometric error map of each (loss key, scale), including SSIM intermediates
+"""
+import tensorflow as tf
+
+from config import opts
+from utils.util_class import WrongInputException
+
+RECOMPUTE_STAGES = ["depth_decoder", "posenet", "flownet", "synthesis", "photo_error"]
+
+
+def recompute(stage, func):
+    """
+    :param stage: one of RECOMPUTE_STAGES
+    :param func: function whose positional arguments are tensors
+    :return: func wrapped by tf.recompute_grad if stage is in opts.RECOMPUTE, otherwise func itself
+    """
+    if is_recomputed(stage):
+        return tf.recompute_grad(func)
+    return func
+
+
+def is_recomputed(stage):
+    for name in list(opts.RECOMPUTE) + [stage]:
+        if name not in RECOMPUTE_STAGES:
+            raise WrongInputException(f"[recompute] {name} is NOT a recomputable stage")
+    return stage in opts.RECOMPUTE
+
+
+def recompute_block(stage, build_block, inputs, name):
+    """
+    :param stage: one of RECOMPUTE_STAGES
+    :param build_block: function that builds layers of a block on keras tensors and returns its output
+    :param inputs: list of keras tensors, positional arguments of build_block
+    :param name: name of the block
+    :return: output of the block, if stage is in opts.RECOMPUTE the block is built as a nested model
+             whose activations are recomputed in backward pass
+    """
+    if not is_recomputed(stage):
+        return build_block(*inputs)
+    block_inputs = [tf.keras.Input(batch_shape=x.shape, dtype=x.dtype, name=f"{name}_in{i}")
+                    for i, x in enumerate(inputs)]
+    block = tf.keras.Model(inputs=block_inputs, outputs=build_block(*block_inputs), name=name + "_block")
+    return RecomputedModel(block, name=name)(inputs)
+
+
+class RecomputedModel(tf.keras.layers.Layer):
+    """
+    layer that calls a model with recomputation, the model is built in advance so that
+    its variables are not created inside tf.recompute_grad
+    """
+    def __init__(self, model, **kwargs):
+        super().__init__(**kwargs)
+        self.model = model
+        self.recomputed_call = tf.recompute_grad(lambda *inputs: self.model(list(inputs)))
+
+    def call(self, inputs):
+        return self.recomputed_call(*inputs)
+
+
+# ======================================================================
+import numpy as np
+
+
+def test_recompute():
+    print("\n===== start test_recompute")
+    weight = tf.Variable(tf.random.normal((16, 16)))
+    x = tf.random.normal((8, 16))
+
+    def block(inputs):
+        return tf.nn.relu(tf.matmul(tf.nn.relu(tf.matmul(inputs, weight)), weight))
+
+    grads = []
+    recompute_stages = opts.RECOMPUTE
+    try:
+        for stages in [[], ["photo_error"]]:
+            opts.RECOMPUTE = stages
+            with tf.GradientTape() as tape:
+                loss = tf.reduce_sum(recompute("photo_error", block)(x))
+            grads.append(tape.gradient(loss, weight).numpy())
+    finally:
+        opts.RECOMPUTE = recompute_stages
+    # recomputed gradients must be the same as stored ones
+    assert np.allclose(grads[0], grads[1], atol=1e-5)
+    print("!!! test_recompute passed")
+
+
+def test_recompute_block():
+    print("\n===== start test_recompute_block")
+    x = tf.random.normal((2, 8, 8, 4))
+    skip = tf.random.normal((2, 8, 8, 4))
+
+    def build_block(inputs, skip_inputs):
+        conv = tf.keras.layers.Conv2D(4, 3, padding="same", activation="relu", name="blk_conv1")(inputs)
+        concat = tf.keras.layers.Concatenate(axis=3, name="blk_concat")([conv, skip_inputs])
+        return tf.keras.layers.Conv2D(4, 3, padding="same", activation="relu", name="blk_conv2")(concat)
+
+    grads = []
+    weights = None
+    recompute_stages = opts.RECOMPUTE
+    try:
+        for stages in [[], ["depth_decoder"]]:
+            opts.RECOMPUTE = stages
+            inputs = [tf.keras.Input(batch_shape=x.shape), tf.keras.Input(batch_shape=skip.shape)]
+            model = tf.keras.Model(inputs, recompute_block("depth_decoder", build_block, inputs, "blk"))
+            # the same weights in plain and nested layers
+            weights = model.get_weights() if weights is None else weights
+            model.set_weights(weights)
+            with tf.GradientTape() as tape:
+                loss = tf.reduce_sum(model([x, skip]))
+            grads.append([grad.numpy() for grad in tape.gradient(loss, model.trainable_weights)])
+            print(f"RECOMPUTE={stages}, layers:", [layer.name for layer in model.layers])
+    finally:
+        opts.RECOMPUTE = recompute_stages
+    assert all([np.allclose(plain, nested, atol=1e-5) for plain, nested in zip(grads[0], grads[1])])
+    print("!!! test_recompute_block passed")
+
+
+if __name__ == "__main__":
+    test_recompute()
+    test_recompute_block()
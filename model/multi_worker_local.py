@@ -0,0 +1,94 @@
+"""
+Runs multi-worker training with CPU worker processes on one machine
+Each process gets TF_CONFIG of a localhost cluster and runs in "multi_worker" mode,
+e.g. train by PRE_TRAINING_PLAN with 2 workers:
+    python -m model.multi_worker_local
+"""
+import os
+import json
+import socket
+import multiprocessing
+
+import settings
+from config import opts
+
+
+def local_tf_configs(num_workers):
+    """
+    :return: TF_CONFIG json strings of workers in a localhost cluster, worker 0 is chief
+    """
+    ports = []
+    sockets = []
+    # reserve distinct free ports
+    for _ in range(num_workers):
+        sock = socket.socket()
+        sock.bind(("localhost", 0))
+        sockets.append(sock)
+        ports.append(sock.getsockname()[1])
+    for sock in sockets:
+        sock.close()
+    cluster = {"worker": [f"localhost:{port}" for port in ports]}
+    return [json.dumps({"cluster": cluster, "task": {"type": "worker", "index": index}})
+            for index in range(num_workers)]
+
+
+def run_worker(tf_config, target, args):
+    # environment must be set before tensorflow is initialized in the new process
+    os.environ["TF_CONFIG"] = tf_config
+    os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+    opts.TRAIN_MODE = "multi_worker"
+    target(*args)
+
+
+def launch_local_workers(target, args=(), num_workers=2):
+    """
+    :param target: module level function that each worker runs
+    :return: exit codes of workers
+    """
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=run_worker, args=(tf_config, target, args))
+                 for tf_config in local_tf_configs(num_workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    exitcodes = [process.exitcode for process in processes]
+    print("[launch_local_workers] exit codes of workers:", exitcodes)
+    return exitcodes
+
+
+def train_plan_worker(plan_name):
+    from model.model_main import train_by_plan
+    train_by_plan(getattr(opts, plan_name))
+
+
+# ======================================================================
+
+def check_worker_sync():
+    import tensorflow as tf
+    from model.model_util.distributer import DistributionStrategy, read_tf_config
+
+    strategy = DistributionStrategy.get_strategy()
+    task_type, task_id, cluster = read_tf_config()
+    num_workers = len(cluster["worker"])
+    assert strategy.num_replicas_in_sync == num_workers
+    assert opts.BATCH_SIZE == num_workers * opts.PER_REPLICA_BATCH
+    assert DistributionStrategy.is_chief() == (task_id == 0)
+    DistributionStrategy.barrier()
+    # sum of worker indices over all replicas
+    indices = strategy.run(lambda: tf.constant(float(task_id)))
+    index_sum = strategy.reduce(tf.distribute.ReduceOp.SUM, indices, axis=None).numpy()
+    assert index_sum == sum(range(num_workers)), index_sum
+    print(f"[check_worker_sync] worker {task_id} passed")
+
+
+def test_local_multi_worker():
+    print("\n===== start test_local_multi_worker")
+    exitcodes = launch_local_workers(check_worker_sync, num_workers=2)
+    assert all([code == 0 for code in exitcodes])
+    print("!!! test_local_multi_worker passed")
+
+
+if __name__ == "__main__":
+    launch_local_workers(train_plan_worker, ("PRE_TRAINING_PLAN",), num_workers=2)
+    # test_local_multi_worker()
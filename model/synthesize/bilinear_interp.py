@@ -1,8 +1,28 @@
 import tensorflow as tf
 from utils.decorators import shape_check
+from model.synthesize import synth_consts
+try:
+    import tensorflow_addons as tfa
+except ImportError:
+    tfa = None
+
+"""
+sampling methods of BilinearInterpolation
+"gather": gathers four neighbors with a single tf.gather on flattened image and reduces them by einsum
+"gather_nd": gathers each neighbor by tf.gather_nd and merges stacked samples (previous implementation)
+"resampler": tfa.image.resampler masked by the same valid mask, falls back to "gather" without tfa
+"""
+SAMPLE_METHODS = ["gather", "gather_nd", "resampler"]
+DEFAULT_SAMPLE_METHOD = "gather"
 
 
 class BilinearInterpolation:
+    def __init__(self, method=DEFAULT_SAMPLE_METHOD):
+        assert method in SAMPLE_METHODS, f"[BilinearInterpolation] wrong sampling method: {method}"
+        if method == "resampler" and tfa is None:
+            method = "gather"
+        self.method = method
+
     @shape_check
     def __call__(self, image, pixel_coords, valid_mask=None):
         """
@@ -19,15 +39,21 @@ class BilinearInterpolation:
         # valid_mask: [batch, numsrc, 1, height*width]
         valid_mask2 = self.make_valid_mask(pixel_floorceil, valid_mask, batch)
 
-        # weights[batch, numsrc, :, height*width] = (w_uf_vf, w_uf_vc, w_uc_vf, w_uc_vc)
-        weights = self.calc_neighbor_weights([pixel_coords, pixel_floorceil, valid_mask2])
-
-        # sampled_image[batch, numsrc, :, height, width, 3] =
-        # (im_uf_vf, im_uf_vc, im_uc_vf, im_uc_vc)
-        sampled_images = self.sample_neighbor_images([image, pixel_floorceil])
+        if self.method == "resampler":
+            # flat_image[batch, numsrc, height*width, 3]
+            flat_image = self.resample_image([image, pixel_coords, valid_mask2])
+        else:
+            # weights[batch, numsrc, :, height*width] = (w_uf_vf, w_uf_vc, w_uc_vf, w_uc_vc)
+            weights = self.calc_neighbor_weights([pixel_coords, pixel_floorceil, valid_mask2])
+            if self.method == "gather":
+                flat_image = self.gather_and_merge([image, pixel_floorceil, weights])
+            else:
+                # sampled_image[batch, numsrc, :, height, width, 3] =
+                # (im_uf_vf, im_uf_vc, im_uc_vf, im_uc_vc)
+                sampled_images = self.sample_neighbor_images([image, pixel_floorceil])
+                # recon_image[batch, numsrc, height*width, 3]
+                flat_image = self.merge_images([sampled_images, weights])
 
-        # recon_image[batch, numsrc, height*width, 3]
-        flat_image = self.merge_images([sampled_images, weights])
         recon_image = tf.reshape(flat_image, shape=(batch, numsrc, height, width, channels))
         return recon_image
 
@@ -72,7 +98,7 @@ class BilinearInterpolation:
             nonzero_mask = tf.math.not_equal(nonzero_mask, 0)
             mask = tf.logical_and(mask, nonzero_mask)
 
-        mask = tf.cast(mask, tf.float32)
+        mask = tf.cast(mask, pixel_floorceil.dtype)
         return mask
 
     @shape_check
@@ -132,6 +158,51 @@ class BilinearInterpolation:
                                   name="stack_samples")
         return sampled_images
 
+    @shape_check
+    def gather_and_merge(self, inputs):
+        source_image, pixel_floorceil, weights = inputs
+        """
+        source_image: [batch, numsrc, height, width, 3]
+        pixel_floorceil: (u_floor, u_ceil, v_floor, v_ceil) [batch, numsrc, 4, height*width]
+        weights: 4 neighbor pixel weights (w_uf_vf, w_uf_vc, w_uc_vf, w_uc_vc) [batch, numsrc, 4, height*width]
+        return: merged_flat_image, [batch, numsrc, height*width, 3]
+        """
+        batch, numsrc, height, width, channels = source_image.get_shape()
+        pixel_floorceil = tf.cast(pixel_floorceil, tf.int32)
+        # linear indices of neighbors in the order of weights: [batch, numsrc, 4, height*width]
+        u_index = tf.gather(pixel_floorceil, [0, 0, 1, 1], axis=2)
+        v_index = tf.gather(pixel_floorceil, [2, 3, 2, 3], axis=2)
+        linear_index = v_index * width + u_index
+        linear_index = tf.reshape(linear_index, (batch, numsrc, -1))
+        # gather all neighbors at once: [batch, numsrc, 4*height*width, 3]
+        flat_source = tf.reshape(source_image, (batch, numsrc, height*width, channels))
+        samples = tf.gather(flat_source, linear_index, batch_dims=2)
+        samples = tf.reshape(samples, (batch, numsrc, 4, -1, channels))
+        # weighted sum over neighbors without materializing weighted samples
+        merged_flat_image = tf.einsum("bnkpc,bnkp->bnpc", samples, tf.cast(weights, samples.dtype))
+        return merged_flat_image
+
+    @shape_check
+    def resample_image(self, inputs):
+        source_image, pixel_coords, valid_mask = inputs
+        """
+        source_image: [batch, numsrc, height, width, 3]
+        pixel_coords: (u, v) [batch, numsrc, 2 or 3, height*width]
+        valid_mask: [batch, numsrc, 1, height*width]
+        return: merged_flat_image, [batch, numsrc, height*width, 3]
+        """
+        batch, numsrc, height, width, channels = source_image.get_shape()
+        image_dtype = source_image.dtype
+        source_image = tf.reshape(source_image, (batch * numsrc, height, width, channels))
+        # warp: [batch*numsrc, height*width, 2(u,v)]
+        warp = tf.transpose(pixel_coords[:, :, :2], perm=[0, 1, 3, 2])
+        warp = tf.reshape(warp, (batch * numsrc, -1, 2))
+        flat_image = tfa.image.resampler(tf.cast(source_image, warp.dtype), warp)
+        flat_image = tf.reshape(flat_image, (batch, numsrc, -1, channels))
+        # resampler treats out-of-image neighbors as zeros, mask them out like the other methods
+        valid_mask = tf.transpose(valid_mask, perm=[0, 1, 3, 2])
+        return tf.cast(flat_image * valid_mask, image_dtype)
+
     def merge_images(self, inputs):
         sampled_images, weights = inputs
         """
@@ -141,7 +212,7 @@ class BilinearInterpolation:
         return: merged_flat_image, [batch, numsrc, height*width, 3]
         """
         # expand dimension to channel
-        weights = tf.expand_dims(weights, -1)
+        weights = tf.cast(tf.expand_dims(weights, -1), sampled_images.dtype)
         weighted_image = sampled_images * weights
         merged_flat_image = tf.reduce_sum(weighted_image, axis=2)
         return merged_flat_image
@@ -159,7 +230,7 @@ class BilinearInterpolation:
         depth_vec = tf.expand_dims(depth_vec, 1)
         # depth_vec [batch, 1, height*width, 1]
         depth_invalid_mask = tf.math.equal(depth_vec, 0)
-        flat_image = tf.where(depth_invalid_mask, tf.constant(0, dtype=tf.float32), flat_image)
+        flat_image = tf.where(depth_invalid_mask, tf.zeros_like(flat_image), flat_image)
         return flat_image
 
 
@@ -185,12 +256,8 @@ class FlowBilinearInterpolation:
         :return: pixel_coords: source image pixel coordinates [batch, numsrc, 2, height*width]
         """
         batch, numsrc, height, width, _ = flow.get_shape()
-        u = tf.range(0, width, 1, dtype=tf.float32)
-        v = tf.range(0, height, 1, dtype=tf.float32)
-        ugrid, vgrid = tf.meshgrid(u, v)
-        uvgrid = tf.stack([ugrid, vgrid], axis=0)
         # uvgrid -> [1, 1, 2, height*width]
-        uvgrid = tf.reshape(uvgrid, (1, 1, 2, -1))
+        uvgrid = synth_consts.pixel_grid(height, width, homogeneous=False)[tf.newaxis, tf.newaxis]
 
         # uvflow -> [batch, numsrc, height*width, 2]
         uvflow = tf.reshape(flow, (batch, numsrc, -1, 2))
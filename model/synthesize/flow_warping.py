@@ -6,6 +6,7 @@ import tensorflow_addons as tfa
 from config import opts
 from utils.decorators import shape_check
 from model.synthesize.bilinear_interp import BilinearInterpolation
+from model.synthesize import synth_consts
 
 
 class FlowWarpMultiScale:
@@ -54,12 +55,8 @@ class FlowWarpMultiScale:
         :return: pixel_coords: source image pixel coordinates [batch, numsrc, 2, height/scale*width/scale]
         """
         batch, numsrc, height, width, _ = flow.get_shape()
-        u = tf.range(0, width, 1, dtype=tf.float32)
-        v = tf.range(0, height, 1, dtype=tf.float32)
-        ugrid, vgrid = tf.meshgrid(u, v)
-        uvgrid = tf.stack([ugrid, vgrid], axis=0)
         # uvgrid -> [1, 1, 2, height*width]
-        uvgrid = tf.reshape(uvgrid, (1, 1, 2, -1))
+        uvgrid = synth_consts.pixel_grid(height, width, homogeneous=False)[tf.newaxis, tf.newaxis]
 
         # uvflow -> [batch, numsrc, height*width, 2]
         uvflow = tf.reshape(flow, (batch, numsrc, -1, 2))
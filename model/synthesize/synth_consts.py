@@ -0,0 +1,96 @@
+"""
+Registry of constant tensors used in view synthesis
+Each constant is built once per shape and reused across scales, losses and training steps.
+Constants are created under tf.init_scope() so that they are eager tensors captured by tf.function graphs
+instead of being rebuilt as graph ops on every trace.
+"""
+import numpy as np
+import tensorflow as tf
+
+_CONSTANTS = dict()
+
+
+def get_constant(key, builder):
+    """
+    :param key: hashable key that identifies the constant, e.g. ("pixel_grid", height, width)
+    :param builder: function without argument that returns the constant in numpy
+    :return: cached constant tensor
+    """
+    if key in _CONSTANTS:
+        return _CONSTANTS[key]
+    with tf.init_scope():
+        if not tf.executing_eagerly():
+            # outer context is a legacy graph, constant cannot be shared across graphs
+            return tf.constant(builder())
+        constant = tf.constant(builder())
+    _CONSTANTS[key] = constant
+    return constant
+
+
+def pixel_grid(height, width, homogeneous=True):
+    """
+    :return: pixel coordinates like vectors of (u,v,1) [3, height*width] if homogeneous,
+             else (u,v) [2, height*width]
+    """
+    def build():
+        ugrid, vgrid = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+        grid = [ugrid.reshape(-1), vgrid.reshape(-1)]
+        if homogeneous:
+            grid.append(np.ones(height * width, dtype=np.float32))
+        return np.stack(grid, axis=0)
+    return get_constant(("pixel_grid", height, width, homogeneous), build)
+
+
+def ones(shape):
+    """
+    :return: tensor of ones in float32 with the given static shape
+    """
+    shape = tuple(int(dim) for dim in shape)
+    return get_constant(("ones", shape), lambda: np.ones(shape, dtype=np.float32))
+
+
+def intrinsic_scaler(scales):
+    """
+    :param scales: scale or list of scales
+    :return: diag(1/s, 1/s, 1) and its inverse for each scale, [scales, 3, 3] each
+    """
+    scales = tuple(np.atleast_1d(scales).tolist())
+
+    def build(inverse):
+        diag = np.array([[1. / sc, 1. / sc, 1.] for sc in scales], dtype=np.float32)
+        if inverse:
+            diag = 1. / diag
+        return np.stack([np.diag(row) for row in diag], axis=0)
+    scaler = get_constant(("intrinsic_scaler", scales), lambda: build(False))
+    scaler_inv = get_constant(("intrinsic_scaler_inv", scales), lambda: build(True))
+    return scaler, scaler_inv
+
+
+def clear():
+    _CONSTANTS.clear()
+
+
+# ======================================================================
+
+def test_synth_consts():
+    print("\n===== start test_synth_consts")
+    grid = pixel_grid(3, 4)
+    assert grid.shape == (3, 12)
+    assert np.allclose(grid.numpy()[:, 5], [1, 1, 1])
+    # the same object is returned for the same shape
+    assert pixel_grid(3, 4) is grid
+    assert pixel_grid(3, 4, homogeneous=False).shape == (2, 12)
+
+    @tf.function
+    def scaled_grid(scale):
+        return pixel_grid(3, 4) * scale
+
+    # constant is captured, not rebuilt, inside tf.function
+    assert np.allclose(scaled_grid(tf.constant(2.)).numpy(), grid.numpy() * 2)
+    scaler, scaler_inv = intrinsic_scaler([1, 2, 4])
+    assert np.allclose(np.matmul(scaler.numpy(), scaler_inv.numpy()), np.eye(3))
+    print("!!! test_synth_consts passed")
+
+
+if __name__ == "__main__":
+    test_synth_consts()
@@ -4,20 +4,169 @@ from tensorflow.keras import layers
 
 from utils.decorators import shape_check
 from model.synthesize.bilinear_interp import BilinearInterpolation
+from model.synthesize import synth_consts
+from model.model_util.recompute import recompute
 from utils.convert_pose import pose_rvec2matr_batch_tf
 
 
 class SynthesizeMultiScale:
+    """
+    Fused multi-scale view synthesis
+    Pixel grids come from the constant registry and the intrinsic is inverted once for all scales.
+    Target-to-source pixel projections of all scales are computed in a single batched matmul,
+    and a precomputed source image pyramid can be shared by several calls (e.g. temporal and stereo).
+    """
+
     @shape_check
-    def __call__(self, source_image, intrinsic, pred_depth_ms, pred_pose):
+    def __call__(self, source_image, intrinsic, pred_depth_ms, pred_pose, source_ms=None):
         """
         :param source_image: source images stacked vertically [batch, numsrc, height, width, 3]
         :param intrinsic: [batch, 3, 3]
         :param pred_depth_ms: predicted target depth in multi scale, list of [batch, height/scale, width/scale, 1]}
-        :param pred_pose: predicted source pose in twist vector for each source frame [batch, numsrc, 6]
+        :param pred_pose: predicted source pose in twist vector [batch, numsrc, 6]
+                        or in transformation matrix [batch, numsrc, 4, 4] for each source frame
                         it transforms target points to source frame
+        :param source_ms: (optional) source image pyramid matched to pred_depth_ms,
+                        list of [batch, numsrc, height/scale, width/scale, 3], it is built if not given
         :return: reconstructed target view in multi scale, list of [batch, numsrc, height/scale, width/scale, 3]}
         """
+        if pred_pose.get_shape().ndims == 3:
+            # convert pose vector to transformation matrix
+            pred_pose = pose_rvec2matr_batch_tf(pred_pose)
+        if source_ms is None:
+            source_ms = self.make_pyramid(source_image, pred_depth_ms)
+
+        height_orig = source_image.get_shape()[2]
+        return self.synthesize_pyramid(source_ms, intrinsic, pred_depth_ms, pred_pose, height_orig)
+
+    def synthesize_requests(self, requests, intrinsic, pred_depth_ms, height_orig):
+        """
+        synthesize targets for several requests that share target depth in one projection and sampling per scale,
+        sources of requests are concatenated along the source axis and outputs are split back by request
+        :param requests: list of SynthesisRequest
+        :param intrinsic: [batch, 3, 3]
+        :param pred_depth_ms: target depth in multi scale, list of [batch, height/scale, width/scale, 1]
+        :param height_orig: height of original image
+        :return: {request.key: list of [batch, request.numsrc, height/scale, width/scale, 3]}
+        """
+        # [batch, sum of numsrc, 4, 4]
+        pose = tf.concat([request.pose for request in requests], axis=1)
+        source_ms = [tf.concat([request.source_ms[i] for request in requests], axis=1)
+                     for i in range(len(pred_depth_ms))]
+        synth_ms = self.synthesize_pyramid(source_ms, intrinsic, pred_depth_ms, pose, height_orig)
+
+        synth_by_key = dict()
+        numsrcs = [request.numsrc for request in requests]
+        synth_split_ms = [tf.split(synth_sc, numsrcs, axis=1) for synth_sc in synth_ms]
+        for k, request in enumerate(requests):
+            synth_by_key[request.key] = [synth_split[k] for synth_split in synth_split_ms]
+        return synth_by_key
+
+    def synthesize_pyramid(self, source_ms, intrinsic, pred_depth_ms, pose_matr, height_orig):
+        """
+        :param source_ms: source image pyramid, list of [batch, numsrc, height/scale, width/scale, 3]
+        :param pose_matr: [batch, numsrc, 4, 4]
+        :return: reconstructed target view in multi scale, list of [batch, numsrc, height/scale, width/scale, 3]}
+        """
+        scales = [int(height_orig // depth_sc.get_shape()[1]) for depth_sc in pred_depth_ms]
+        # projection matrices of all scales [batch, numsrc, scales, 3, 4]
+        proj_ms = self.projection_matrices(intrinsic, pose_matr, scales)
+
+        def synthesize_scale(source_sc, depth_sc, proj_sc):
+            src_pixel_coords = self.warp_pixel_coords(depth_sc, proj_sc)
+            return BilinearInterpolation()(source_sc, src_pixel_coords, depth_sc)
+
+        # pixel coordinates and sampling weights are recomputed in backward pass if "synthesis" in RECOMPUTE
+        synthesize_scale = recompute("synthesis", synthesize_scale)
+        synth_targets = []
+        for i, depth_sc in enumerate(pred_depth_ms):
+            synth_target_sc = synthesize_scale(source_ms[i], depth_sc, proj_ms[:, :, i])
+            synth_targets.append(synth_target_sc)
+        return synth_targets
+
+    @staticmethod
+    def make_pyramid(image, depth_ms):
+        """
+        :param image: images [batch, numimg, height, width, 3]
+        :param depth_ms: list of [batch, height/scale, width/scale, 1]
+        :return: image pyramid, list of [batch, numimg, height/scale, width/scale, 3]
+        """
+        batch, numimg, height, width, channel = image.get_shape()
+        image4d = tf.reshape(image, (batch * numimg, height, width, channel))
+        pyramid = []
+        for depth_sc in depth_ms:
+            height_sc, width_sc = depth_sc.get_shape()[1:3]
+            image_sc = tf.image.resize(image4d, size=(height_sc, width_sc), method="bilinear")
+            pyramid.append(tf.reshape(image_sc, (batch, numimg, height_sc, width_sc, channel)))
+        return pyramid
+
+    def projection_matrices(self, intrinsic, pose, scales):
+        """
+        a target pixel p with depth d is projected to source by [M|b] as d*M*p + b,
+        where M = K_s*R*inv(K_s), b = K_s*t, and K_s is the intrinsic scaled down by s
+        :param intrinsic: [batch, 3, 3]
+        :param pose: pose matrices that transform points from target to source frame [batch, numsrc, 4, 4]
+        :param scales: list of integer scales
+        :return: [M|b] [batch, numsrc, scales, 3, 4]
+        """
+        # scale_matr: diag(1/s, 1/s, 1) [scales, 3, 3]
+        scale_matr, scale_inv = synth_consts.intrinsic_scaler(scales)
+        # invert intrinsic only once: inv(K_s) = inv(K) * inv(S_s)
+        # [batch, 1, scales, 3, 3]
+        intrinsic_ms = tf.matmul(scale_matr[tf.newaxis], intrinsic[:, tf.newaxis])[:, tf.newaxis]
+        intrinsic_inv_ms = tf.matmul(tf.linalg.inv(intrinsic)[:, tf.newaxis], scale_inv[tf.newaxis])[:, tf.newaxis]
+        # [batch, numsrc, 1, 3, 4]
+        pose = pose[:, :, tf.newaxis, :3, :]
+        # [batch, numsrc, scales, 3, 3]
+        rotation = tf.matmul(tf.matmul(intrinsic_ms, pose[..., :3]), intrinsic_inv_ms)
+        # [batch, numsrc, scales, 3, 1]
+        translation = tf.matmul(intrinsic_ms, pose[..., 3:])
+        return tf.concat([rotation, translation], axis=-1)
+
+    def warp_pixel_coords(self, depth_sc, proj_sc):
+        """
+        :param depth_sc: target depth [batch, height/scale, width/scale, 1]
+        :param proj_sc: projection matrix [M|b] [batch, numsrc, 3, 4]
+        :return: projected pixel coordinates on source image plane (u,v,1) [batch, numsrc, 3, height*width]
+        """
+        batch, height_sc, width_sc, _ = depth_sc.get_shape()
+        pixel_grid = synth_consts.pixel_grid(height_sc, width_sc)
+        # [batch, numsrc, 3, height*width] = [batch, numsrc, 3, 3] x [3, height*width]
+        pixel_coords = tf.tensordot(proj_sc[..., :3], pixel_grid, [[3], [0]])
+        # scale rays by depth and add translation
+        depth_flat = tf.cast(tf.reshape(depth_sc, (batch, 1, 1, -1)), proj_sc.dtype)
+        pixel_coords = pixel_coords * depth_flat + proj_sc[..., 3:]
+        # normalize scale
+        pixel_coords = pixel_coords / (pixel_coords[:, :, 2:3, :] + 1e-10)
+        return pixel_coords
+
+
+class SynthesisRequest:
+    """
+    a group of source views to be synthesized into the target view, e.g. temporal or stereo sources
+    """
+    def __init__(self, key, source_ms, pose):
+        """
+        :param key: output key of synthesized targets
+        :param source_ms: source image pyramid, list of [batch, numsrc, height/scale, width/scale, 3]
+        :param pose: pose matrices that transform points from target to source frame [batch, numsrc, 4, 4]
+        """
+        self.key = key
+        self.source_ms = source_ms
+        self.pose = pose
+        self.numsrc = pose.get_shape()[1]
+
+
+class SynthesizeMultiScaleLegacy:
+    """
+    previous multi-scale synthesis that runs SynthesizeSingleScale for each scale independently,
+    it is kept as a reference for tests and benchmarks
+    """
+    @shape_check
+    def __call__(self, source_image, intrinsic, pred_depth_ms, pred_pose):
+        """
+        arguments are the same as SynthesizeMultiScale except for source_ms
+        """
         # convert pose vector to transformation matrix
         poses_matr = layers.Lambda(lambda pose: pose_rvec2matr_batch_tf(pose),
                                    name="pose2matrix")(pred_pose)
@@ -64,10 +213,9 @@ class SynthesizeSingleScale:
         self.scale = int(height_orig // self.height_sc)
 
     def scale_intrinsic(self, intrinsic, scale):
-        scaled_part = tf.slice(intrinsic, (0, 0, 0), (-1, 2, -1))
-        scaled_part = scaled_part / scale
-        const_part = tf.tile(tf.constant([[[0, 0, 1]]], dtype=tf.float32), (self.batch, 1, 1))
-        scaled_intrinsic = tf.concat([scaled_part, const_part], axis=1)
+        scale_matr, _ = synth_consts.intrinsic_scaler(scale)
+        # [batch, 3, 3] = [1, 3, 3] x [batch, 3, 3]
+        scaled_intrinsic = tf.matmul(scale_matr, intrinsic)
         return scaled_intrinsic
 
     @shape_check
@@ -115,12 +263,14 @@ class SynthesizeSingleScale:
         """
         :return: pixel coordinates like vectors of (u,v,1) [3, height*width]
         """
+        if stride == 1:
+            return synth_consts.pixel_grid(height, width)
         v = np.linspace(0, height - stride, int(height // stride)).astype(np.float32)
         u = np.linspace(0, width - stride, int(width // stride)).astype(np.float32)
         ugrid, vgrid = tf.meshgrid(u, v)
         uv = tf.stack([ugrid, vgrid], axis=0)
         uv = tf.reshape(uv, (2, -1))
-        uv = tf.concat([uv, tf.ones((1, height*width), tf.float32)], axis=0)
+        uv = tf.concat([uv, tf.ones((1, uv.get_shape()[1]), tf.float32)], axis=0)
         return uv
 
     def pixel2cam(self, pixel_coords, depth, intrinsic):
@@ -142,7 +292,7 @@ class SynthesizeSingleScale:
         # num_pts = height * width
         num_pts = cam_coords.get_shape().as_list()[2]
         # make homogeneous coordinates
-        cam_coords = tf.concat([cam_coords, tf.ones((self.batch, 1, num_pts), tf.float32)], axis=1)
+        cam_coords = tf.concat([cam_coords, synth_consts.ones((self.batch, 1, num_pts))], axis=1)
         return cam_coords
 
     @shape_check
@@ -3,10 +3,12 @@ import numpy as np
 import tensorflow as tf
 from tensorflow.keras import layers
 import cv2
+from timeit import default_timer as timer
 
 from config import opts
-from model.synthesize.synthesize_base import SynthesizeSingleScale, SynthesizeMultiScale
-from model.synthesize.bilinear_interp import BilinearInterpolation
+from model.synthesize.synthesize_base import SynthesizeSingleScale, SynthesizeMultiScale, SynthesizeMultiScaleLegacy, \
+    SynthesisRequest
+from model.synthesize.bilinear_interp import BilinearInterpolation, SAMPLE_METHODS
 from tfrecords.tfrecord_reader import TfrecordReader
 from model.model_util.augmentation import augmentation_factory
 import utils.convert_pose as cp
@@ -301,6 +303,170 @@ def test_reconstruct_bilinear_interp():
     print("!!! test reconstruct_bilinear_interp passed")
 
 
+def bilinear_interp_np(image, pixel_coords):
+    """
+    numpy reference of BilinearInterpolation, pixels whose neighbors are not all inside image are zero
+    :param image: [batch, numsrc, height, width, channel]
+    :param pixel_coords: (u, v) [batch, numsrc, 2, height*width]
+    :return: [batch, numsrc, height, width, channel]
+    """
+    batch, numsrc, height, width, channel = image.shape
+    recon = np.zeros((batch, numsrc, height*width, channel), dtype=np.float32)
+    for b in range(batch):
+        for n in range(numsrc):
+            for p in range(height*width):
+                u, v = pixel_coords[b, n, 0, p], pixel_coords[b, n, 1, p]
+                uf, vf = int(np.floor(u)), int(np.floor(v))
+                if uf < 0 or vf < 0 or uf + 1 > width - 1 or vf + 1 > height - 1:
+                    continue
+                du, dv = u - uf, v - vf
+                recon[b, n, p] = image[b, n, vf, uf] * (1 - du) * (1 - dv) + image[b, n, vf + 1, uf] * (1 - du) * dv \
+                                 + image[b, n, vf, uf + 1] * du * (1 - dv) + image[b, n, vf + 1, uf + 1] * du * dv
+    return recon.reshape((batch, numsrc, height, width, channel))
+
+
+def test_bilinear_sample_methods():
+    """
+    all sampling methods of BilinearInterpolation must match the numpy reference
+    """
+    print("\n===== start test_bilinear_sample_methods")
+    batch, numsrc, height, width = (2, 3, 6, 8)
+    image = np.random.uniform(-1, 1, (batch, numsrc, height, width, 3)).astype(np.float32)
+    # coordinates include out-of-image pixels
+    pixel_coords = np.random.uniform(-1.5, width + 0.5, (batch, numsrc, 2, height*width)).astype(np.float32)
+    pixel_coords[:, :, 1] = np.random.uniform(-1.5, height + 0.5, (batch, numsrc, height*width))
+    expected = bilinear_interp_np(image, pixel_coords)
+
+    for method in SAMPLE_METHODS:
+        # EXECUTE
+        recon = BilinearInterpolation(method)(tf.constant(image), tf.constant(pixel_coords))
+        print(f"{method}: max abs diff {np.max(np.abs(recon.numpy() - expected)):.6f}")
+        assert np.allclose(recon.numpy(), expected, atol=1e-5)
+    print("!!! test_bilinear_sample_methods passed")
+
+
+def test_bilinear_sample_speed(steps=20):
+    """
+    compare ms/step and measured peak memory of a forward and backward pass of sampling methods on CPU
+    """
+    print("\n===== start test_bilinear_sample_speed")
+    batch, numsrc, height, width = (4, 4, 128, 384)
+    image = tf.random.uniform((batch, numsrc, height, width, 3))
+    pixel_coords = tf.random.uniform((batch, numsrc, 2, height*width), 0, height)
+    with tf.device("/CPU:0"):
+        for method in SAMPLE_METHODS:
+            interp = BilinearInterpolation(method)
+
+            @tf.function
+            def sample(img, coords):
+                with tf.GradientTape() as tape:
+                    tape.watch(img)
+                    recon = interp(img, coords)
+                    loss = tf.reduce_sum(recon)
+                return recon, tape.gradient(loss, img)
+
+            sample(image, pixel_coords)
+            _, peak_mbytes = uf.measure_peak_memory(lambda: sample(image, pixel_coords)[1].numpy())
+            start = timer()
+            for _ in range(steps):
+                recon, grad = sample(image, pixel_coords)
+            grad.numpy()
+            peak_text = "n/a" if peak_mbytes is None else f"{peak_mbytes:.1f} MB"
+            print(f"[test_bilinear_sample_speed] {interp.method}: {(timer() - start) / steps * 1000.:.2f} ms/step, "
+                  f"peak memory {peak_text}")
+    print("!!! test_bilinear_sample_speed passed")
+
+
+def make_random_synthesis_inputs(batch=4, numsrc=4, height=128, width=384):
+    source_image = tf.random.uniform((batch, numsrc, height, width, 3), -1., 1.)
+    intrinsic = np.array([[width/2, 0, width/2], [0, width/2, height/2], [0, 0, 1]], dtype=np.float32)
+    intrinsic = tf.constant(np.tile(intrinsic[np.newaxis], (batch, 1, 1)))
+    depth = tf.random.uniform((batch, height, width, 1), 5., 20.)
+    depth_ms = uf.multi_scale_depths(depth, [1, 2, 4, 8])
+    pose = np.random.uniform(-0.05, 0.05, (batch, numsrc, 6)).astype(np.float32)
+    pose = tf.constant(pose)
+    return source_image, intrinsic, depth_ms, pose
+
+
+def test_fused_synthesis_equals_legacy():
+    """
+    fused multi-scale synthesis must reproduce the result of per-scale synthesis
+    """
+    print("\n===== start test_fused_synthesis_equals_legacy")
+    source_image, intrinsic, depth_ms, pose = make_random_synthesis_inputs()
+    # EXECUTE
+    synth_legacy_ms = SynthesizeMultiScaleLegacy()(source_image, intrinsic, depth_ms, pose)
+    synth_fused_ms = SynthesizeMultiScale()(source_image, intrinsic, depth_ms, pose)
+    # pose in matrix and precomputed pyramid give the same result
+    source_ms = SynthesizeMultiScale.make_pyramid(source_image, depth_ms)
+    pose_matr = cp.pose_rvec2matr_batch_tf(pose)
+    synth_reuse_ms = SynthesizeMultiScale()(source_image, intrinsic, depth_ms, pose_matr, source_ms)
+
+    for legacy, fused, reuse in zip(synth_legacy_ms, synth_fused_ms, synth_reuse_ms):
+        print("max abs diff:", np.max(np.abs(legacy.numpy() - fused.numpy())))
+        assert np.allclose(legacy.numpy(), fused.numpy(), atol=1e-3)
+        assert np.allclose(fused.numpy(), reuse.numpy(), atol=1e-5)
+    print("!!! test_fused_synthesis_equals_legacy passed")
+
+
+def test_synthesis_requests():
+    """
+    packed synthesis of temporal and stereo requests must reproduce separate synthesis of each request
+    """
+    print("\n===== start test_synthesis_requests")
+    source_image, intrinsic, depth_ms, pose = make_random_synthesis_inputs()
+    stereo_image = source_image[:, :1]
+    stereo_pose = tf.tile(tf.constant([[[[1, 0, 0, -0.5], [0, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]]]],
+                                      dtype=tf.float32), (stereo_image.get_shape()[0], 1, 1, 1))
+    synthesizer = SynthesizeMultiScale()
+    pose_matr = cp.pose_rvec2matr_batch_tf(pose)
+    requests = [SynthesisRequest("temporal", synthesizer.make_pyramid(source_image, depth_ms), pose_matr),
+                SynthesisRequest("stereo", synthesizer.make_pyramid(stereo_image, depth_ms), stereo_pose)]
+    # EXECUTE
+    synth_by_key = synthesizer.synthesize_requests(requests, intrinsic, depth_ms, source_image.get_shape()[2])
+    synth_temporal_ms = synthesizer(source_image, intrinsic, depth_ms, pose_matr)
+    synth_stereo_ms = synthesizer(stereo_image, intrinsic, depth_ms, stereo_pose)
+
+    for packed, separate in zip(synth_by_key["temporal"] + synth_by_key["stereo"], synth_temporal_ms + synth_stereo_ms):
+        assert packed.get_shape() == separate.get_shape()
+        assert np.allclose(packed.numpy(), separate.numpy(), atol=1e-5)
+    print("!!! test_synthesis_requests passed")
+
+
+def test_synthesis_speed(steps=20):
+    """
+    compare ms/step of legacy and fused synthesis
+    "fused+pyramid" reuses one source pyramid across three calls as TotalLoss does for L, R and stereo
+    """
+    print("\n===== start test_synthesis_speed")
+    source_image, intrinsic, depth_ms, pose = make_random_synthesis_inputs()
+    legacy = SynthesizeMultiScaleLegacy()
+    fused = SynthesizeMultiScale()
+
+    @tf.function
+    def run_legacy(image, intrin, depths, pose_vec):
+        return [legacy(image, intrin, depths, pose_vec) for _ in range(3)]
+
+    @tf.function
+    def run_fused(image, intrin, depths, pose_vec):
+        return [fused(image, intrin, depths, pose_vec) for _ in range(3)]
+
+    @tf.function
+    def run_fused_pyramid(image, intrin, depths, pose_vec):
+        source_ms = fused.make_pyramid(image, depths)
+        return [fused(image, intrin, depths, pose_vec, source_ms) for _ in range(3)]
+
+    for name, func in [("legacy", run_legacy), ("fused", run_fused), ("fused+pyramid", run_fused_pyramid)]:
+        # trace and warm up
+        func(source_image, intrinsic, depth_ms, pose)
+        start = timer()
+        for _ in range(steps):
+            synth_ms = func(source_image, intrinsic, depth_ms, pose)
+        synth_ms[-1][-1].numpy()
+        print(f"[test_synthesis_speed] {name}: {(timer() - start) / steps * 1000.:.2f} ms/step")
+    print("!!! test_synthesis_speed passed")
+
+
 def test_all():
     np.set_printoptions(precision=4, suppress=True, linewidth=100)
     test_synthesize_batch_multi_scale()
@@ -311,6 +477,11 @@ def test_all():
     # test_transform_to_source()
     # test_pixel_weighting()
     # test_reconstruct_bilinear_interp()
+    # test_fused_synthesis_equals_legacy()
+    # test_synthesis_requests()
+    # test_synthesis_speed()
+    # test_bilinear_sample_methods()
+    # test_bilinear_sample_speed()
 
 
 if __name__ == "__main__":
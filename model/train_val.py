@@ -1,22 +1,35 @@
 import tensorflow as tf
 import numpy as np
-import pandas as pd
-import time
+import os.path as op
 
 import utils.util_funcs as uf
 import utils.util_class as uc
 import evaluate.eval_utils as eu
-from model.model_util.distributer import DistributionStrategy, ReplicaOutputIntegrator
+from model.model_util.distributer import DistributionStrategy, ReplicaOutputIntegrator, local_replica_values
+import model.model_util.optimizers as optim
+import model.loss_and_metric.train_metrics as tm
+from model.model_util.metric_accumulator import MetricAccumulator
+from config import opts
 
 
-def train_val_factory(mode_sel, model, loss_object, steps_per_epoch, stereo, augmenter, optimizer):
+def train_val_factory(mode_sel, model, loss_object, steps_per_epoch, stereo, augmenter, optimizer,
+                      feature_signature=None):
+    """
+    :param feature_signature: {key: tf.TensorSpec} of features, step functions of graph mode are traced
+                              with this input signature, see tfrecord_reader.feature_signature()
+    """
     if mode_sel == "eager":
         trainer = ModelTrainer(model, loss_object, steps_per_epoch, stereo, augmenter, optimizer)
         validater = ModelValidater(model, loss_object, steps_per_epoch, stereo)
     elif mode_sel == "graph":
-        trainer = ModelTrainerGraph(model, loss_object, steps_per_epoch, stereo, augmenter, optimizer)
-        validater = ModelValidaterGraph(model, loss_object, steps_per_epoch, stereo)
-    elif mode_sel == "distributed":
+        trainer = ModelTrainerGraph(model, loss_object, steps_per_epoch, stereo, augmenter, optimizer,
+                                    feature_signature)
+        validater = ModelValidaterGraph(model, loss_object, steps_per_epoch, stereo, feature_signature)
+    elif mode_sel == "graph_xla":
+        trainer = ModelTrainerXla(model, loss_object, steps_per_epoch, stereo, augmenter, optimizer,
+                                  feature_signature)
+        validater = ModelValidaterXla(model, loss_object, steps_per_epoch, stereo, feature_signature)
+    elif mode_sel in ["distributed", "multi_worker"]:
         trainer = ModelTrainerDistrib(model, loss_object, steps_per_epoch, stereo, augmenter, optimizer)
         validater = ModelValidaterDistrib(model, loss_object, steps_per_epoch, stereo)
     else:
@@ -35,32 +48,134 @@ class TrainValBase:
         self.stereo = stereo
         self.optimizer = optimizer
         self.weights = None
+        # number of times that the step function is traced
+        self.trace_count = 0
+        # prefix of csv file of step metrics
+        self.log_name = "train_val"
+        # TrainingCheckpointer that saves checkpoints in the middle of epoch, only trainer has it
+        self.checkpointer = None
 
     def set_name(self, name):
         self.train_val_name = name
 
+    def set_checkpointer(self, checkpointer):
+        self.checkpointer = checkpointer
+
+    def is_update_boundary(self):
+        """
+        :return: whether all trained batches are applied to weights, i.e. checkpoint can be saved
+        """
+        return True
+
+    def flush_updates(self):
+        """
+        apply updates of trained batches that are not applied yet at the end of epoch
+        """
+        pass
+
+    def run_step_with_metrics(self, step_func, features):
+        """
+        metrics are computed by TF ops and read back to host only every LOG_STEPS steps
+        :return: preds, loss, loss_by_type and metrics {name: scalar tensor} of the batch
+        """
+        preds, loss, loss_by_type = step_func(features)
+        metrics = tm.compute_batch_metrics(features, preds, loss, loss_by_type)
+        return preds, loss, loss_by_type, metrics
+
+    def gather_outputs(self, preds, features):
+        """
+        :return: predictions and features of the whole batch as plain tensors, called only on inspection steps
+        """
+        return preds, features
+
+    def compile_step(self, step_func, input_signature=None, xla=False):
+        """
+        :param step_func: function that takes features and returns (preds, loss, loss_by_type)
+        :param input_signature: signature of features, the step is traced once if given
+        :param xla: compile the step by XLA
+        :return: step function compiled by tf.function
+        """
+        def traced_step(features):
+            # python code here runs only when the step is traced
+            self.trace_count += 1
+            print(f"\n[{self.train_val_name}] trace step function, trace count={self.trace_count}")
+            return self.run_step_with_metrics(step_func, features)
+
+        signature = None if input_signature is None else [input_signature]
+        return tf.function(traced_step, input_signature=signature, experimental_compile=xla)
+
+    def compile_xla_step(self, step_func, input_signature=None):
+        """
+        compile the whole step by XLA if networks have only XLA compatible ops,
+        otherwise, compile only the loss by XLA (tfa CorrelationCost of flownet has no XLA kernel)
+        if XLA compilation fails at the first step, it falls back to graph mode
+        """
+        graph_step = self.compile_step(step_func, input_signature)
+        if not has_xla_incompatible_ops(self.model):
+            xla_step = self.compile_step(step_func, input_signature, xla=True)
+            return XlaStepWithFallback(self.train_val_name, xla_step, graph_step)
+
+        print(f"[{self.train_val_name}] networks have ops that XLA cannot compile, only loss is compiled by XLA")
+        # trainer with gradient accumulation compiles two steps, loss is wrapped only once
+        if not isinstance(self.loss_object, XlaCompiledLoss):
+            self.loss_object = XlaCompiledLoss(self.loss_object)
+        plain_loss = self.loss_object.loss_object
+        # steps are traced lazily, so graph step traced after fallback uses the plain loss
+        xla_step = self.compile_step(step_func, input_signature)
+
+        def restore_loss():
+            self.loss_object = plain_loss
+        return XlaStepWithFallback(self.train_val_name, xla_step, graph_step, restore_loss)
+
     # tf.data.Dataset object is reusable after a full iteration, check test_reuse_dataset()
-    def run_an_epoch(self, dataset):
-        results = []
-        for step, features in enumerate(dataset):
-            start = time.time()
-            preds, loss, loss_by_type = self.run_a_batch(features)
-            batch_result, log_msg = merge_results(features, preds, loss, loss_by_type, self.stereo)
-            uf.print_progress_status(f"    {self.train_val_name} {step}/{self.steps_per_epoch} steps, {log_msg}, "
-                                     f"time={time.time() - start:1.4f}...")
-            inspect_model(preds, features, step, self.steps_per_epoch)
-            results.append(batch_result)
+    def run_an_epoch(self, dataset, epoch=0, start_step=0):
+        """
+        :param epoch: epoch index written in csv of step metrics
+        :param start_step: number of steps already trained in this epoch, which are skipped in dataset
+        :return: summary of metrics, dataframe of rows "mean" and quantiles (e.g. "q50") by metric columns
+        """
+        # metric tensors of steps that are not read back yet
+        step_metrics = []
+        trace_count_begin = self.trace_count
+        accumulator = MetricAccumulator(self.train_val_name, self.step_log_path(), opts.LOG_PERIOD, format_metrics)
+        accumulator.start(self.steps_per_epoch - start_step, epoch, start_step)
+        try:
+            for step, features in enumerate(dataset, start=start_step):
+                preds, loss, loss_by_type, metrics = self.run_a_batch(features)
+                step_metrics.append(metrics)
+                # read back metrics only every LOG_STEPS steps, console and csv are written by accumulator thread
+                if (step + 1) % opts.LOG_STEPS == 0:
+                    accumulator.add(read_step_metrics(step_metrics))
+                    step_metrics = []
+                if is_inspection_step(step, self.steps_per_epoch):
+                    inspect_model(*self.gather_outputs(preds, features))
+                # the last step of epoch is saved by end of epoch checkpoint
+                if (self.checkpointer is not None) and self.is_update_boundary() \
+                        and (step + 1 < self.steps_per_epoch):
+                    self.checkpointer.step_end(step + 1)
+            self.flush_updates()
+            accumulator.add(read_step_metrics(step_metrics))
+        finally:
+            accumulator.close()
 
         print("")
-        # list of dict -> dataframe -> mean: single row dataframe -> to_dict: dict of mean values
-        results = pd.DataFrame(results)
-        mean_results = results.mean(axis=0).to_dict()
-        print("results quantile:\n", results.loc[:, ["trjabs", "trjrel", "roterr", "deprel"]].quantile([0.5, 0.8, 0.9, 1.0]))
+        if self.trace_count > 0:
+            print(f"[{self.train_val_name}] step function traced {self.trace_count - trace_count_begin} times "
+                  f"in this epoch, {self.trace_count} times in total")
+        summary = accumulator.summary()
+        quantile_cols = [col for col in ["trjabs", "trjrel", "roterr", "deprel"] if col in summary]
+        print("results quantile:\n", summary.loc[["q50", "q80", "q90", "q100"], quantile_cols])
         message = f"[{self.train_val_name} Epoch MEAN], result: "
-        for key, val in mean_results.items():
+        for key, val in summary.loc["mean"].items():
             message += f"{key}={val:1.4f}, "
         print(message, "\n\n")
-        return results
+        return summary
+
+    def step_log_path(self):
+        # only chief writes logs in multi_worker mode
+        if not DistributionStrategy.is_chief():
+            return None
+        return op.join(opts.DATAPATH_CKP, opts.CKPT_NAME, f"{self.log_name}_steps.csv")
 
     def run_a_batch(self, features):
         raise NotImplementedError()
@@ -70,18 +185,58 @@ class ModelTrainer(TrainValBase):
     def __init__(self, model, loss_object, steps_per_epoch, stereo, augmenter, optimizer):
         super().__init__(model, loss_object, steps_per_epoch, stereo, augmenter, optimizer)
         self.set_name("Train (eager)")
+        self.log_name = "train"
+        # gradients of GRAD_ACCUM_STEPS micro-batches are accumulated and applied at once
+        self.accum_steps = max(opts.GRAD_ACCUM_STEPS, 1)
+        self.accum_count = 0
+        self.grad_accumulator = optim.create_gradient_accumulator(self.model.trainable_weights(), self.accum_steps)
+        self.step_funcs = self.make_step_funcs(
+            lambda step_func: (lambda features: self.run_step_with_metrics(step_func, features)))
+        # applies micro-batches left at the end of epoch, takes gradient scale
+        self.flush_step = self.apply_accumulated_step
+
+    def make_step_funcs(self, compile_func):
+        """
+        :param compile_func: function that takes a step function and returns a runnable step
+        :return: {"apply": step that applies gradients, "accumulate": step that only accumulates gradients}
+        """
+        if self.grad_accumulator is None:
+            return {"apply": compile_func(self.train_a_step)}
+        return {"accumulate": compile_func(self.accumulate_a_step),
+                "apply": compile_func(self.accumulate_and_apply_step)}
 
     def run_a_batch(self, features):
-        return self.train_a_step(features)
+        # micro-batch count is kept in python, so that no step has conditional apply_gradients in graph
+        self.accum_count += 1
+        if self.accum_count < self.accum_steps:
+            return self.step_funcs["accumulate"](features)
+        self.accum_count = 0
+        return self.step_funcs["apply"](features)
+
+    def is_update_boundary(self):
+        # accumulated gradients are not saved in checkpoints
+        return self.accum_count == 0
+
+    def flush_updates(self):
+        """
+        when steps_per_epoch is not a multiple of accum_steps, gradients of the left micro-batches are
+        applied at the end of epoch, so that they are not mixed into the first update of the next epoch
+        """
+        if self.accum_count == 0:
+            return
+        # accumulated gradients are divided by accum_steps, rescale them to the mean over the real count
+        scale = tf.constant(self.accum_steps / self.accum_count, dtype=tf.float32)
+        print(f"\n[{self.train_val_name}] apply gradients of the last {self.accum_count} micro-batches")
+        self.flush_step(scale)
+        self.accum_count = 0
+
+    def reset_accumulation(self):
+        self.accum_count = 0
+        if self.grad_accumulator is not None:
+            self.grad_accumulator.reset()
 
     def train_a_step(self, features):
-        features = self.augmenter(features)
-        with tf.GradientTape() as tape:
-            # preds = {"depth_ms": ..., "pose": ...} = model(image)
-            preds = self.model(features)
-            total_loss, loss_by_type = self.loss_object(preds, features)
-
-        grads = tape.gradient(total_loss, self.model.trainable_weights())
+        preds, total_loss, loss_by_type, grads = self.compute_gradients(features)
         self.optimizer.apply_gradients(zip(grads, self.model.trainable_weights()))
         """
         preds: {"pose": ..., "depth_ms":, ...}
@@ -90,15 +245,53 @@ class ModelTrainer(TrainValBase):
         """
         return preds, total_loss, loss_by_type
 
+    def accumulate_a_step(self, features):
+        preds, total_loss, loss_by_type, grads = self.compute_gradients(features)
+        self.grad_accumulator.accumulate(grads)
+        return preds, total_loss, loss_by_type
+
+    def accumulate_and_apply_step(self, features):
+        preds, total_loss, loss_by_type = self.accumulate_a_step(features)
+        self.optimizer.apply_gradients(zip(self.grad_accumulator.gradients(), self.model.trainable_weights()))
+        self.grad_accumulator.reset()
+        return preds, total_loss, loss_by_type
+
+    def apply_accumulated_step(self, scale):
+        grads = [grad * tf.cast(scale, grad.dtype) for grad in self.grad_accumulator.gradients()]
+        self.optimizer.apply_gradients(zip(grads, self.model.trainable_weights()))
+        self.grad_accumulator.reset()
+
+    def compute_gradients(self, features):
+        """
+        :return: preds, total_loss, loss_by_type and unscaled gradients of trainable weights
+        """
+        features = self.augmenter(features)
+        with tf.GradientTape() as tape:
+            # preds = {"depth_ms": ..., "pose": ...} = model(image)
+            preds = self.model(features)
+            total_loss, loss_by_type = self.loss_object(preds, features)
+            # loss is scaled up only with mixed_float16 policy
+            scaled_loss = optim.get_scaled_loss(self.optimizer, total_loss)
+
+        grads = tape.gradient(scaled_loss, self.model.trainable_weights())
+        grads = optim.get_unscaled_gradients(self.optimizer, grads)
+        return preds, total_loss, loss_by_type, grads
+
 
 class ModelTrainerGraph(ModelTrainer):
-    def __init__(self, model, loss_object, steps_per_epoch, stereo, augmenter, optimizer):
+    def __init__(self, model, loss_object, steps_per_epoch, stereo, augmenter, optimizer, feature_signature=None):
         super().__init__(model, loss_object, steps_per_epoch, stereo, augmenter, optimizer)
         self.set_name("Train (graph)")
+        self.step_funcs = self.make_step_funcs(lambda step_func: self.compile_step(step_func, feature_signature))
+        self.flush_step = tf.function(self.apply_accumulated_step)
 
-    @tf.function
-    def run_a_batch(self, features):
-        return self.train_a_step(features)
+
+class ModelTrainerXla(ModelTrainer):
+    def __init__(self, model, loss_object, steps_per_epoch, stereo, augmenter, optimizer, feature_signature=None):
+        super().__init__(model, loss_object, steps_per_epoch, stereo, augmenter, optimizer)
+        self.set_name("Train (graph_xla)")
+        self.step_funcs = self.make_step_funcs(lambda step_func: self.compile_xla_step(step_func, feature_signature))
+        self.flush_step = tf.function(self.apply_accumulated_step)
 
 
 class ModelTrainerDistrib(ModelTrainer):
@@ -107,21 +300,28 @@ class ModelTrainerDistrib(ModelTrainer):
         self.strategy = DistributionStrategy.get_strategy()
         self.replica_integrator = ReplicaOutputIntegrator()
         self.set_name("Train (distributed)")
+        # distributed features are not plain tensors, they are traced without signature
+        self.step_funcs = self.make_step_funcs(lambda step_func: self.compile_step(step_func))
+        # optimizer applies gradients only in replica context
+        self.flush_step = tf.function(
+            lambda scale: self.strategy.run(self.apply_accumulated_step, args=(scale,)))
+        self.predict_replicas = tf.function(lambda features: predict_replicas(self.strategy, self.model, features))
 
-    @tf.function
-    def run_a_batch(self, features):
-        per_replica_results = self.strategy.run(self.train_a_step, args=(features,))
-        per_replica_results = self.strategy.experimental_local_results(per_replica_results)
-        return self.replica_integrator(per_replica_results)
+    def run_step_with_metrics(self, step_func, features):
+        return run_replica_step_with_metrics(self.strategy, step_func, features)
+
+    def gather_outputs(self, preds, features):
+        return gather_replica_outputs(self.strategy, self.replica_integrator, self.predict_replicas, features)
 
 
 class ModelValidater(TrainValBase):
     def __init__(self, model, loss_object, steps_per_epoch, stereo):
         super().__init__(model, loss_object, steps_per_epoch, stereo)
         self.set_name("Validate (eager)")
+        self.log_name = "val"
 
     def run_a_batch(self, features):
-        return self.validate_a_step(features)
+        return self.run_step_with_metrics(self.validate_a_step, features)
 
     def validate_a_step(self, features):
         preds = self.model(features)
@@ -130,13 +330,17 @@ class ModelValidater(TrainValBase):
 
 
 class ModelValidaterGraph(ModelValidater):
-    def __init__(self, model, loss_object, steps_per_epoch, stereo):
+    def __init__(self, model, loss_object, steps_per_epoch, stereo, feature_signature=None):
         super().__init__(model, loss_object, steps_per_epoch, stereo)
         self.set_name("Validate (graph)")
+        self.run_a_batch = self.compile_step(self.validate_a_step, feature_signature)
 
-    @tf.function
-    def run_a_batch(self, features):
-        return self.validate_a_step(features)
+
+class ModelValidaterXla(ModelValidater):
+    def __init__(self, model, loss_object, steps_per_epoch, stereo, feature_signature=None):
+        super().__init__(model, loss_object, steps_per_epoch, stereo)
+        self.set_name("Validate (graph_xla)")
+        self.run_a_batch = self.compile_xla_step(self.validate_a_step, feature_signature)
 
 
 class ModelValidaterDistrib(ModelValidater):
@@ -145,12 +349,122 @@ class ModelValidaterDistrib(ModelValidater):
         self.set_name("Validate (distributed)")
         self.strategy = DistributionStrategy.get_strategy()
         self.replica_integrator = ReplicaOutputIntegrator()
+        self.run_a_batch = self.compile_step(self.validate_a_step)
+        self.predict_replicas = tf.function(lambda features: predict_replicas(self.strategy, self.model, features))
 
-    @tf.function
-    def run_a_batch(self, features):
-        per_replica_results = self.strategy.run(self.validate_a_step, args=(features,))
-        per_replica_results = self.strategy.experimental_local_results(per_replica_results)
-        return self.replica_integrator(per_replica_results)
+    def run_step_with_metrics(self, step_func, features):
+        return run_replica_step_with_metrics(self.strategy, step_func, features)
+
+    def gather_outputs(self, preds, features):
+        return gather_replica_outputs(self.strategy, self.replica_integrator, self.predict_replicas, features)
+
+
+def run_replica_step_with_metrics(strategy, step_func, features):
+    """
+    run step and compute metrics on each replica, then reduce only scalars across replicas
+    predictions stay on replicas, they are gathered by gather_replica_outputs() on demand
+    :return: empty predictions, loss, loss_by_type and metrics of the global batch
+    """
+    def replica_step(replica_features):
+        preds, loss, loss_by_type = step_func(replica_features)
+        metrics = tm.compute_batch_metrics(replica_features, preds, loss, loss_by_type)
+        return loss, loss_by_type, metrics
+
+    loss, loss_by_type, metrics = strategy.run(replica_step, args=(features,))
+    # losses of replicas are already divided by global batch size
+    loss = strategy.reduce(tf.distribute.ReduceOp.SUM, loss, axis=None)
+    loss_by_type = {key: strategy.reduce(tf.distribute.ReduceOp.SUM, value, axis=None)
+                    for key, value in loss_by_type.items()}
+    metrics = {key: strategy.reduce(tf.distribute.ReduceOp.MEAN, value, axis=None)
+               for key, value in metrics.items()}
+    metrics["loss"] = loss
+    metrics.update(loss_by_type)
+    return dict(), loss, loss_by_type, metrics
+
+
+def predict_replicas(strategy, model, features):
+    """
+    :return: list of predictions of local replicas
+    """
+    per_replica_preds = strategy.run(model, args=(features,))
+    return local_replica_values(strategy, per_replica_preds)
+
+
+def gather_replica_outputs(strategy, replica_integrator, predict_func, features):
+    """
+    :return: predictions and features of local replicas concatenated along batch axis
+    """
+    preds = replica_integrator.integrate_predictions(predict_func(features))
+    features = replica_integrator.integrate_predictions(local_replica_values(strategy, features))
+    return preds, features
+
+
+class XlaStepWithFallback:
+    """
+    runs XLA compiled step, if compilation fails at the first step, runs graph step from then on
+    errors after the first successful step are not caught
+    """
+    def __init__(self, name, xla_step, graph_step, on_fallback=None):
+        self.name = name
+        self.xla_step = xla_step
+        self.graph_step = graph_step
+        self.on_fallback = on_fallback
+        self.verified = False
+
+    def __call__(self, features):
+        if self.xla_step is None:
+            return self.graph_step(features)
+        if self.verified:
+            return self.xla_step(features)
+        try:
+            results = self.xla_step(features)
+            self.verified = True
+            return results
+        except (tf.errors.InvalidArgumentError, tf.errors.UnimplementedError, tf.errors.NotFoundError) as e:
+            print(f"\n[{self.name}] XLA compilation failed, fall back to graph mode: {type(e).__name__}: {e.message}")
+            self.xla_step = None
+            if self.on_fallback is not None:
+                self.on_fallback()
+            return self.graph_step(features)
+
+
+class XlaCompiledLoss:
+    """
+    wraps loss object to compute loss in an XLA compiled function
+    """
+    def __init__(self, loss_object):
+        self.loss_object = loss_object
+        self.compiled_loss = tf.function(loss_object.compute_loss, experimental_compile=True)
+
+    def __call__(self, predictions, features):
+        return self.compiled_loss(predictions, features)
+
+
+def has_xla_incompatible_ops(model):
+    # PWCNet uses tfa.layers.CorrelationCost, which is a custom op without XLA kernel
+    return "flownet" in model.models
+
+
+def read_step_metrics(step_metrics):
+    """
+    :param step_metrics: list of metrics {name: scalar tensor} of steps
+    :return: list of metrics {name: float} read back to host at once
+    """
+    if not step_metrics:
+        return []
+    keys = list(step_metrics[0].keys())
+    # [steps, metrics]
+    values = tf.stack([tf.stack([metrics[key] for key in keys]) for metrics in step_metrics]).numpy()
+    return [dict(zip(keys, step_values)) for step_values in values]
+
+
+def format_metrics(metrics):
+    log_msg = f"loss = {metrics['loss']:1.4f}"
+    if "trjabs" in metrics:
+        log_msg += f", pose_err={metrics['trjabs']:1.4f}, {metrics['trjrel']:1.4f}, {metrics['roterr']:1.4f}"
+    if "deprel" in metrics:
+        log_msg += f", depth_err={metrics['deprel']:1.4f}"
+    return log_msg
 
 
 def merge_results(features, preds, loss, loss_by_type, stereo):
@@ -232,21 +546,36 @@ def get_center_depths(features, preds):
     return mean_true, mean_pred
 
 
-def inspect_model(preds, features, step, steps_per_epoch):
-    stride = steps_per_epoch // 3
-    if step % stride > 0:
-        return
+def tensor_deciles(tensor, max_samples=100000):
+    """
+    deciles of a large tensor by TF ops on a strided subsample, only 9 values are copied to host
+    :return: 10%, 20%, ..., 90% quantiles in numpy
+    """
+    values = tf.reshape(tf.cast(tensor, tf.float32), [-1])
+    stride = max(values.shape[0] // max_samples, 1)
+    values = tf.sort(values[::stride])
+    count = values.shape[0]
+    indices = [min(int(round(quantile * (count - 1))), count - 1) for quantile in np.arange(0.1, 1, 0.1)]
+    return tf.gather(values, indices).numpy()
+
+
+def is_inspection_step(step, steps_per_epoch):
+    # three times in an epoch
+    stride = max(steps_per_epoch // 3, 1)
+    return step % stride == 0
+
 
+def inspect_model(preds, features):
     print("")
     if "depth_ms" in preds:
-        print("depth0 ", np.quantile(preds["depth_ms"][0].numpy(), np.arange(0.1, 1, 0.1)))
-        print("depth3 ", np.quantile(preds["depth_ms"][3].numpy(), np.arange(0.1, 1, 0.1)))
+        print("depth0 ", tensor_deciles(preds["depth_ms"][0]))
+        print("depth3 ", tensor_deciles(preds["depth_ms"][3]))
     if "debug_out" in preds:
-        print("upconv0", np.quantile(preds["debug_out"][0].numpy(), np.arange(0.1, 1, 0.1)))
-        print("upconv3", np.quantile(preds["debug_out"][1].numpy(), np.arange(0.1, 1, 0.1)))
+        print("upconv0", tensor_deciles(preds["debug_out"][0]))
+        print("upconv3", tensor_deciles(preds["debug_out"][1]))
     # flow: [batch, numsrc, height/4, width/4, 2] (4, 4, 32, 96, 2)
     if "flow_ms" in preds:
-        print("flow0  ", np.quantile(preds["flow_ms"][0].numpy(), np.arange(0.1, 1, 0.1)))
+        print("flow0  ", tensor_deciles(preds["flow_ms"][0]))
     # pose: [batch, numsrc, 6]
     if "pose" in preds:
         print("pose_pr", preds["pose"][0, 0, :3].numpy(), preds["pose"][0, 1, :3].numpy())
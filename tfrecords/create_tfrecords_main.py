@@ -5,6 +5,7 @@ import settings
 from config import opts
 import tfrecords.tfrecord_maker as tm
 from tfrecords.validation_maker import generate_validation_tfrecords
+from tfrecords.example_preview import previewer_factory
 
 
 def convert_to_tfrecords_directly():
@@ -19,14 +20,25 @@ def convert_to_tfrecords_directly():
 
             srcpath = opts.get_raw_data_path(dataset)
             tfrmaker = tfrecord_maker_factory(dataset, split, srcpath, tfrpath)
-            tfrmaker.make(opts.FRAME_PER_DRIVE, opts.TOTAL_FRAME_LIMIT)
+            previewer = create_previewer(tfrpath)
+            tfrmaker.make(opts.FRAME_PER_DRIVE, opts.TOTAL_FRAME_LIMIT, previewer)
+            if previewer is not None:
+                previewer.close()
 
         # create validation split from test or train dataset
         tfrpath = op.join(opts.DATAPATH_TFR, f"{dataset.split('__')[0]}_val")
         if op.isdir(tfrpath):
             print("[convert_to_tfrecords] tfrecord already created in", op.basename(tfrpath))
         else:
-            generate_validation_tfrecords(tfrpath, opts.VALIDATION_FRAMES)
+            previewer = create_previewer(tfrpath)
+            generate_validation_tfrecords(tfrpath, opts.VALIDATION_FRAMES, previewer)
+            if previewer is not None:
+                previewer.close()
+
+
+def create_previewer(tfrpath):
+    outpath = op.join(opts.DATAPATH_PRV, op.basename(tfrpath))
+    return previewer_factory(outpath, opts.PREVIEW_INTERVAL, opts.PREVIEW_MIN_PERIOD)
 
 
 def tfrecord_maker_factory(dataset, split, srcpath, tfrpath):
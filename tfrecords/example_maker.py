@@ -7,8 +7,10 @@ from tfrecords.readers.city_reader import CityscapesReader
 from tfrecords.readers.waymo_reader import WaymoReader
 from tfrecords.readers.driving_reader import DrivingStereoReader
 from tfrecords.readers.a2d2_reader import A2D2Reader
-from tfrecords.tfr_util import show_example, point_cloud_to_depth_map
+from tfrecords.tfr_util import point_cloud_to_depth_map, sparse_depth_to_depth_map
 from utils.util_class import MyExceptionToCatch
+from utils.convert_pose import pose_inverse_batch_np
+from config import opts
 
 
 class ExampleMaker:
@@ -20,9 +22,15 @@ class ExampleMaker:
         self.data_reader = WaymoReader()
         self.reader_args = reader_args
         self.max_frame_id = 0
+        self.drive_count = -1
+        # ExamplePreviewer to write sampled examples, None to disable preview
+        self.previewer = None
 
     def init_reader(self, drive_path):
+        if (self.data_reader.frame_cache is not None) and self.data_reader.frame_cache.misses > 0:
+            print("\n[ExampleMaker] frame cache of the last drive:", self.data_reader.frame_cache)
         self.data_reader = self.data_reader_factory()
+        self.drive_count += 1
         self.data_reader.init_drive(drive_path)
         if len(self.get_range()) > 0:
             self.max_frame_id = self.get_range()[-1]
@@ -35,9 +43,9 @@ class ExampleMaker:
         elif self.dataset.startswith("cityscapes"):
             return CityscapesReader(self.split, self.reader_args)   # split and ZipFile object
         elif self.dataset == "waymo":
-            return WaymoReader(self.split)
+            return WaymoReader(self.split, opts.FRAME_CACHE_MBYTES * 2**20)
         elif self.dataset == "a2d2":
-            return A2D2Reader(self.split, self.reader_args)
+            return A2D2Reader(self.split, self.reader_args, opts.FRAME_CACHE_MBYTES * 2**20)
         elif self.dataset == "driving_stereo":
             return DrivingStereoReader(self.split)
         else:
@@ -55,34 +63,28 @@ class ExampleMaker:
         example["image"], rawshape_hw, rszshape_hw = self.load_snippet_images(frame_seq_ids)
         if self.check_static_sequence(example):
             return dict()
-        example["intrinsic"] = self.load_intrinsic(frame_id, rawshape_hw, rszshape_hw)
+        calib = self.data_reader.get_calibration(frame_id)
+        calib.set_image_shape(rawshape_hw, rszshape_hw)
+        example["intrinsic"] = calib.get_intrinsic()
         if "depth_gt" in self.data_keys:
-            example["depth_gt"] = self.load_depth_map(frame_id, rawshape_hw, rszshape_hw)
+            example["depth_gt"] = self.load_depth_map(frame_id, calib, rszshape_hw)
         if "pose_gt" in self.data_keys:
             example["pose_gt"] = self.load_snippet_poses(frame_seq_ids)
         if "image_R" in self.data_keys:
             example["image_R"], _, _ = self.load_snippet_images(frame_seq_ids, right=True)
         if "intrinsic_R" in self.data_keys:
-            example["intrinsic_R"] = self.load_intrinsic(frame_id, rawshape_hw, rszshape_hw, right=True)
+            example["intrinsic_R"] = calib.get_intrinsic(right=True)
         if "depth_gt_R" in self.data_keys:
-            example["depth_gt_R"] = self.load_depth_map(frame_id, rawshape_hw, rszshape_hw, right=True)
+            example["depth_gt_R"] = self.load_depth_map(frame_id, calib, rszshape_hw, right=True)
         if "pose_gt_R" in self.data_keys:
             example["pose_gt_R"] = self.load_snippet_poses(frame_seq_ids, right=True)
         if "stereo_T_LR" in self.data_keys:
-            example["stereo_T_LR"] = self.data_reader.get_stereo_extrinsic(frame_id)
-
-        # if index % 500 == 10:
-        #     show_example(example, 0, print_param=True, max_height=0)
-        # elif index % 100 == 10:
-        #     show_example(example, 0)
+            example["stereo_T_LR"] = calib.stereo_T_LR
 
         example = self.crop_example(example, rszshape_hw)
-
-        if index % 500 == 10:
-            show_example(example, 200, print_param=True, max_height=0, suffix="_crop")
-        elif index % 100 == 10:
-            show_example(example, 200, max_height=0, suffix="_crop")
         example = self.verify_snippet(example)
+        if self.previewer is not None:
+            self.previewer.submit(example, f"drive{self.drive_count:03d}_{index:06d}")
         return example
 
     def make_snippet_ids(self, frame_index):
@@ -151,49 +153,40 @@ class ExampleMaker:
         else:
             return True
 
-    def load_intrinsic(self, index, rawshape_hw, rszshape_hw, right=False):
-        intrinsic_raw = self.data_reader.get_intrinsic(index, right=right)
-        if intrinsic_raw is None:
-            return None
-        intrinsic = intrinsic_raw.copy()
-        # scale fx, cx
-        intrinsic[0] = intrinsic[0] * rszshape_hw[1] / rawshape_hw[1]
-        # scale fy, cy
-        intrinsic[1] = intrinsic[1] * rszshape_hw[0] / rawshape_hw[0]
-        return intrinsic.astype(np.float32)
-
     def load_snippet_poses(self, frame_ids, right=False):
-        pose_seq = []
-        for fid in frame_ids:
-            pose = self.data_reader.get_pose(fid, right=right)
-            if pose is None:
-                return None
-            pose_seq.append(pose)
+        drive_poses = self.data_reader.get_drive_poses(right)
+        if drive_poses is not None:
+            # pose_seq: [snippet, 4, 4]
+            pose_seq = drive_poses[frame_ids]
+        else:
+            pose_seq = []
+            for fid in frame_ids:
+                pose = self.data_reader.get_pose(fid, right=right)
+                if pose is None:
+                    return None
+                pose_seq.append(pose)
+            pose_seq = np.stack(pose_seq, axis=0)
         target_index = self.shwc_shape[0] // 2
-        target_pose = pose_seq.pop(target_index)
+        target_pose = pose_seq[target_index]
+        source_poses = np.delete(pose_seq, target_index, axis=0)
         # poses that transform a point from target to source frame
-        pose_seq = [np.linalg.inv(pose) @ target_pose for pose in pose_seq]
-        pose_seq = np.stack(pose_seq, axis=0)
+        pose_seq = np.einsum("nij,jk->nik", pose_inverse_batch_np(source_poses), target_pose)
         return pose_seq.astype(np.float32)
 
-    def load_depth_map(self, index, rawshape_hw, rszshape_hw, right=False):
-        intrinsic = self.data_reader.get_intrinsic(index, right)
-        if intrinsic is None: return None
-        intrinsic_rsz = self.rescale_intrinsic(intrinsic, rawshape_hw, rszshape_hw)
+    def load_depth_map(self, index, calib, rszshape_hw, right=False):
+        intrinsic_rsz = calib.get_intrinsic(right)
+        if intrinsic_rsz is None: return None
+        # project depth points directly to the resized image if the reader has them
+        sparse_depth = self.data_reader.get_sparse_depth(index, right)
+        if sparse_depth is not None:
+            rows, cols, depths = sparse_depth
+            return sparse_depth_to_depth_map(rows, cols, depths, calib.rawshape_hw, rszshape_hw)
         point_cloud = self.data_reader.get_point_cloud(index, right)
         if point_cloud is None: return None
         depth_map = point_cloud_to_depth_map(point_cloud, intrinsic_rsz, rszshape_hw)
         # depth_map = self.data_reader.get_depth(index, rawshape_hw, rszshape_hw, intrinsic, right)
         return depth_map.astype(np.float32)
 
-    def rescale_intrinsic(self, intrinsic, rawshape_hw, rszshape_hw):
-        intrinsic_rsz = intrinsic.copy()
-        # rescale fx, cx
-        intrinsic_rsz[0] *= (rszshape_hw[1] / rawshape_hw[1])
-        # rescale fy, cy
-        intrinsic_rsz[1] *= (rszshape_hw[0] / rawshape_hw[0])
-        return intrinsic_rsz
-
     def verify_snippet(self, example):
         if self.dataset is "waymo":
             poses = example["pose_gt"]
@@ -282,7 +275,6 @@ class ExampleMaker:
 
 
 # ======================================================================
-from config import opts
 from utils.util_funcs import print_progress_status
 import os.path as op
 
@@ -0,0 +1,113 @@
+import os
+import os.path as op
+import threading
+import queue
+import numpy as np
+import cv2
+from timeit import default_timer as timer
+
+from tfrecords.tfr_util import apply_color_map
+from utils.convert_pose import pose_matr2rvec
+
+
+def previewer_factory(outpath, interval, min_period=0., max_height=0):
+    """
+    :param outpath: directory to write preview images
+    :param interval: write one preview every `interval` submitted examples, 0 disables preview
+    :param min_period: minimum time (sec) between two previews
+    :param max_height: resize contact sheet to this height if it is taller, 0 keeps original size
+    :return: ExamplePreviewer or None when preview is disabled
+    """
+    if interval <= 0:
+        return None
+    return ExamplePreviewer(outpath, interval, min_period, max_height)
+
+
+class ExamplePreviewer:
+    """
+    Writes sampled examples to disk as contact sheets in a background thread.
+    The conversion loop only counts examples and puts a sampled one in a bounded queue,
+    if the writer is busy, the sample is dropped instead of blocking the loop.
+    """
+    def __init__(self, outpath, interval, min_period=0., max_height=0, queue_size=4):
+        self.outpath = outpath
+        self.interval = interval
+        self.min_period = min_period
+        self.max_height = max_height
+        self.submit_count = 0
+        self.write_count = 0
+        self.drop_count = 0
+        self.last_time = None
+        self.queue = queue.Queue(maxsize=queue_size)
+        os.makedirs(outpath, exist_ok=True)
+        self.worker = threading.Thread(target=self.work, daemon=True)
+        self.worker.start()
+
+    def submit(self, example, name):
+        """
+        :param example: example dict of numpy arrays, it must not be modified after submission
+        :param name: file name (without extension) of preview
+        """
+        self.submit_count += 1
+        if self.submit_count % self.interval != 0:
+            return
+        curtime = timer()
+        if (self.last_time is not None) and (curtime - self.last_time < self.min_period):
+            return
+        self.last_time = curtime
+        try:
+            # shallow copy: arrays are shared, only the dict is copied
+            self.queue.put_nowait((name, dict(example)))
+        except queue.Full:
+            self.drop_count += 1
+
+    def close(self):
+        self.queue.put(None)
+        self.worker.join()
+        print(f"[ExamplePreviewer] {self.write_count} previews written to {self.outpath}, "
+              f"{self.drop_count} dropped")
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            name, example = item
+            try:
+                self.write_preview(example, name)
+                self.write_count += 1
+            except Exception as e:
+                # preview must not stop conversion
+                print(f"\n[ExamplePreviewer] failed to write {name}: {e}")
+
+    def write_preview(self, example, name):
+        sheet = make_contact_sheet(example)
+        if self.max_height and sheet.shape[0] > self.max_height:
+            dstsize_wh = (int(sheet.shape[1] * self.max_height / sheet.shape[0]), self.max_height)
+            sheet = cv2.resize(sheet, dstsize_wh)
+        cv2.imwrite(op.join(self.outpath, name + ".jpg"), sheet)
+
+        if "intrinsic" in example and example["intrinsic"] is not None:
+            with open(op.join(self.outpath, name + ".txt"), "w") as fw:
+                fw.write(f"intrinsic:\n{example['intrinsic']}\n")
+                if "pose_gt" in example and example["pose_gt"] is not None:
+                    fw.write(f"pose:\n{pose_matr2rvec(example['pose_gt'])}\n")
+
+
+def make_contact_sheet(example):
+    """
+    :param example: example dict with "image" [snippet*height, width, 3] and optionally
+                    "image_R", "depth_gt", "depth_gt_R" [height, width(, 1)]
+    :return: panels of example arranged horizontally [max panel height, sum of panel widths, 3]
+    """
+    panels = [example["image"]]
+    if "image_R" in example and example["image_R"] is not None:
+        panels.append(example["image_R"])
+    for key in ["depth_gt", "depth_gt_R"]:
+        if key in example and example[key] is not None:
+            panels.append(apply_color_map(example[key]))
+
+    sheet_height = max([panel.shape[0] for panel in panels])
+    panels = [np.pad(panel, ((0, sheet_height - panel.shape[0]), (0, 0), (0, 0))) for panel in panels]
+    sheet = np.concatenate(panels, axis=1).astype(np.uint8)
+    return sheet
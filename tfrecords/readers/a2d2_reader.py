@@ -8,8 +8,9 @@ import numpy as np
 import json
 import cv2
 
-from tfrecords.readers.reader_base import DataReaderBase
-from tfrecords.tfr_util import resize_depth_map, depth_map_to_point_cloud
+from tfrecords.readers.reader_base import DataReaderBase, DriveCalibration
+from tfrecords.readers.frame_cache import FrameCache, DEFAULT_CACHE_BYTES
+from tfrecords.tfr_util import sparse_depth_to_depth_map
 from utils.util_funcs import print_progress_status
 
 
@@ -53,12 +54,12 @@ def convert_tar_to_vanilla_zip():
 
 
 class A2D2Reader(DataReaderBase):
-    def __init__(self, split="", reader_arg=None):
+    def __init__(self, split="", reader_arg=None, cache_bytes=DEFAULT_CACHE_BYTES):
         super().__init__(split)
         self.zip_files = dict()
-        self.frame_buffer = dict()
+        self.frame_cache = FrameCache(cache_bytes, "A2D2Reader")
         self.sensor_config = SensorConfig("")
-        self.latest_index = 0
+        self.calib = None
 
     """
     Public methods used outside this class
@@ -71,6 +72,9 @@ class A2D2Reader(DataReaderBase):
         configfile = op.join(op.dirname(self.zip_files["camera_left"].filename), "cams_lidars.json")
         print("[A2D2Reader] sensor config file:", configfile)
         self.sensor_config = SensorConfig(configfile)
+        self.calib = DriveCalibration(self.sensor_config.get_cam_matrix("front_left"),
+                                      self.sensor_config.get_cam_matrix("front_right"),
+                                      self.sensor_config.get_stereo_extrinsic())
         self.frame_names = self.zip_files["camera_left"].namelist()
         self.frame_names = [name for name in self.frame_names if name.endswith(".png")]
         self.frame_names.sort()
@@ -100,56 +104,52 @@ class A2D2Reader(DataReaderBase):
 
     def get_point_cloud(self, index, right=False):
         intrinsic = self.get_intrinsic(index, right)
-        key = "depth_gt_R" if right else "depth_gt"
-        depth_map = self.get_frame_data(index, key)
-        assert (intrinsic.shape == (3, 3)) and (depth_map.ndim == 2), f"[A2D2.get_point_cloud] {intrinsic}, {depth_map.shape}"
-        point_cloud = depth_map_to_point_cloud(depth_map, intrinsic)
+        rows, cols, depths = self.get_sparse_depth(index, right)
+        valid = depths > 0.1
+        rows, cols, Z = rows[valid], cols[valid], depths[valid]
+        # X = (u - cx) / fx * Z
+        X = (cols - intrinsic[0, 2]) / intrinsic[0, 0] * Z
+        # Y = (v - cy) / fy * Z
+        Y = (rows - intrinsic[1, 2]) / intrinsic[1, 1] * Z
+        point_cloud = np.stack([X, Y, Z], axis=1)
         return point_cloud
 
-    def get_depth(self, index, srcshape_hw, dstshape_hw, intrinsic, right=False):
+    def get_sparse_depth(self, index, right=False):
         key = "depth_gt_R" if right else "depth_gt"
-        depth_map = self.get_frame_data(index, key)
+        return self.get_frame_data(index, key)
+
+    def get_depth(self, index, srcshape_hw, dstshape_hw, intrinsic, right=False):
+        rows, cols, depths = self.get_sparse_depth(index, right)
         srcshape_hw = self.sensor_config.get_resolution_hw("front_left")
-        return resize_depth_map(depth_map, srcshape_hw, dstshape_hw)
+        return sparse_depth_to_depth_map(rows, cols, depths, srcshape_hw, dstshape_hw)
 
     def get_intrinsic(self, index=0, right=False):
-        key = "intrinsic_R" if right else "intrinsic"
-        return self.get_frame_data(index, key)
+        # loaded in init_drive()
+        return self.calib.get_intrinsic(right, resized=False)
 
     def get_stereo_extrinsic(self, index=0):
-        return self.get_frame_data(index, "stereo_T_LR")
+        # loaded in init_drive()
+        return self.calib.stereo_T_LR
+
+    def get_calibration(self, index=0):
+        # loaded in init_drive()
+        return self.calib
 
     """
     Private methods used inside this class
     """
     def get_frame_data(self, index, key):
-        # use loaded frame
-        if index in self.frame_buffer:
-            return self.frame_buffer[index][key]
-
-        # add new frame
-        frame_data = dict()
-        frame_data["image"] = self._read_image(index)
-        frame_data["intrinsic"] = self.sensor_config.get_cam_matrix("front_left")
-        frame_data["depth_gt"] = self._read_depth_map(index)
-        frame_data["image_R"] = self._read_image(index, right=True)
-        frame_data["intrinsic_R"] = self.sensor_config.get_cam_matrix("front_right")
-        frame_data["depth_gt_R"] = self._read_depth_map(index, right=True)
-        frame_data["stereo_T_LR"] = self.sensor_config.get_stereo_extrinsic()
-        self.frame_buffer[index] = frame_data
-
-        # remove old frames
-        if self.latest_index < index:
-            self.latest_index = index
-        indices_pop = []
-        for frame_idx in self.frame_buffer:
-            if frame_idx < self.latest_index - 20:
-                indices_pop.append(frame_idx)
-        for frame_idx in indices_pop:
-            self.frame_buffer.pop(frame_idx)
-
-        # return requested data
-        return self.frame_buffer[index][key]
+        # decode only the requested field and keep it in LRU cache
+        if key == "image":
+            return self.frame_cache.get(index, key, lambda: self._read_image(index))
+        elif key == "image_R":
+            return self.frame_cache.get(index, key, lambda: self._read_image(index, right=True))
+        elif key == "depth_gt":
+            return self.frame_cache.get(index, key, lambda: self._read_depth_points(index))
+        elif key == "depth_gt_R":
+            return self.frame_cache.get(index, key, lambda: self._read_depth_points(index, right=True))
+        else:
+            assert 0, f"[A2D2Reader.get_frame_data] invalid key: {key}"
 
     def _read_image(self, index, right=False):
         """
@@ -170,7 +170,10 @@ class A2D2Reader(DataReaderBase):
         # image = self.sensor_config.undistort_image(image, cam_dir)
         return image
 
-    def _read_depth_map(self, index, right=False):
+    def _read_depth_points(self, index, right=False):
+        """
+        :return: (rows, cols, depths) of LiDAR points projected onto image [N] each, float32
+        """
         image_name = self.frame_names[index]
         if right:
             image_name = image_name.replace("frontleft", "frontright").replace("front_left", "front_right")
@@ -178,21 +181,17 @@ class A2D2Reader(DataReaderBase):
         lidar_key = "lidar_right" if right else "lidar_left"
         npzfile = self.zip_files[lidar_key].open(npz_name)
         npzfile = np.load(npzfile)
-        lidar_row = (npzfile["pcloud_attr.row"] + 0.5).astype(np.int32)
-        lidar_col = (npzfile["pcloud_attr.col"] + 0.5).astype(np.int32)
-        lidar_depth = npzfile["pcloud_attr.depth"]
+        lidar_row = npzfile["pcloud_attr.row"].astype(np.float32)
+        lidar_col = npzfile["pcloud_attr.col"].astype(np.float32)
+        lidar_depth = npzfile["pcloud_attr.depth"].astype(np.float32)
         camera_key = "front_right" if right else "front_left"
         imsize_hw = self.sensor_config.get_resolution_hw(camera_key)
 
-        assert (lidar_row >= 0).all() and (lidar_row < imsize_hw[0]).all(), \
-            f"wrong index: {lidar_row[lidar_row >= 0]}, {lidar_row[lidar_row < imsize_hw[0]]}"
-        assert (lidar_col >= 0).all() and (lidar_col < imsize_hw[1]).all(), \
-            f"wrong index: {lidar_col[lidar_col >= 0]}, {lidar_col[lidar_col < imsize_hw[1]]}"
-
-        depth_map = np.zeros(imsize_hw, dtype=np.float32)
-        depth_map[lidar_row, lidar_col] = lidar_depth
-        # depth is supposed to have shape [H, W]
-        return depth_map
+        assert (lidar_row >= -0.5).all() and (lidar_row < imsize_hw[0] - 0.5).all(), \
+            f"wrong index: {lidar_row[lidar_row < -0.5]}, {lidar_row[lidar_row >= imsize_hw[0] - 0.5]}"
+        assert (lidar_col >= -0.5).all() and (lidar_col < imsize_hw[1] - 0.5).all(), \
+            f"wrong index: {lidar_col[lidar_col < -0.5]}, {lidar_col[lidar_col >= imsize_hw[1] - 0.5]}"
+        return lidar_row, lidar_col, lidar_depth
 
 
 class SensorConfig:
@@ -311,7 +310,7 @@ class SensorConfig:
 
 
 # ======================================================================
-from tfrecords.tfr_util import apply_color_map
+from tfrecords.tfr_util import apply_color_map, resize_depth_map
 
 
 def test_read_npz():
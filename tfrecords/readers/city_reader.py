@@ -4,7 +4,7 @@ from PIL import Image
 import json
 from utils.util_class import MyExceptionToCatch
 
-from tfrecords.readers.reader_base import DataReaderBase
+from tfrecords.readers.reader_base import DataReaderBase, DriveCalibration
 from tfrecords.tfr_util import resize_depth_map, depth_map_to_point_cloud
 
 # pre-crop range to remove vehicle and blurred region in images [sy, ey, sx, ex]
@@ -18,6 +18,9 @@ class CityscapesReader(DataReaderBase):
         self.camera_names = []
         self.cur_camera_param = dict()
         self.cur_camera_index = -1
+        self.cur_camera_file = ""
+        # calibrations of sub-drives indexed by camera file name
+        self.calib_buffer = dict()
         self.target_indices = []
 
     """
@@ -31,6 +34,7 @@ class CityscapesReader(DataReaderBase):
         self.camera_names = self.zip_files["camera"].namelist()
         self.frame_names = [frame for frame in self.frame_names if frame.startswith(drive_path)]
         self.frame_names.sort()
+        self.calib_buffer = dict()
 
     def num_frames_(self):
         return len(self.target_indices)
@@ -125,6 +129,15 @@ class CityscapesReader(DataReaderBase):
         stereo_T_LR = np.array([[1, 0, 0, baseline], [0, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]])
         return stereo_T_LR.astype(np.float32)
 
+    def get_calibration(self, index=0):
+        # calibration is constant within a sub-drive that shares a camera file
+        self._get_camera_param(index)
+        if self.cur_camera_file not in self.calib_buffer:
+            self.calib_buffer[self.cur_camera_file] = \
+                DriveCalibration(self.get_intrinsic(index), self.get_intrinsic(index, right=True),
+                                 self.get_stereo_extrinsic(index))
+        return self.calib_buffer[self.cur_camera_file]
+
     """
     Private methods used inside this class
     """
@@ -145,6 +158,7 @@ class CityscapesReader(DataReaderBase):
         param = json.loads(contents)
         self.cur_camera_param = param
         self.cur_camera_index = index
+        self.cur_camera_file = filename
         return param
 
 
@@ -4,7 +4,7 @@ from glob import glob
 from PIL import Image
 import zipfile
 
-from tfrecords.readers.reader_base import DataReaderBase
+from tfrecords.readers.reader_base import DataReaderBase, DriveCalibration
 from tfrecords.tfr_util import resize_depth_map, apply_color_map
 
 
@@ -15,6 +15,7 @@ class DrivingStereoReader(DataReaderBase):
         self.intrinsic = np.array(0)
         self.intrinsic_R = np.array(0)
         self.stereo_T_LR = np.array(0)
+        self.calib = None
 
     """
     Public methods used outside this class
@@ -38,6 +39,7 @@ class DrivingStereoReader(DataReaderBase):
                                np.array([[0, 0, 0, 1]], dtype=np.float32)], axis=0)
         self.stereo_T_LR = np.linalg.inv(T_RL)
         # print("stereo_T_LR:\n", self.stereo_T_LR)
+        self.calib = DriveCalibration(self.intrinsic, self.intrinsic_R, self.stereo_T_LR)
 
     def _load_zip_files(self, drive_path):
         zip_files = dict()
@@ -96,12 +98,15 @@ class DrivingStereoReader(DataReaderBase):
 
     def get_intrinsic(self, index=0, right=False):
         # loaded in init_drive()
-        intrinsic = self.intrinsic_R if right else self.intrinsic
-        return intrinsic.copy()
+        return self.calib.get_intrinsic(right, resized=False)
 
     def get_stereo_extrinsic(self, index=0):
         # loaded in init_drive()
-        return self.stereo_T_LR.copy()
+        return self.calib.stereo_T_LR
+
+    def get_calibration(self, index=0):
+        # loaded in init_drive()
+        return self.calib
 
 
 # ======================================================================
@@ -0,0 +1,117 @@
+from collections import OrderedDict
+import numpy as np
+
+DEFAULT_CACHE_BYTES = 512 * 2**20
+
+
+class FrameCache:
+    """
+    LRU cache of decoded frame fields, indexed by (frame index, field key) and bounded by total bytes.
+    Readers load only the fields that are requested, so the cache holds nothing more than needed.
+    """
+    def __init__(self, byte_budget=DEFAULT_CACHE_BYTES, name="FrameCache"):
+        self.byte_budget = byte_budget
+        self.name = name
+        self.items = OrderedDict()
+        self.nbytes = 0
+        self.peak_nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, index, key, loader):
+        """
+        :param index: frame index
+        :param key: field name
+        :param loader: function without argument that loads the field when it is not cached
+        :return: cached or loaded field
+        """
+        item_key = (index, key)
+        if item_key in self.items:
+            self.items.move_to_end(item_key)
+            self.hits += 1
+            return self.items[item_key][0]
+
+        self.misses += 1
+        value = loader()
+        self.put(item_key, value)
+        return value
+
+    def put(self, item_key, value):
+        nbytes = count_bytes(value)
+        if nbytes > self.byte_budget:
+            # too large to cache
+            return
+        self.pop(item_key)
+        while self.items and (self.nbytes + nbytes > self.byte_budget):
+            _, (_, old_nbytes) = self.items.popitem(last=False)
+            self.nbytes -= old_nbytes
+            self.evictions += 1
+        self.items[item_key] = (value, nbytes)
+        self.nbytes += nbytes
+        self.peak_nbytes = max(self.peak_nbytes, self.nbytes)
+
+    def pop(self, item_key):
+        if item_key in self.items:
+            _, nbytes = self.items.pop(item_key)
+            self.nbytes -= nbytes
+
+    def clear(self):
+        self.items.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return {"items": len(self.items), "MB": self.nbytes / 2**20, "peak_MB": self.peak_nbytes / 2**20,
+                "budget_MB": self.byte_budget / 2**20, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions}
+
+    def __str__(self):
+        stats = self.stats()
+        return f"[{self.name}] items={stats['items']}, size={stats['MB']:.1f}/{stats['budget_MB']:.1f}MB, " \
+               f"peak={stats['peak_MB']:.1f}MB, hits={stats['hits']}, misses={stats['misses']}, " \
+               f"evictions={stats['evictions']}"
+
+
+def count_bytes(value):
+    if value is None:
+        return 0
+    elif isinstance(value, np.ndarray):
+        return value.nbytes
+    elif isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    elif isinstance(value, (tuple, list)):
+        return sum([count_bytes(item) for item in value])
+    elif isinstance(value, dict):
+        return sum([count_bytes(item) for item in value.values()])
+    else:
+        return np.asarray(value).nbytes
+
+
+# ======================================================================
+
+def test_frame_cache():
+    print("\n===== start test_frame_cache")
+    frame_bytes = 2**20
+    cache = FrameCache(byte_budget=frame_bytes * 3, name="TestCache")
+    load_count = [0]
+
+    def loader():
+        load_count[0] += 1
+        return np.zeros(frame_bytes, dtype=np.uint8)
+
+    for index in range(5):
+        cache.get(index, "image", loader)
+    # only the last three frames remain
+    assert [index for index, key in cache.items] == [2, 3, 4]
+    assert cache.nbytes <= cache.byte_budget
+    cache.get(3, "image", loader)
+    assert load_count[0] == 5 and cache.hits == 1 and cache.evictions == 2
+    # frame 3 is most recently used, so frame 2 is evicted first
+    cache.get(5, "image", loader)
+    assert [index for index, key in cache.items] == [4, 3, 5]
+    print(cache)
+    print("!!! test_frame_cache passed")
+
+
+if __name__ == "__main__":
+    test_frame_cache()
@@ -4,8 +4,9 @@ from glob import glob
 import pykitti
 from collections import Counter
 
-from tfrecords.readers.reader_base import DataReaderBase
+from tfrecords.readers.reader_base import DataReaderBase, DriveCalibration
 from tfrecords.tfr_util import apply_color_map
+from utils.convert_pose import pose_inverse_batch_np
 
 
 class KittiRawReader(DataReaderBase):
@@ -17,6 +18,9 @@ class KittiRawReader(DataReaderBase):
         self.intrinsic = np.array(0)
         self.intrinsic_R = np.array(0)
         self.stereo_T_LR = np.array(0)
+        self.calib = None
+        self.poses = np.array(0)
+        self.poses_R = np.array(0)
         self.cur_images = np.array(0)
         self.cur_image_index = -1
 
@@ -35,6 +39,8 @@ class KittiRawReader(DataReaderBase):
         self.intrinsic = self._init_intrinsic()
         self.intrinsic_R = self._init_intrinsic(right=True)
         self.stereo_T_LR = self._init_extrinsic()
+        self.calib = DriveCalibration(self.intrinsic, self.intrinsic_R, self.stereo_T_LR)
+        self.poses, self.poses_R = self._init_poses()
         print("[KittiRawReader.init_drive] stereo_T_LR:\n", self.stereo_T_LR)
 
     def num_frames_(self):
@@ -55,15 +61,13 @@ class KittiRawReader(DataReaderBase):
         return image
 
     def get_pose(self, index, right=False):
-        T_w_imu = self.drive_loader.oxts[index].T_w_imu
-        T_imu_cam2 = np.linalg.inv(self.drive_loader.calib.T_cam2_imu)
-        T_w_cam2 = np.dot(T_w_imu, T_imu_cam2)
-        if right:
-            T_cam2_cam3 = self.stereo_T_LR
-            T_w_cam3 = np.dot(T_w_cam2, T_cam2_cam3)
-            return T_w_cam3.astype(np.float32)
-        else:
-            return T_w_cam2.astype(np.float32)
+        # loaded in init_drive()
+        pose = self.poses_R[index] if right else self.poses[index]
+        return pose.astype(np.float32)
+
+    def get_drive_poses(self, right=False):
+        # loaded in init_drive()
+        return self.poses_R if right else self.poses
 
     def get_point_cloud(self, index, right=False):
         if index >= len(self.drive_loader.velo_files):
@@ -105,12 +109,15 @@ class KittiRawReader(DataReaderBase):
 
     def get_intrinsic(self, index=0, right=False):
         # loaded in init_drive()
-        intrinsic = self.intrinsic_R if right else self.intrinsic
-        return intrinsic.copy().astype(np.float32)
+        return self.calib.get_intrinsic(right, resized=False)
 
     def get_stereo_extrinsic(self, index=0):
         # loaded in init_drive()
-        return self.stereo_T_LR.copy().astype(np.float32)
+        return self.calib.stereo_T_LR
+
+    def get_calibration(self, index=0):
+        # loaded in init_drive()
+        return self.calib
 
     """
     Private methods used inside this class
@@ -184,6 +191,15 @@ class KittiRawReader(DataReaderBase):
         T_cam2_cam3 = np.dot(cal.T_cam2_velo, np.linalg.inv(cal.T_cam3_velo))
         return T_cam2_cam3
 
+    def _init_poses(self):
+        # T_w_imu: [N, 4, 4] poses of all frames in the drive
+        T_w_imu = np.stack([oxts.T_w_imu for oxts in self.drive_loader.oxts], axis=0)
+        T_imu_cam2 = pose_inverse_batch_np(self.drive_loader.calib.T_cam2_imu)
+        T_w_cam2 = np.matmul(T_w_imu, T_imu_cam2)
+        # T_cam2_cam3 = self.stereo_T_LR
+        T_w_cam3 = np.matmul(T_w_cam2, self.stereo_T_LR)
+        return T_w_cam2, T_w_cam3
+
 
 def generate_depth_map(velo_data, T_cam_velo, K_cam, orig_shape, target_shape):
     # remove all velodyne points behind image plane (approximation)
@@ -250,7 +266,9 @@ class KittiOdomReader(DataReaderBase):
         self.intrinsic = np.array(0)
         self.intrinsic_R = np.array(0)
         self.poses = np.array(0)
+        self.poses_R = np.array(0)
         self.stereo_T_LR = np.array(0)
+        self.calib = None
         self.cur_images = np.array(0)
         self.cur_image_index = -1
 
@@ -270,11 +288,14 @@ class KittiOdomReader(DataReaderBase):
         frame_ids = self._list_frame_ids(drive_path_)
         self.target_frame_ids = frame_ids
         print("[KittiOdomReader.init_drive] frame_ids:", len(frame_ids), frame_ids[:5], frame_ids[-5:])
-        if self.split != "train":
-            self.poses = self._load_poses(drive_id)     # (N, 4, 4) pose matrices
         self.intrinsic = self._init_intrinsic()
         self.intrinsic_R = self._init_intrinsic(right=True)
         self.stereo_T_LR = self._init_extrinsic()
+        self.calib = DriveCalibration(self.intrinsic, self.intrinsic_R, self.stereo_T_LR)
+        if self.split != "train":
+            self.poses = self._load_poses(drive_id)     # (N, 4, 4) pose matrices
+            # T_cam2_cam3 = self.stereo_T_LR
+            self.poses_R = np.matmul(self.poses, self.stereo_T_LR)
         print("[KittiRawReader.init_drive] stereo_T_LR:\n", self.stereo_T_LR)
 
     def num_frames_(self):
@@ -297,14 +318,15 @@ class KittiOdomReader(DataReaderBase):
     def get_pose(self, index, right=False):
         if self.split == "train":
             return None
+        # loaded in init_drive()
+        pose = self.poses_R[index] if right else self.poses[index]
+        return pose.astype(np.float32)
 
-        T_w_cam2 = self.poses[index]
-        if right:
-            T_cam2_cam3 = self.stereo_T_LR
-            T_w_cam3 = np.dot(T_w_cam2, T_cam2_cam3)
-            return T_w_cam3.astype(np.float32)
-        else:
-            return T_w_cam2.astype(np.float32)
+    def get_drive_poses(self, right=False):
+        if self.split == "train":
+            return None
+        # loaded in init_drive()
+        return self.poses_R if right else self.poses
 
     def get_point_cloud(self, index, right=False):
         return None
@@ -314,12 +336,15 @@ class KittiOdomReader(DataReaderBase):
 
     def get_intrinsic(self, index=0, right=False):
         # loaded in init_drive()
-        intrinsic = self.intrinsic_R if right else self.intrinsic
-        return intrinsic.copy().astype(np.float32)
+        return self.calib.get_intrinsic(right, resized=False)
 
     def get_stereo_extrinsic(self, index=0):
         # loaded in init_drive()
-        return self.stereo_T_LR.copy().astype(np.float32)
+        return self.calib.stereo_T_LR
+
+    def get_calibration(self, index=0):
+        # loaded in init_drive()
+        return self.calib
 
     """
     Private methods used inside this class
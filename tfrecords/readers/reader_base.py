@@ -1,3 +1,5 @@
+import numpy as np
+
 
 class DataReaderBase:
     def __init__(self, split):
@@ -8,6 +10,8 @@ class DataReaderBase:
         self.frame_names = []
         self.intrinsic = None
         self.T_left_right = None
+        # FrameCache of readers that buffer decoded frames
+        self.frame_cache = None
 
     """
     Public methods used outside this class
@@ -43,12 +47,26 @@ class DataReaderBase:
         """
         raise NotImplementedError()
 
+    def get_drive_poses(self, right=False):
+        """
+        :return: poses of all frames in the drive [N, 4, 4] indexed by frame id, computed in init_drive()
+                 None if the reader cannot provide poses of the whole drive in advance
+        """
+        return None
+
     def get_point_cloud(self, index, right=False):
         """
         :return: point cloud in standard camera frame (X=right, Y=down, Z=front)
         """
         raise NotImplementedError()
 
+    def get_sparse_depth(self, index, right=False):
+        """
+        :return: (rows, cols, depths) of depth points in raw image coordinates [N] each,
+                 None if the reader provides depth only as point cloud or dense map
+        """
+        return None
+
     def get_depth(self, index, srcshape_hw, dstshape_hw, intrinsic, right=False):
         """
         :return: indexed pose in a vector [position, quaternion] in the current sequence
@@ -67,6 +85,14 @@ class DataReaderBase:
         """
         raise NotImplementedError()
 
+    def get_calibration(self, index=0):
+        """
+        :return: DriveCalibration of the indexed frame
+        readers whose calibration is constant in a drive should create it in init_drive() and return it
+        """
+        return DriveCalibration(self.get_intrinsic(index), self.get_intrinsic(index, right=True),
+                                self.get_stereo_extrinsic(index))
+
     def get_filename(self, index):
         """
         :return: indexed frame file name
@@ -81,3 +107,84 @@ class DataReaderBase:
         return index
 
 
+
+
+class DriveCalibration:
+    """
+    Camera calibration shared by all frames of a drive.
+    Raw parameters are verified and frozen once, resized intrinsics and projection matrices are
+    recomputed only when image shapes change, so per-frame code reads them without copying.
+    Arrays are read-only, copy them before modification.
+    """
+    def __init__(self, intrinsic, intrinsic_R=None, stereo_T_LR=None):
+        self.intrinsic = self.verify_intrinsic(intrinsic)
+        self.intrinsic_R = self.verify_intrinsic(intrinsic_R)
+        self.stereo_T_LR = self.verify_extrinsic(stereo_T_LR)
+        self.rawshape_hw = None
+        self.rszshape_hw = None
+        self.intrinsic_rsz = None
+        self.intrinsic_R_rsz = None
+        # projection matrices [3, 4] from left camera frame to resized left/right images
+        self.proj_matrix = None
+        self.proj_matrix_R = None
+
+    def set_image_shape(self, rawshape_hw, rszshape_hw):
+        rawshape_hw, rszshape_hw = tuple(rawshape_hw), tuple(rszshape_hw)
+        if (rawshape_hw == self.rawshape_hw) and (rszshape_hw == self.rszshape_hw):
+            return
+        self.rawshape_hw, self.rszshape_hw = rawshape_hw, rszshape_hw
+        self.intrinsic_rsz = self.rescale_intrinsic(self.intrinsic, rawshape_hw, rszshape_hw)
+        self.intrinsic_R_rsz = self.rescale_intrinsic(self.intrinsic_R, rawshape_hw, rszshape_hw)
+        self.proj_matrix = frozen(np.dot(self.intrinsic_rsz, np.eye(3, 4)))
+        if (self.intrinsic_R_rsz is not None) and (self.stereo_T_LR is not None):
+            # stereo_T_LR transforms points in right frame into left frame, its inverse does the opposite
+            T_RL = np.linalg.inv(self.stereo_T_LR)
+            self.proj_matrix_R = frozen(np.dot(self.intrinsic_R_rsz, T_RL[:3]))
+        else:
+            self.proj_matrix_R = None
+
+    def get_intrinsic(self, right=False, resized=True):
+        if resized:
+            assert self.rszshape_hw is not None, "[DriveCalibration] set_image_shape() was not called"
+            return self.intrinsic_R_rsz if right else self.intrinsic_rsz
+        return self.intrinsic_R if right else self.intrinsic
+
+    @staticmethod
+    def rescale_intrinsic(intrinsic, rawshape_hw, rszshape_hw):
+        if intrinsic is None:
+            return None
+        intrinsic_rsz = intrinsic.copy()
+        # rescale fx, cx
+        intrinsic_rsz[0] *= (rszshape_hw[1] / rawshape_hw[1])
+        # rescale fy, cy
+        intrinsic_rsz[1] *= (rszshape_hw[0] / rawshape_hw[0])
+        return frozen(intrinsic_rsz)
+
+    @staticmethod
+    def verify_intrinsic(intrinsic):
+        if intrinsic is None:
+            return None
+        intrinsic = np.asarray(intrinsic, dtype=np.float32)
+        assert intrinsic.shape == (3, 3), f"[DriveCalibration] wrong intrinsic shape: {intrinsic.shape}"
+        assert np.isfinite(intrinsic).all(), f"[DriveCalibration] invalid intrinsic:\n{intrinsic}"
+        assert (intrinsic[0, 0] > 0) and (intrinsic[1, 1] > 0), f"[DriveCalibration] wrong focal length:\n{intrinsic}"
+        assert np.allclose(intrinsic[2], [0, 0, 1]), f"[DriveCalibration] wrong last row:\n{intrinsic}"
+        return frozen(intrinsic)
+
+    @staticmethod
+    def verify_extrinsic(extrinsic):
+        if extrinsic is None:
+            return None
+        extrinsic = np.asarray(extrinsic, dtype=np.float32)
+        assert extrinsic.shape == (4, 4), f"[DriveCalibration] wrong extrinsic shape: {extrinsic.shape}"
+        assert np.allclose(extrinsic[3], [0, 0, 0, 1]), f"[DriveCalibration] wrong last row:\n{extrinsic}"
+        rotation = extrinsic[:3, :3]
+        assert np.allclose(np.dot(rotation, rotation.T), np.eye(3), atol=1e-3), \
+            f"[DriveCalibration] rotation is not orthonormal:\n{extrinsic}"
+        return frozen(extrinsic)
+
+
+def frozen(array):
+    array = array.astype(np.float32)
+    array.flags.writeable = False
+    return array
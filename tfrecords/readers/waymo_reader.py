@@ -1,11 +1,13 @@
 import os.path as op
+from collections import OrderedDict
 import numpy as np
 from scipy import sparse
 import tensorflow as tf
 from waymo_open_dataset.utils import frame_utils
 from waymo_open_dataset import dataset_pb2 as open_dataset
 
-from tfrecords.readers.reader_base import DataReaderBase
+from tfrecords.readers.reader_base import DataReaderBase, DriveCalibration
+from tfrecords.readers.frame_cache import FrameCache, DEFAULT_CACHE_BYTES
 from tfrecords.tfr_util import depth_map_to_point_cloud
 from utils.util_class import MyExceptionToCatch
 
@@ -14,11 +16,23 @@ FRONT_IND = 0
 
 
 class WaymoReader(DataReaderBase):
-    def __init__(self, split=""):
+    def __init__(self, split="", cache_bytes=DEFAULT_CACHE_BYTES, record_window=10):
+        """
+        :param record_window: number of the latest serialized records that are kept regardless of cache budget,
+                              it must cover frames of a snippet (up to 2*SNIPPET_LEN-1 frames with stride 2)
+        """
         super().__init__(split)
         self.tfr_dataset = None
-        self.frame_buffer = dict()
+        # decoded fields of recent frames
+        self.frame_cache = FrameCache(cache_bytes, "WaymoReader")
+        # records can be read only sequentially, so records of the current snippet window are pinned here
+        self.record_window = record_window
+        self.records = OrderedDict()
+        # the latest parsed frame to avoid parsing the same record for each field
+        self.parsed_frame = (-1, None)
         self.latest_index = -1
+        # calibrations of segments indexed by segment name
+        self.calib_buffer = dict()
 
     """
     Public methods used outside this class
@@ -29,6 +43,9 @@ class WaymoReader(DataReaderBase):
         """
         self.tfr_dataset = self._get_dataset(drive_path)
         self.tfr_dataset = iter(self.tfr_dataset)
+        self.frame_cache.clear()
+        self.records.clear()
+        self.parsed_frame = (-1, None)
         self.latest_index = -1
         # self.frame_names =
         # self.intrinsic =
@@ -42,17 +59,11 @@ class WaymoReader(DataReaderBase):
 
     def get_image(self, index, right=False):
         if right: return None
-        frame = self._get_frame(index)
-        front_image = tf.image.decode_jpeg(frame.images[0].image)
-        front_image = cv2.cvtColor(front_image.numpy(), cv2.COLOR_RGB2BGR)
-        return front_image.astype(np.uint8)
+        return self.frame_cache.get(index, "image", lambda: self._decode_image(index))
 
     def get_pose(self, index, right=False):
         if right: return None
-        frame = self._get_frame(index)
-        pose_c2w = tf.reshape(frame.images[0].pose.transform, (4, 4)) @ T_C2V
-        pose_c2w = pose_c2w.numpy()
-        return pose_c2w.astype(np.float32)
+        return self.frame_cache.get(index, "pose", lambda: self._decode_pose(index))
 
     def get_point_cloud(self, index, right=False):
         if right: return None
@@ -99,6 +110,13 @@ class WaymoReader(DataReaderBase):
     def get_stereo_extrinsic(self, index=0):
         return None
 
+    def get_calibration(self, index=0):
+        # a drive consists of several segments, calibration is constant within a segment
+        segment = self._get_frame(index).context.name
+        if segment not in self.calib_buffer:
+            self.calib_buffer[segment] = DriveCalibration(self.get_intrinsic(index))
+        return self.calib_buffer[segment]
+
     def get_filename(self, example_index):
         return None
 
@@ -112,29 +130,49 @@ class WaymoReader(DataReaderBase):
         return dataset
 
     def _get_frame(self, index):
-        if index in self.frame_buffer:
-            frame = self.frame_buffer[index]
-            time_of_day = f"{frame.context.stats.time_of_day}"
-            if time_of_day != "Day":
-                raise MyExceptionToCatch(f"time_of_day is not Day: {time_of_day}")
-            return frame
-
-        if (index == self.latest_index + 1) or self.latest_index < 0:
-            # add a new frame
-            frame_data = self.tfr_dataset.__next__()
+        if self.parsed_frame[0] != index:
+            record = self._get_record(index)
             frame = open_dataset.Frame()
-            frame.ParseFromString(bytearray(frame_data.numpy()))
-            self.frame_buffer[index] = frame
-            if index - 20 in self.frame_buffer:
-                self.frame_buffer.pop(index - 20, None)
-            self.latest_index = index
-            time_of_day = f"{frame.context.stats.time_of_day}"
-            if time_of_day != "Day":
-                raise MyExceptionToCatch(f"time_of_day is not Day: {time_of_day}")
-            # remove an old frame
-            return frame
-
-        assert 0, f"frame index is not consecutive: {self.latest_index} to {index}"
+            frame.ParseFromString(record)
+            self.parsed_frame = (index, frame)
+
+        frame = self.parsed_frame[1]
+        time_of_day = f"{frame.context.stats.time_of_day}"
+        if time_of_day != "Day":
+            raise MyExceptionToCatch(f"time_of_day is not Day: {time_of_day}")
+        return frame
+
+    def _get_record(self, index):
+        if index in self.records:
+            return self.records[index]
+        if index <= self.latest_index:
+            raise ValueError(f"[WaymoReader] record {index} is older than the pinned record window "
+                             f"{list(self.records.keys())}, increase record_window over the snippet length")
+        record = self._read_next_record(index)
+        self.records[index] = record
+        while len(self.records) > self.record_window:
+            self.records.popitem(last=False)
+        return record
+
+    def _read_next_record(self, index):
+        # records can be read only sequentially
+        assert (index == self.latest_index + 1) or (self.latest_index < 0), \
+            f"frame index is not consecutive: {self.latest_index} to {index}"
+        frame_data = self.tfr_dataset.__next__()
+        self.latest_index = index
+        return bytes(frame_data.numpy())
+
+    def _decode_image(self, index):
+        frame = self._get_frame(index)
+        front_image = tf.image.decode_jpeg(frame.images[0].image)
+        front_image = cv2.cvtColor(front_image.numpy(), cv2.COLOR_RGB2BGR)
+        return front_image.astype(np.uint8)
+
+    def _decode_pose(self, index):
+        frame = self._get_frame(index)
+        pose_c2w = tf.reshape(frame.images[0].pose.transform, (4, 4)) @ T_C2V
+        pose_c2w = pose_c2w.numpy()
+        return pose_c2w.astype(np.float32)
 
 
 def get_waymo_depth_map(frame, srcshape_hw, dstshape_hw, intrinsic):
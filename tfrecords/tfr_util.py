@@ -2,7 +2,6 @@ import numpy as np
 import cv2
 import tensorflow as tf
 import pandas as pd
-from utils.convert_pose import pose_matr2rvec
 
 
 class Serializer:
@@ -185,6 +184,30 @@ def point_cloud_to_depth_map(src_pcd, intrinsic, imshape):
     return depthmap
 
 
+def sparse_depth_to_depth_map(rows, cols, depths, srcshape_hw, dstshape_hw):
+    """
+    :param rows, cols: pixel coordinates of depth points in source image [N]
+    :param depths: depth values of points [N]
+    :param srcshape_hw: height and width of source image where rows and cols are defined
+    :param dstshape_hw: height and width of output depth map
+    :return: depth map [dstshape_hw], the nearest depth is taken where points collide (z-buffer)
+    """
+    # scale pixel coordinates in the same way as intrinsic is rescaled
+    dst_rows = np.round(rows * (dstshape_hw[0] / srcshape_hw[0])).astype(np.int64)
+    dst_cols = np.round(cols * (dstshape_hw[1] / srcshape_hw[1])).astype(np.int64)
+    valid = (dst_rows >= 0) & (dst_rows < dstshape_hw[0]) & (dst_cols >= 0) & (dst_cols < dstshape_hw[1]) \
+            & (depths > 0)
+    pixel_inds = dst_rows[valid] * dstshape_hw[1] + dst_cols[valid]
+    depths = depths[valid]
+    # sort by depth and keep the first (nearest) point of each pixel
+    order = np.argsort(depths, kind="stable")
+    pixel_inds, depths = pixel_inds[order], depths[order]
+    pixel_inds, first_inds = np.unique(pixel_inds, return_index=True)
+    depth_map = np.zeros(dstshape_hw[0] * dstshape_hw[1], dtype=np.float32)
+    depth_map[pixel_inds] = depths[first_inds]
+    return depth_map.reshape(dstshape_hw[0], dstshape_hw[1])
+
+
 def apply_color_map(depth):
     if len(depth.shape) > 2:
         depth = depth[:, :, 0]
@@ -194,33 +217,6 @@ def apply_color_map(depth):
     return depth_view
 
 
-def show_example(example, wait=0, print_param=False, max_height=1000, suffix=""):
-    image = example["image"]
-    dstsize_wh = (image.shape[1], image.shape[0])
-    if max_height:
-        dstsize_wh = (int(image.shape[1] * max_height / image.shape[0]), max_height)
-    image_view = cv2.resize(image, dstsize_wh) if image.shape[0] > 1000 else image.copy()
-    cv2.imshow("image" + suffix, image_view)
-
-    if "image_R" in example and example["image_R"] is not None:
-        image = example["image_R"]
-        image_view = cv2.resize(image, dstsize_wh) if image.shape[0] > 1000 else image.copy()
-        cv2.imshow("image_R" + suffix, image_view)
-
-    if "depth_gt" in example and example["depth_gt"] is not None:
-        depth = example["depth_gt"]
-        depth_view = (np.clip(depth, 0, 50.) / 50. * 256).astype(np.uint8)
-        depth_view = cv2.applyColorMap(depth_view, cv2.COLORMAP_VIRIDIS)
-        cv2.imshow("depth" + suffix, depth_view)
-
-    if print_param:
-        print("\nintrinsic:\n", example["intrinsic"])
-        if "pose_gt" in example and example["pose_gt"] is not None:
-            print("pose\n", pose_matr2rvec(example["pose_gt"]))
-
-    cv2.waitKey(wait)
-
-
 # ======================================================================
 import pykitti
 
@@ -245,5 +241,26 @@ def test_point_cloud_to_depth_map():
     print("!!! test_point_cloud_to_depth_map passed")
 
 
+def test_sparse_depth_to_depth_map():
+    print("\n===== start test_sparse_depth_to_depth_map")
+    srcshape_hw, dstshape_hw = (1208, 1920), (302, 480)
+    num_points = 20000
+    rows = np.random.uniform(-0.5, srcshape_hw[0] - 0.5, num_points).astype(np.float32)
+    cols = np.random.uniform(-0.5, srcshape_hw[1] - 0.5, num_points).astype(np.float32)
+    depths = np.random.uniform(1., 80., num_points).astype(np.float32)
+    depth_map = sparse_depth_to_depth_map(rows, cols, depths, srcshape_hw, dstshape_hw)
+    # compare with point-by-point z-buffer
+    expected = np.zeros(dstshape_hw, dtype=np.float32)
+    for row, col, depth in zip(rows, cols, depths):
+        v = int(np.round(row * dstshape_hw[0] / srcshape_hw[0]))
+        u = int(np.round(col * dstshape_hw[1] / srcshape_hw[1]))
+        if (0 <= v < dstshape_hw[0]) and (0 <= u < dstshape_hw[1]):
+            if (expected[v, u] == 0) or (depth < expected[v, u]):
+                expected[v, u] = depth
+    assert np.allclose(depth_map, expected)
+    print("!!! test_sparse_depth_to_depth_map passed")
+
+
 if __name__ == "__main__":
+    test_sparse_depth_to_depth_map()
     test_point_cloud_to_depth_map()
@@ -48,8 +48,9 @@ class TfrecordMakerBase:
     def get_example_maker(self, dataset, split, shwc_shape, data_keys):
         return ExampleMaker(dataset, split, shwc_shape, data_keys)
 
-    def make(self, frame_per_drive=0, total_frame_limit=0):
+    def make(self, frame_per_drive=0, total_frame_limit=0, previewer=None):
         print("\n\n========== Start a new dataset:", op.basename(self.tfrpath))
+        self.example_maker.previewer = previewer
         num_drives = len(self.drive_paths)
         with uc.PathManager([self.tfrpath__], closer_func=self.on_exit) as pm:
             self.pm = pm
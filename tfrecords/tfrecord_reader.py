@@ -9,11 +9,22 @@ import utils.util_funcs as uf
 
 
 class TfrecordReader:
-    def __init__(self, tfrpath, shuffle=False, epochs=1, batch_size=opts.BATCH_SIZE):
+    def __init__(self, tfrpath, shuffle=False, epochs=1, batch_size=opts.BATCH_SIZE, num_shards=1, shard_index=0,
+                 shuffle_seed=None, skip_batches=0):
+        """
+        :param num_shards, shard_index: for multi-worker training, each worker reads
+                                        every num_shards-th tfrecord file starting from shard_index
+        :param shuffle_seed: seed that fixes the order of shuffled records, they are reshuffled every iteration if None
+        :param skip_batches: number of batches skipped at the beginning, e.g. batches trained before a checkpoint
+        """
         self.tfrpath = tfrpath
         self.shuffle = shuffle
         self.epochs = epochs
         self.batch_size = batch_size
+        self.num_shards = num_shards
+        self.shard_index = shard_index
+        self.shuffle_seed = shuffle_seed
+        self.skip_batches = skip_batches
         self.config = self.read_tfrecord_config(tfrpath)
         self.features_dict = self.get_features(self.config)
 
@@ -71,8 +82,21 @@ class TfrecordReader:
         filenames = tf.io.gfile.glob(file_pattern)
         filenames.sort()
         print("[tfrecord reader]", file_pattern, filenames)
-        dataset = tf.data.TFRecordDataset(filenames)
-
+        if len(filenames) >= self.num_shards:
+            # file-level sharding: each worker reads disjoint files
+            dataset = tf.data.TFRecordDataset(filenames[self.shard_index::self.num_shards])
+        else:
+            # fewer files than workers: every worker reads all files and takes every num_shards-th record
+            dataset = tf.data.TFRecordDataset(filenames).shard(self.num_shards, self.shard_index)
+        # serialized records are shuffled and skipped before parsing,
+        # so the shuffle buffer holds compact records and skipped records are not decoded
+        if self.shuffle:
+            dataset = dataset.shuffle(buffer_size=400, seed=self.shuffle_seed,
+                                      reshuffle_each_iteration=self.shuffle_seed is None)
+            print("[dataset] dataset suffled")
+        if self.skip_batches > 0:
+            dataset = dataset.skip(self.skip_batches * self.batch_size)
+            print(f"[dataset] skip {self.skip_batches} batches")
         dataset = dataset.map(self.parse_example)
         return self.dataset_process(dataset)
 
@@ -99,9 +123,6 @@ class TfrecordReader:
         return decoded
 
     def dataset_process(self, dataset):
-        if self.shuffle:
-            dataset = dataset.shuffle(buffer_size=400)
-            print("[dataset] dataset suffled")
         print(f"[dataset] num epochs={self.epochs}, batch size={self.batch_size}")
         dataset = dataset.repeat(self.epochs)
         dataset = dataset.batch(batch_size=self.batch_size, drop_remainder=True)
@@ -113,6 +134,31 @@ class TfrecordReader:
     def get_tfr_config(self):
         return self.config
 
+    def get_feature_signature(self):
+        return feature_signature(self.config, self.batch_size)
+
+
+def feature_signature(tfr_config, batch_size):
+    """
+    :param tfr_config: config read from tfr_config.txt
+    :param batch_size: batch size, batches are made with drop_remainder, so it is static
+    :return: {key: tf.TensorSpec} of batched features that are output from TfrecordReader.parse_example()
+    """
+    signature = dict()
+    for key, feat_conf in tfr_config.items():
+        if not isinstance(feat_conf, dict):
+            continue
+        shape = feat_conf["shape"] if feat_conf["shape"] is not None else [None]
+        signature[key] = tf.TensorSpec([batch_size] + list(shape), feat_conf["decode_type"], name=key)
+
+    # images are converted to float and reshaped to 5D in parse_example()
+    for key, key5d in [("image", "image5d"), ("image_R", "image5d_R")]:
+        if key in signature:
+            signature[key] = tf.TensorSpec(signature[key].shape, tf.float32, name=key)
+            signature[key5d] = tf.TensorSpec([batch_size] + list(tfr_config["imshape"]), tf.float32, name=key5d)
+    return signature
+
+
 # --------------------------------------------------------------------------------
 # TESTS
 
@@ -155,7 +201,23 @@ def test_reuse_dataset():
     print("Dataset is REUSABLE")
 
 
+def test_feature_signature():
+    """
+    Test if feature signature from tfr_config.txt matches the dataset element spec
+    """
+    print("\n===== start test_feature_signature")
+    tfrgen = TfrecordReader(op.join(opts.DATAPATH_TFR, "kitti_raw_val"), batch_size=4)
+    dataset = tfrgen.get_dataset()
+    signature = tfrgen.get_feature_signature()
+    assert set(signature.keys()) == set(dataset.element_spec.keys())
+    for key, spec in dataset.element_spec.items():
+        print(f"{key}: signature={signature[key].shape}, {signature[key].dtype}, dataset={spec.shape}, {spec.dtype}")
+        assert signature[key].shape == spec.shape and signature[key].dtype == spec.dtype
+    print("!!! test_feature_signature passed")
+
+
 if __name__ == "__main__":
     np.set_printoptions(precision=4, suppress=True)
     test_read_dataset()
     # test_reuse_dataset()
+    # test_feature_signature()
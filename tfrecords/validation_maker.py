@@ -6,10 +6,10 @@ import json
 import utils.util_funcs as uf
 from utils.util_class import PathManager
 from tfrecords.tfrecord_reader import TfrecordReader
-from tfrecords.tfr_util import Serializer, show_example
+from tfrecords.tfr_util import Serializer
 
 
-def generate_validation_tfrecords(tfrpath, val_frames):
+def generate_validation_tfrecords(tfrpath, val_frames, previewer=None):
     srcpath = check_source_path(tfrpath)
     if srcpath is None:
         return
@@ -38,10 +38,8 @@ def generate_validation_tfrecords(tfrpath, val_frames):
                 tfrwriter.write(serialized)
                 save_count += 1
                 uf.print_progress_status(f"== [validation] index: {i}, count: {save_count}/{val_frames}")
-                if save_count % 100 == 10:
-                    show_example(example, 100, True)
-                elif save_count % 50 == 10:
-                    show_example(example, 100)
+                if previewer is not None:
+                    previewer.submit(example, f"val_{save_count:06d}")
 
             write_tfrecord_config(tfrpath, config, save_count)
         pm.set_ok()
@@ -191,6 +191,21 @@ def pose_matr2rvec(poses):
     return pose_vec
 
 
+def pose_inverse_batch_np(poses):
+    """
+    :param poses: rigid transformation matrices as np.array, [..., 4, 4]
+    :return: inverse transformation matrices, [..., 4, 4]
+    inverse of rigid transformation is [R^T, -R^T t], no need of general matrix inversion
+    """
+    rot_inv = np.swapaxes(poses[..., :3, :3], -1, -2)
+    trans_inv = -np.einsum("...ij,...j->...i", rot_inv, poses[..., :3, 3])
+    poses_inv = np.zeros(poses.shape, dtype=poses.dtype)
+    poses_inv[..., :3, :3] = rot_inv
+    poses_inv[..., :3, 3] = trans_inv
+    poses_inv[..., 3, 3] = 1
+    return poses_inv
+
+
 # --------------------------------------------------------------------------------
 # TESTS
 
@@ -271,6 +286,15 @@ def test_pose_matr2rvec_batch():
     print("!!! test_pose_matr2rvec_batch passed")
 
 
+def test_pose_inverse_batch_np():
+    print("===== start test_pose_inverse_batch_np")
+    pose_vec = np.random.uniform(-1., 1., (4, 5, 6))
+    poses = pose_rvec2matr_batch_np(pose_vec)
+    poses_inv = pose_inverse_batch_np(poses)
+    assert np.isclose(poses_inv, np.linalg.inv(poses), atol=1e-6).all()
+    print("!!! test_pose_inverse_batch_np passed")
+
+
 def test():
     np.set_printoptions(precision=4, suppress=True)
     test_pose_quat2matr()
@@ -278,6 +302,7 @@ def test():
     test_pose_rvec2matr_batch()
     test_pose_rvec2matr()
     test_pose_matr2rvec_batch()
+    test_pose_inverse_batch_np()
 
 
 if __name__ == "__main__":
@@ -5,7 +5,6 @@ import os.path as op
 import pandas as pd
 import numpy as np
 import tensorflow as tf
-from tensorflow.keras import layers
 
 from config import opts
 
@@ -155,11 +154,27 @@ def safe_reciprocal_number_ms(src_ms):
 
 
 def safe_reciprocal_number(src_tensor):
-    mask = tf.cast(src_tensor > 0.00001, tf.float32)
+    # mask follows input dtype, e.g. float16 under mixed precision policy
+    mask = tf.cast(src_tensor > 0.00001, src_tensor.dtype)
     dst_tensor = (1. / src_tensor) * mask
     return dst_tensor
 
 
+def cast_float32(data):
+    """
+    :param data: tensor or dict or list of tensors
+    :return: the same structure whose floating point tensors are cast to float32
+    """
+    if isinstance(data, dict):
+        return {key: cast_float32(value) for key, value in data.items()}
+    elif isinstance(data, (list, tuple)):
+        return [cast_float32(value) for value in data]
+    elif isinstance(data, tf.Tensor) and data.dtype.is_floating and data.dtype != tf.float32:
+        return tf.cast(data, tf.float32)
+    else:
+        return data
+
+
 def multi_scale_like_depth(image, depth_ms):
     """
     :param image: [batch, height, width, 3]
@@ -167,10 +182,9 @@ def multi_scale_like_depth(image, depth_ms):
     :return: image_ms: list of [batch, height/scale, width/scale, 3]
     """
     image_ms = []
-    for i, depth in enumerate(depth_ms):
+    for depth in depth_ms:
         batch, height_sc, width_sc, _ = depth.get_shape().as_list()
-        image_sc = layers.Lambda(lambda img: tf.image.resize(img, size=(height_sc, width_sc), method="bilinear"),
-                                 name=f"resize_like_depth_{i}")(image)
+        image_sc = tf.image.resize(image, size=(height_sc, width_sc), method="bilinear")
         image_ms.append(image_sc)
     return image_ms
 
@@ -182,10 +196,9 @@ def multi_scale_like_flow(image, flow_ms):
     :return: image_ms: list of [batch, height/scale, width/scale, 3]
     """
     image_ms = []
-    for i, flow in enumerate(flow_ms):
+    for flow in flow_ms:
         batch, numsrc, height_sc, width_sc, _ = flow.get_shape().as_list()
-        image_sc = layers.Lambda(lambda img: tf.image.resize(img, size=(height_sc, width_sc), method="bilinear"),
-                                 name=f"resize_like_flow_{i}")(image)
+        image_sc = tf.image.resize(image, size=(height_sc, width_sc), method="bilinear")
         image_ms.append(image_sc)
     return image_ms
 
@@ -221,3 +234,18 @@ def stack_titled_images(view_imgs, guide_lines=True):
 
 def count_nan(tensor):
     return tf.reduce_sum(tf.cast(tf.math.is_nan(tensor), tf.int32)).numpy()
+
+
+def measure_peak_memory(func, device="CPU:0"):
+    """
+    :param func: function without argument, e.g. a traced train step
+    :return: output of func and peak memory (MB) allocated by TF on device while func runs,
+             above the memory already in use, None when TF does not report memory stats (TF < 2.5)
+    """
+    if not hasattr(tf.config.experimental, "reset_memory_stats"):
+        return func(), None
+    tf.config.experimental.reset_memory_stats(device)
+    in_use = tf.config.experimental.get_memory_info(device)["current"]
+    output = func()
+    peak = tf.config.experimental.get_memory_info(device)["peak"]
+    return output, (peak - in_use) / 2**20